@@ -14,16 +14,31 @@
 """
 """
 import copy
-import pprint as pp
+import datetime
+import functools
 import re
-import six
+import struct
 import sys
-import types
-
+import threading
+import time
+import uuid
+
+import bson
+import bson.binary
+import bson.max_key
+import bson.min_key
 import bson.objectid
 import bson.son
-import pymongo.cursor
-import pymongo.database
+import bson.timestamp
+import bson.tz_util
+import pymongo
+import pymongo.errors
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # python 2
+    from collections import Mapping
 
 try:
     # pymongo 2.8
@@ -32,11 +47,39 @@ except ImportError:
     # pymongo < 2.8
     from pymongo.database import _check_name as _check_database_name
 
+try:
+    # python >= 3.11
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
 try:
     unicode
 except NameError:
     unicode = str
 
+# six replacements, six is only imported by the optional modules
+if sys.version_info[0] >= 3:
+    string_types = (str,)
+    integer_types = (int,)
+    unichr = chr
+else:
+    string_types = (basestring,)
+    integer_types = (int, long)
+    unichr = unichr
+
+try:
+    decodeBSON = bson.decode
+    encodeBSON = bson.encode
+except AttributeError:
+    # pymongo < 3.9
+    def decodeBSON(data):
+        """Decode a BSON document from bytes or a buffer"""
+        return bson.BSON(bytes(data)).decode()
+
+    encodeBSON = bson.BSON.encode
+
+
 def toUnicode(s):
     try:
         return unicode(s)
@@ -52,44 +95,170 @@ def toUnicode(s):
 ###############################################################################
 
 # SON to dict converter
+def _dictifyFrame(data):
+    # [source, value iterator, converted values, keys, changed]
+    if isinstance(data, dict):
+        return [data, iter(list(data.values())), [], list(data.keys()),
+                type(data) is not dict]
+    return [data, iter(data), [], None, type(data) not in (list, tuple)]
+
+
 def dictify(data):
-    """Recursive replace SON items with dict in the given data structure.
+    """Replace SON items with dict in the given data structure.
 
     Compared to the SON.to_dict method, this method will also handle tuples
     and keep them intact.
 
+    The structure gets processed with an explicit stack and not recursive.
+    Subtrees which don't contain any SON item get returned as is and don't
+    get copied.
     """
-    if isinstance(data, bson.son.SON):
-        data = dict(data)
-    if isinstance(data, dict):
-        d = {}
-        for k, v in data.items():
-            # replace nested SON items
-            d[k] = dictify(v)
-    elif isinstance(data, (tuple, list)):
-        d = []
-        for v in data:
-            # replace nested SON items
-            d.append(dictify(v))
-        if isinstance(data, tuple):
-            # keep tuples intact
-            d = tuple(d)
-    else:
-        d = data
-    return d
+    if not isinstance(data, (dict, list, tuple)):
+        return data
+    stack = [_dictifyFrame(data)]
+    while True:
+        frame = stack[-1]
+        values = frame[2]
+        for value in frame[1]:
+            if isinstance(value, (dict, list, tuple)):
+                stack.append(_dictifyFrame(value))
+                break
+            values.append(value)
+        else:
+            # all values processed
+            stack.pop()
+            source = frame[0]
+            if not frame[4]:
+                result = source
+            elif isinstance(source, dict):
+                result = dict(zip(frame[3], values))
+            elif isinstance(source, tuple):
+                # keep tuples intact
+                result = tuple(values)
+            else:
+                result = list(values)
+            if not stack:
+                return result
+            parent = stack[-1]
+            parent[2].append(result)
+            if result is not source:
+                parent[4] = True
 
 
-def pprint(data):
+def pprint(data, stream=None):
     """Can pprint a bson.son.SON instance like a dict"""
-    pp.pprint(dictify(data))
+    _lazy('BSONPrettyPrinter')(stream=stream).pprint(data)
+
+
+def _createDatePattern():
+    return re.compile(
+        r"(\d\d\d\d)-(\d\d)-(\d\d)([tT ])(\d\d):(\d\d):(\d\d)")
+
+
+def _createObjectAtPattern():
+    return re.compile(r"object at 0x[a-zA-Z0-9]+")
+
+
+# nested values get formatted with PrettyPrinter.format since python 3.10
+NESTED_FORMAT = sys.version_info >= (3, 10)
+
+
+def _createBSONPrettyPrinter():
+    # the class gets created on first use, importing pprint is not needed
+    # for running tests with the fake
+    import pprint
+    PrettyPrinter = pprint.PrettyPrinter
+
+    class BSONPrettyPrinter(pprint.PrettyPrinter):
+        """PrettyPrinter which knows how to print SON items like dicts.
+
+        With normalize=True, ObjectId, datetime, Timestamp, date strings and
+        memory addresses get normalized while formatting.
+        """
+
+        def __init__(self, indent=1, width=80, depth=None, stream=None,
+            normalize=False):
+            pprint.PrettyPrinter.__init__(self, indent, width, depth, stream)
+            self.normalize = normalize
+
+        def pprint(self, object):
+            pprint.PrettyPrinter.pprint(self, dictify(object))
+
+        def pformat(self, object):
+            return pprint.PrettyPrinter.pformat(self, dictify(object))
+
+        def _normalize(self, object):
+            if isinstance(object, bson.objectid.ObjectId):
+                return "ObjectId('...')"
+            elif isinstance(object, datetime.datetime):
+                if object.tzinfo is None:
+                    return "datetime.datetime(...)"
+                elif isinstance(object.tzinfo, bson.tz_util.FixedOffset):
+                    return ("datetime(..., "
+                            "tzinfo=<bson.tz_util.FixedOffset ...>)")
+                return "datetime(..., tzinfo= ...)"
+            elif isinstance(object, bson.timestamp.Timestamp):
+                return "Timestamp('...')"
+            elif isinstance(object, string_types) and '-' in object:
+                return _lazy('DATE_PATTERN').sub(r"NNNN-NN-NN\4NN:NN:NN",
+                    repr(object))
+            return None
+
+        def format(self, object, context, maxlevels, level):
+            if self.normalize:
+                rep = self._normalize(object)
+                if rep is not None:
+                    return rep, False, False
+            rep, readable, recursive = pprint.PrettyPrinter.format(self,
+                object, context, maxlevels, level)
+            if self.normalize and 'object at 0x' in rep:
+                rep = _lazy('OBJECT_AT_PATTERN').sub("object at ...", rep)
+            return rep, readable, recursive
+
+        if hasattr(PrettyPrinter, '_pprint_str'):
+            # strings longer than the width get split into lines without
+            # format, normalize the dates before a date gets split
+            def _pprint_str(self, object, stream, indent, allowance, context,
+                level):
+                if self.normalize and '-' in object:
+                    object = _lazy('DATE_PATTERN').sub(
+                        r"NNNN-NN-NN\4NN:NN:NN", object)
+                pprint.PrettyPrinter._pprint_str(self, object, stream, indent,
+                    allowance, context, level)
+
+            _dispatch = dict(PrettyPrinter._dispatch)
+            _dispatch[str.__repr__] = _pprint_str
+
+    BSONPrettyPrinter.__module__ = __name__
+    return BSONPrettyPrinter
 
 
 class RENormalizer(object):
-    """Normalizer which can convert text based on regex patterns"""
+    """Normalizer which can convert text based on regex patterns.
+
+    Consecutive (regex, replacement) patterns get combined into one
+    alternation regex and applied in a single pass over the text. A callback
+    dispatches each match to the replacement of the matching pattern. If
+    patterns overlap, the leftmost match wins and on the same position the
+    first given pattern. Callable patterns get applied to the whole text.
+
+    Like with patterns applied one by one, a later pattern can match the
+    replacement of a previous one. Such a pattern starts a new pass, also a
+    pattern following a callable replacement or one with group references.
+    Only a match spanning a replacement and the text around it doesn't get
+    chained.
+    """
 
     def __init__(self, patterns):
-        self.patterns = patterns
-        self.transformers = map(self._cook, patterns)
+        self.patterns = list(patterns)
+        self._transformers = None
+
+    @property
+    def transformers(self):
+        """The transformer passes, compiled on first use"""
+        if self._transformers is None:
+            self._compile()
+        return self._transformers
 
     def _cook(self, pattern):
         if callable(pattern):
@@ -97,44 +266,208 @@ class RENormalizer(object):
         regexp, replacement = pattern
         return lambda text: regexp.sub(replacement, text)
 
+    def _combinable(self, regexp):
+        # numbered backreferences would point to the wrong group
+        return re.search(r'\\[1-9]|\(\?P=', regexp.pattern) is None
+
+    def _chains(self, run, regexp):
+        # whether regexp can match the output of a pattern in run
+        for previous, replacement in run:
+            if callable(replacement) or '\\' in replacement:
+                return True
+            if regexp.search(replacement) is not None:
+                return True
+        return False
+
+    def _firstChars(self, parsed):
+        """Return regex char class items matching the first char or None"""
+        if not len(parsed):
+            return None
+        op, av = parsed[0]
+        if op is sre_parse.LITERAL:
+            return [re.escape(unichr(av))]
+        elif op is sre_parse.IN:
+            items = []
+            for iop, iav in av:
+                if iop is sre_parse.LITERAL:
+                    items.append(re.escape(unichr(iav)))
+                elif iop is sre_parse.RANGE:
+                    items.append('%s-%s' % (re.escape(unichr(iav[0])),
+                                            re.escape(unichr(iav[1]))))
+                elif iav in self._categories:
+                    items.append(self._categories[iav])
+                else:
+                    return None
+            return items
+        elif op is sre_parse.SUBPATTERN:
+            return self._firstChars(av[-1])
+        elif op is sre_parse.BRANCH:
+            items = []
+            for branch in av[1]:
+                chars = self._firstChars(branch)
+                if chars is None:
+                    return None
+                items.extend(chars)
+            return items
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0]:
+            return self._firstChars(av[2])
+        return None
+
+    _categories = {
+        sre_parse.CATEGORY_DIGIT: r'\d',
+        sre_parse.CATEGORY_WORD: r'\w',
+        sre_parse.CATEGORY_SPACE: r'\s',
+        }
+
+    def _getPrefilter(self, regexps):
+        """Lookahead for the possible first chars of all patterns.
+
+        Without such a lookahead the regex engine tries each alternative at
+        each position of the text.
+        """
+        items = []
+        for regexp in regexps:
+            if regexp.flags & re.IGNORECASE:
+                return ''
+            try:
+                chars = self._firstChars(sre_parse.parse(regexp.pattern,
+                                                         regexp.flags))
+            except Exception:
+                chars = None
+            if chars is None:
+                return ''
+            for char in chars:
+                if char not in items:
+                    items.append(char)
+        return '(?=[%s])' % ''.join(items)
+
+    def _combine(self, run):
+        regexps = [regexp for regexp, replacement in run]
+        parts = ['(?P<_p%d>%s)' % (idx, regexp.pattern)
+                 for idx, regexp in enumerate(regexps)]
+        try:
+            combined = re.compile('%s(?:%s)' % (self._getPrefilter(regexps),
+                '|'.join(parts)), regexps[0].flags)
+        except re.error:
+            # e.g. duplicated group names, apply them one by one
+            return [self._cook(pattern) for pattern in run]
+        dispatch = {}
+        for idx, (regexp, replacement) in enumerate(run):
+            dispatch['_p%d' % idx] = self._getReplacer(regexp, replacement)
+
+        def replace(match):
+            return dispatch[match.lastgroup](match)
+
+        return [lambda text: combined.sub(replace, text)]
+
+    def _getReplacer(self, regexp, replacement):
+        if not callable(replacement) and '\\' not in replacement:
+            # plain text, no group references
+            return lambda match: replacement
+
+        def replacer(match):
+            # match again with the original pattern for correct groups
+            m = regexp.match(match.string, match.start())
+            if callable(replacement):
+                return replacement(m)
+            return m.expand(replacement)
+
+        return replacer
+
+    def _compile(self):
+        """Setup the (reusable) transformer passes"""
+        passes = []
+        run = []
+        for pattern in self.patterns:
+            if not callable(pattern):
+                regexp, replacement = pattern
+                if isinstance(regexp, string_types):
+                    regexp = re.compile(regexp)
+                if self._combinable(regexp):
+                    if run and (run[0][0].flags != regexp.flags or
+                                self._chains(run, regexp)):
+                        passes.extend(self._combine(run))
+                        run = []
+                    run.append((regexp, replacement))
+                    continue
+                pattern = self._cook((regexp, replacement))
+            if run:
+                passes.extend(self._combine(run))
+                run = []
+            passes.append(pattern)
+        if run:
+            passes.extend(self._combine(run))
+        self._transformers = passes
+
     def addPattern(self, pattern):
-        patterns = list(self.patterns)
-        patterns.append(pattern)
-        self.transformers = map(self._cook, patterns)
-        self.patterns = patterns
+        self.patterns.append(pattern)
+        self._transformers = None
 
     def __call__(self, data):
         """Recursive normalize a SON instance, dict or text"""
-        if not isinstance(data, six.string_types):
-            data = pp.pformat(dictify(data))
-        for normalizer in self.transformers:
-            data = normalizer(dictify(data))
+        if not isinstance(data, string_types):
+            import pprint
+            data = pprint.pformat(dictify(data))
+        for transformer in self.transformers:
+            data = transformer(data)
         return data
 
-    def pprint(self, data):
-        """Pretty print data"""
-        if isinstance(data, pymongo.cursor.Cursor):
+    def pprint(self, data, stream=None):
+        """Pretty print data, cursors get printed document by document"""
+        if stream is None:
+            stream = sys.stdout
+        import pymongo.cursor
+        import types
+        if isinstance(data, (pymongo.cursor.Cursor, FakeCursor,
+                             types.GeneratorType)):
             for item in data:
-                print(self(item))
+                stream.write(self(item))
+                stream.write('\n')
         else:
-            print(self(data))
-
-
-# see testing.txt for a sample usage
-reNormalizer = RENormalizer([
-   (re.compile(u"(\d\d\d\d)-(\d\d)-(\d\d)[tT](\d\d):(\d\d):(\d\d)"),
-               r"NNNN-NN-NNTNN:NN:NN"),
-   (re.compile(u"(\d\d\d\d)-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)"),
-               r"NNNN-NN-NN NN:NN:NN"),
-   (re.compile("ObjectId\(\'[a-zA-Z0-9]+\'\)"), r"ObjectId('...')"),
-   (re.compile("Timestamp\([a-zA-Z0-9, ]+\)"), r"Timestamp('...')"),
-   (re.compile("datetime.datetime\([a-zA-Z0-9, ]+tzinfo=<bson.tz_util.FixedOffset[a-zA-Z0-9 ]+>\)"),
-               "datetime(..., tzinfo=<bson.tz_util.FixedOffset ...>)"),
-   (re.compile("datetime.datetime\([a-zA-Z0-9, ]+tzinfo=[a-zA-Z0-9>]+\)"),
-               "datetime(..., tzinfo= ...)"),
-   (re.compile("datetime\([a-z0-9, ]+\)"), "datetime(...)"),
-   (re.compile("object at 0x[a-zA-Z0-9]+"), "object at ..."),
-   ])
+            stream.write(self(data))
+            stream.write('\n')
+
+
+class BSONNormalizer(RENormalizer):
+    """Normalizes data with a normalizing BSONPrettyPrinter.
+
+    The regex patterns only get applied to text. Patterns added with
+    addPattern get also applied to the formatted data.
+    """
+
+    def __init__(self, patterns, printer=None):
+        super(BSONNormalizer, self).__init__(patterns)
+        if printer is None:
+            printer = _lazy('BSONPrettyPrinter')(normalize=True)
+        self.printer = printer
+        self.dataNormalizer = RENormalizer([])
+
+    def addPattern(self, pattern):
+        super(BSONNormalizer, self).addPattern(pattern)
+        self.dataNormalizer.addPattern(pattern)
+
+    def __call__(self, data):
+        if isinstance(data, string_types) or not NESTED_FORMAT:
+            return super(BSONNormalizer, self).__call__(data)
+        return self.dataNormalizer(self.printer.pformat(data))
+
+
+def _createReNormalizer():
+    # see testing.txt for a sample usage
+    return BSONNormalizer([
+        (re.compile(r"(\d\d\d\d)-(\d\d)-(\d\d)[tT](\d\d):(\d\d):(\d\d)"),
+                    r"NNNN-NN-NNTNN:NN:NN"),
+        (re.compile(r"(\d\d\d\d)-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)"),
+                    r"NNNN-NN-NN NN:NN:NN"),
+        (re.compile(r"ObjectId\(\'[a-zA-Z0-9]+\'\)"), r"ObjectId('...')"),
+        (re.compile(r"Timestamp\([a-zA-Z0-9, ]+\)"), r"Timestamp('...')"),
+        (re.compile(r"datetime.datetime\([a-zA-Z0-9, ]+tzinfo=<bson.tz_util.FixedOffset[a-zA-Z0-9 ]+>\)"),
+                    "datetime(..., tzinfo=<bson.tz_util.FixedOffset ...>)"),
+        (re.compile(r"datetime.datetime\([a-zA-Z0-9, ]+tzinfo=[a-zA-Z0-9>]+\)"),
+                    "datetime(..., tzinfo= ...)"),
+        (re.compile(r"datetime\([a-z0-9, ]+\)"), "datetime(...)"),
+        (re.compile(r"object at 0x[a-zA-Z0-9]+"), "object at ..."),
+        ])
 
 
 def getObjectId(secs=0):
@@ -146,12 +479,221 @@ def getObjectId(secs=0):
     return bson.objectid.ObjectId(("%08x" % secs) + "0" * 16)
 
 
+# secs timestamp and counter of the ObjectIds from getObjectIds
+OBJECTID_STRUCT = struct.Struct('>IQ')
+
+
+def getObjectIds(start, count, secs=None):
+    """Return count similar ObjectIds for the counters start, start + 1, ...
+
+    Without secs the ObjectIds are the same as from getObjectId(counter).
+    With secs all ObjectIds use the secs timestamp followed by the counter.
+    """
+    pack = OBJECTID_STRUCT.pack
+    ObjectId = bson.objectid.ObjectId
+    if secs is None:
+        return [ObjectId(pack(i, 0)) for i in range(start, start + count)]
+    return [ObjectId(pack(secs, i)) for i in range(start, start + count)]
+
+
+class Histogram(object):
+    """Simple histogram with fixed (upper bound) buckets"""
+
+    # default bounds in seconds
+    BOUNDS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self, bounds=None):
+        if bounds is None:
+            bounds = self.BOUNDS
+        self.bounds = tuple(bounds) + (float('inf'),)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        for idx, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def buckets(self):
+        """List of (upper bound, count) tuples"""
+        return list(zip(self.bounds, self.counts))
+
+    def toDict(self):
+        return {'count': self.count,
+                'total': self.total,
+                'max': self.max,
+                'buckets': self.buckets}
+
+
+# operation: (opcounter, latency type) like the serverStatus opcounters and
+# opLatencies, find and getMore get counted by the cursor, save counts the
+# insert or update it calls
+OPERATION_TYPES = {
+    'find': ('query', 'reads'),
+    'getMore': ('getmore', 'reads'),
+    'find_one': ('query', 'reads'),
+    'count': ('command', 'reads'),
+    'count_documents': ('command', 'reads'),
+    'estimated_document_count': ('command', 'reads'),
+    'distinct': ('command', 'reads'),
+    'insert': ('insert', 'writes'),
+    'update': ('update', 'writes'),
+    'remove': ('delete', 'writes'),
+    'find_and_modify': ('command', 'writes'),
+    'find_one_and_update': ('command', 'writes'),
+    'find_one_and_replace': ('command', 'writes'),
+    'find_one_and_delete': ('command', 'writes'),
+    'create_index': ('command', 'commands'),
+    'ensure_index': ('command', 'commands'),
+    'drop_index': ('command', 'commands'),
+    'drop_indexes': ('command', 'commands'),
+    }
+
+
+class OperationStats(object):
+    """Operation counters and latency histograms per latency type (reads,
+    writes, commands) of a client"""
+
+    OPCOUNTERS = ('insert', 'query', 'update', 'delete', 'getmore', 'command')
+
+    def __init__(self):
+        self.opcounters = dict([(op, 0) for op in self.OPCOUNTERS])
+        self.latencies = {'reads': Histogram(),
+                          'writes': Histogram(),
+                          'commands': Histogram()}
+        self._lock = threading.Lock()
+
+    def add(self, op, kind, duration, count=1):
+        with self._lock:
+            self.opcounters[op] += count
+            self.latencies[kind].add(duration)
+
+    def getOpLatencies(self):
+        """Return the latencies like the serverStatus opLatencies, the total
+        latency in microseconds and the histogram buckets"""
+        with self._lock:
+            return dict([(kind, {'latency': int(h.total * 1000000),
+                                 'ops': h.count,
+                                 'histogram': h.buckets})
+                         for kind, h in self.latencies.items()])
+
+
+# the operation of the current thread gets counted, nested calls don't count
+_counting = threading.local()
+
+# estimated index entry overhead in bytes (record id and key header)
+INDEX_ENTRY_SIZE = 16
+
+
+def getKeySize(value):
+    """Estimate the BSON size of an index key value in bytes"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, string_types):
+        return len(value) + 5
+    if isinstance(value, bytes):
+        return len(value) + 5
+    if isinstance(value, (tuple, list)):
+        # hashable index values of arrays and documents
+        return sum([getKeySize(v) + 2 for v in value]) + 5
+    if isinstance(value, bson.objectid.ObjectId):
+        return 12
+    return 8
+
+
+def _getBSONValueSize(value):
+    t = type(value)
+    if t is unicode:
+        return len(value.encode('utf-8')) + 5
+    if t is int:
+        return -2147483648 <= value <= 2147483647 and 4 or 8
+    if t is float or t is datetime.datetime:
+        return 8
+    if t is bool:
+        return 1
+    if value is None:
+        return 0
+    if t is bson.objectid.ObjectId:
+        return 12
+    if isinstance(value, dict):
+        return getBSONSize(value)
+    if isinstance(value, (list, tuple)):
+        size = 5
+        for idx, v in enumerate(value):
+            size += len(str(idx)) + 2 + _getBSONValueSize(v)
+        return size
+    # the size of {'': value} without the document overhead
+    try:
+        return len(encodeBSON({'': value})) - 7
+    except Exception:
+        return 8
+
+
+def getBSONSize(doc):
+    """Return the BSON size of a document without encoding it"""
+    raw = getattr(doc, 'raw', None)
+    if raw is not None:
+        return len(raw)
+    size = 5
+    for k, v in doc.items():
+        size += len(k.encode('utf-8')) + 2
+        size += _getBSONValueSize(v)
+    return size
+
+
 ###############################################################################
 #
 # fake MongoDB
 #
 ###############################################################################
 
+class LazyBSONDocument(Mapping):
+    """Read only document which decodes the BSON data on first access"""
+
+    __slots__ = ('raw', '_doc')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._doc = None
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            self._doc = decodeBSON(self.raw)
+        return self._doc
+
+    def __getitem__(self, key):
+        return self.doc[key]
+
+    def __contains__(self, key):
+        return key in self.doc
+
+    def __iter__(self):
+        return iter(self.doc)
+
+    def __len__(self):
+        return len(self.doc)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.doc)
+
+
+def copyDocument(doc):
+    """Return a deep copy of a stored document"""
+    if isinstance(doc, LazyBSONDocument):
+        # decoding creates a new dict
+        return decodeBSON(doc.raw)
+    return copy.deepcopy(doc)
+
+
 class OrderedData(object):
     """Ordered data."""
 
@@ -169,9 +711,9 @@ class OrderedData(object):
         return self.data[key]
 
     def __setitem__(self, key, item):
-        if key not in self._order:
+        if key not in self.data:
             self._order.append(key)
-        self.data[key] = copy.deepcopy(item)
+        self.data[key] = copyDocument(item)
 
     def __delitem__(self, key):
         del self.data[key]
@@ -181,12 +723,21 @@ class OrderedData(object):
         """Get item by key"""
         return self.data.get(key, default)
 
+    def load(self, items):
+        """Store (key, doc) items without copying the documents"""
+        data = self.data
+        append = self._order.append
+        for key, doc in items:
+            if key not in data:
+                append(key)
+            data[key] = doc
+
     def keys(self):
         return self._order
 
     def values(self):
         for key in self._order:
-            return self.data[key]
+            yield self.data[key]
 
     def items(self):
         for key in self._order:
@@ -226,6 +777,10 @@ def cursor_comparator(keys):
 
 NOVALUEMARKER = object()
 
+# query operators using a geo index
+GEO_OPERATORS = frozenset(['$near', '$nearSphere', '$geoWithin', '$within',
+                           '$geoIntersects'])
+
 
 def getPart(doc, k):
     parts = k.split('.')
@@ -259,94 +814,664 @@ def getPart(doc, k):
     return d
 
 
+def getField(doc, name):
+    """Return the value of a (dotted) field or NOVALUEMARKER.
+
+    Diving into a list returns the list of values found in its documents.
+    """
+    value = doc
+    for part in name.split('.'):
+        if isinstance(value, Mapping):
+            value = value.get(part, NOVALUEMARKER)
+        elif isinstance(value, (list, tuple)):
+            if part.isdigit():
+                idx = int(part)
+                value = idx < len(value) and value[idx] or NOVALUEMARKER
+            else:
+                value = [v[part] for v in value
+                         if isinstance(v, Mapping) and part in v]
+        else:
+            return NOVALUEMARKER
+        if value is NOVALUEMARKER:
+            break
+    return value
+
+
+# supported update operators
+UPDATE_OPERATORS = frozenset(['$set', '$unset', '$inc', '$push',
+                              '$setOnInsert'])
+
+
+def _getItem(container, key):
+    # return the value of a document key or array index or MISSING
+    if isinstance(container, list):
+        if key < len(container):
+            return container[key]
+        return MISSING
+    return container.get(key, MISSING)
+
+
+def _setItem(container, key, value):
+    # set a document key or array index, arrays get padded with null
+    if isinstance(container, list):
+        container.extend([None] * (key + 1 - len(container)))
+    container[key] = value
+
+
+def _updateParent(doc, name, create=True):
+    """Return the copied parent document or array of a (dotted) field and
+    the key or index.
+
+    Returns (None, None) for a missing path if create is False. Raises
+    OperationFailure if the path traverses a value which isn't a document
+    or array.
+    """
+    parts = [toUnicode(part) for part in name.split('.')]
+    container = doc
+    for i, part in enumerate(parts):
+        if isinstance(container, list):
+            if not part.isdigit():
+                raise pymongo.errors.OperationFailure(
+                    "Cannot create field '%s' in element '%s' (an array)" % (
+                        part, '.'.join(parts[:i])), 2)
+            part = int(part)
+        if i == len(parts) - 1:
+            return container, part
+        child = _getItem(container, part)
+        if isinstance(child, Mapping):
+            child = dict(child)
+        elif isinstance(child, (list, tuple)):
+            child = list(child)
+        elif child is MISSING or child is None:
+            if not create:
+                return None, None
+            child = {}
+        else:
+            if not create:
+                return None, None
+            raise pymongo.errors.OperationFailure(
+                "Cannot create field '%s' in element '%s' (not a document "
+                "or array)" % (parts[i + 1], '.'.join(parts[:i + 1])), 2)
+        _setItem(container, part, child)
+        container = child
+
+
+def applyUpdate(doc, update, insert=False):
+    """Return a new document with the update operators applied.
+
+    The given document doesn't change, only the documents and arrays on the
+    path of an updated field get copied. Numeric path parts address array
+    elements. $setOnInsert only applies on insert.
+    """
+    doc = dict(doc)
+    for op, values in update.items():
+        if op not in UPDATE_OPERATORS:
+            raise pymongo.errors.OperationFailure(
+                "Unknown modifier: %s" % op, 9)
+        if op == '$setOnInsert' and not insert:
+            continue
+        for name, value in values.items():
+            parent, key = _updateParent(doc, name, op != '$unset')
+            if parent is None:
+                continue
+            current = _getItem(parent, key)
+            if op == '$unset':
+                if isinstance(parent, list):
+                    # like MongoDB, an unset array element becomes null
+                    if current is not MISSING:
+                        parent[key] = None
+                else:
+                    parent.pop(key, None)
+            elif op == '$inc':
+                if current is MISSING:
+                    current = 0
+                elif not isinstance(current, integer_types + (float,)) or \
+                        isinstance(current, bool):
+                    raise pymongo.errors.OperationFailure(
+                        "Cannot apply $inc to a value of non-numeric type "
+                        "in field '%s'" % name, 14)
+                _setItem(parent, key, current + value)
+            elif op == '$push':
+                if current is MISSING:
+                    current = []
+                elif not isinstance(current, (list, tuple)):
+                    raise pymongo.errors.OperationFailure(
+                        "The field '%s' must be an array" % name, 14)
+                _setItem(parent, key, list(current) + [value])
+            else:
+                _setItem(parent, key, value)
+    return doc
+
+
+RE_TYPE = type(re.compile(''))
+
+
+def sortKey(value, reverse=False):
+    """Return a sort key which orders values like MongoDB (BSON type order)
+
+    Arrays get compared by their smallest element or by their largest one if
+    sorting in reverse order.
+    """
+    if value is None or value is NOVALUEMARKER:
+        return (2,)
+    elif isinstance(value, bool):
+        return (9, value)
+    elif isinstance(value, integer_types + (float,)):
+        return (3, value)
+    elif isinstance(value, string_types):
+        return (4, toUnicode(value))
+    elif isinstance(value, Mapping):
+        return (5, tuple([(toUnicode(k), sortKey(v, reverse))
+                          for k, v in value.items()]))
+    elif isinstance(value, (list, tuple)):
+        if not value:
+            return (1,)
+        keys = [sortKey(v, reverse) for v in value]
+        return reverse and max(keys) or min(keys)
+    elif isinstance(value, uuid.UUID):
+        return (7, value.bytes)
+    elif isinstance(value, bytes):
+        return (7, value)
+    elif isinstance(value, bson.objectid.ObjectId):
+        return (8, value.binary)
+    elif isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(bson.tz_util.utc).replace(tzinfo=None)
+        return (10, value)
+    elif isinstance(value, bson.timestamp.Timestamp):
+        return (11, value.time, value.inc)
+    elif isinstance(value, RE_TYPE):
+        return (12, toUnicode(value.pattern))
+    elif isinstance(value, bson.min_key.MinKey):
+        return (0,)
+    elif isinstance(value, bson.max_key.MaxKey):
+        return (13,)
+    elif hasattr(value, 'to_decimal'):
+        # Decimal128
+        return (3, value.to_decimal())
+    return (14, repr(value))
+
+
+class WriteConflict(pymongo.errors.OperationFailure):
+    """Write conflict between concurrent transactions (code 112)"""
+
+    def __init__(self, error):
+        details = {'ok': 0.0, 'errmsg': error, 'code': 112,
+                   'codeName': 'WriteConflict',
+                   'errorLabels': ['TransientTransactionError']}
+        pymongo.errors.OperationFailure.__init__(self, error, 112, details)
+
+
+# marks a removed or not yet existing document version
+MISSING = object()
+
+
+class SnapshotView(object):
+    """Read only view of a collection at the snapshot of a transaction.
+
+    The view resolves the document versions visible at the snapshot
+    timestamp and overlays the uncommitted writes of the transaction.
+    """
+
+    def __init__(self, collection, session):
+        self.collection = collection
+        self.snapshot = session._snapshot
+        self.writes = session._writes.get(collection, {})
+
+    def get(self, key, default=None):
+        doc = self.writes.get(key)
+        if doc is None:
+            doc = self.collection._versionAt(key, self.snapshot)
+        if doc is MISSING:
+            return default
+        return doc
+
+    def __getitem__(self, key):
+        doc = self.get(key, MISSING)
+        if doc is MISSING:
+            raise KeyError(key)
+        return doc
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def keys(self):
+        collection = self.collection
+        keys = list(collection.docs.keys())
+        seen = set(keys)
+        # removed after our snapshot
+        for key in list(collection._history.keys()):
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        # inserted by our transaction
+        for key in self.writes:
+            if key not in seen:
+                keys.append(key)
+        return keys
+
+    def items(self):
+        for key in self.keys():
+            doc = self.get(key, MISSING)
+            if doc is not MISSING:
+                yield key, doc
+
+    def values(self):
+        for key, doc in self.items():
+            yield doc
+
+    def __iter__(self):
+        return self.values()
+
+    def __len__(self):
+        return len(list(self.items()))
+
+
+# documents in the first batch and in each getMore batch of a cursor
+FIRST_BATCH_SIZE = 101
+GET_MORE_BATCH_SIZE = 1000
+
+
+def project(doc, fields, score=None):
+    """Apply the projection, {'$meta': 'textScore'} adds the score"""
+    values = [(k, v) for k, v in fields.items() if not isinstance(v, dict)]
+    include = [k for k, v in values if v]
+    exclude = [k for k, v in values if not v]
+    res = {}
+    if include and not [k for k in exclude if k != '_id']:
+        if '_id' in doc and '_id' not in exclude:
+            res[u'_id'] = doc['_id']
+        for k in include:
+            _includeField(doc, res, k.split('.'))
+    else:
+        res.update(doc)
+        for k in exclude:
+            _excludeField(res, k.split('.'))
+    for k, v in fields.items():
+        if isinstance(v, dict) and v.get('$meta') == 'textScore':
+            res[toUnicode(k)] = score
+    return res
+
+
+def _produceDoc(fields, scores, item):
+    # return a copy of a found (key, doc) item for the client
+    key, doc = item
+    if fields:
+        return copy.deepcopy(project(doc, fields, scores.get(key)))
+    return copyDocument(doc)
+
+
 class FakeCursor(object):
-    """Fake mongoDB cursor."""
+    """Fake mongoDB cursor.
+
+    The query gets executed on first access. Like in MongoDB, the sort gets
+    applied before skip and limit. Only the first batch gets produced, the
+    remaining result stays in a server-side cursor of the client and each
+    further batch gets fetched with getMore.
+    """
 
     def __init__(self, collection, spec, fields, skip, limit, slave_okay,
                  timeout, tailable, snapshot=False, sort=None,
-                 _sock=None, _must_use_master=False):
-        # filter and setup docs based on given spec
+                 _sock=None, _must_use_master=False, session=None,
+                 read_preference=None, batch_size=0, no_cursor_timeout=False):
         self.collection = collection
+        self.session = session
+        self._read_preference = read_preference
+        self._spec = spec
+        self._fields = fields
+        self._sort = sort
         self._skip = skip
         self._limit = limit
-        self.docs = self._query(collection, spec, sort)
-        self.total = len(self.docs)
+        self._batchSize = batch_size
+        self._noTimeout = no_cursor_timeout or not timeout
+        self._docs = None
+        self._registry = None
+        self._id = 0
+        self._node = None
+        self.total = None
 
-    def _query(self, collection, spec, sort=None):
-        docs = []
-        append = docs.append
-        for key, doc in collection.docs.items():
-            for k, v in spec.items():
-                if k in doc and isinstance(v, dict):
-                    reject = False
-                    for op, value in v.items():
-                        if ((op == '$gt' and not doc[k] > value) or
-                            (op == '$lt' and not doc[k] < value) or
-                            (op == '$gte' and not doc[k] >= value) or
-                            (op == '$lte' and not doc[k] <= value) or
-                            (op == '$ne' and not doc[k] != value) or
-                            (op == '$in' and not doc[k] in value) or
-                            (op == '$exists' and not k in doc) or
-                            (op == '$all' and not all([vv in doc[k]
-                                                       for vv in value])) or
-                            (op == '$nin' and not doc[k] not in value)
-                            # TODO: $mod, $nor $or, $and, $size, $type, $regex
-                            ):
-                            reject = True
-                            break
-                    if reject:
-                        break
+    @property
+    def docs(self):
+        """The remaining documents, fetches all remaining batches"""
+        if self._docs is None:
+            self._execute()
+        if self._id:
+            self._getMore(sys.maxsize)
+        return self._docs
+
+    def _execute(self):
+        collection = self.collection._getReadCollection(
+            self._read_preference, self.session)
+        self._run('find', collection._client, self._executeQuery, collection)
+
+    def _run(self, name, client, func, *args):
+        """Run the query or getMore, count it and apply the performance
+        model"""
+        nested = getattr(_counting, 'active', False)
+        if not nested:
+            _counting.active = True
+            start = time.time()
+        try:
+            model = self.collection._client._model
+            if model is None:
+                return func(*args)
+            with model.operation(name, client):
+                return func(*args)
+        finally:
+            if not nested:
+                _counting.active = False
+                op, kind = OPERATION_TYPES[name]
+                self.collection._client._opStats.add(op, kind,
+                    time.time() - start)
+
+    def _executeQuery(self, collection):
+        items, produce = self._cachedQuery(collection, self._spec,
+            self._fields, self._sort, self._skip, self._limit)
+        self.total = len(items)
+        if self._skip:
+            items = items[self._skip:]
+        if self._limit:
+            # a negative limit means one batch of abs(limit) documents
+            items = items[:abs(self._limit)]
+        size = self._batchSize or FIRST_BATCH_SIZE
+        if self._limit < 0:
+            size = abs(self._limit)
+        batch, rest = items[:size], items[size:]
+        if produce is not None:
+            batch = [produce(item) for item in batch]
+        self._docs = batch
+        if rest:
+            # keep the remaining result in a server-side cursor
+            registry = collection._client.cursors
+            cursor = registry.open(collection.full_name, rest, produce,
+                self._noTimeout)
+            self._registry = registry
+            self._id = cursor.id
+            self._node = collection._client
+
+    def _getMore(self, size):
+        docs, exhausted = self._run('getMore', self._node,
+            self._registry.getMore, self._id, size)
+        if exhausted:
+            self._id = 0
+        self._docs.extend(docs)
+
+    def _checkOkay(self):
+        if self._docs is not None:
+            raise pymongo.errors.InvalidOperation(
+                "cannot set options after executing query")
+
+    def _cachedQuery(self, collection, spec, fields, sort, skip, limit):
+        """Return the query result from the collection cache if enabled.
+
+        Returns (items, produce), see _query. The cached documents are
+        already produced, produce is None for them.
+        """
+        # the number of documents needed, 0 for all
+        needed = limit and skip + abs(limit) or 0
+        cache = collection.cache
+        session = self.session
+        if cache is None or (session is not None and session.in_transaction):
+            return self._query(collection, spec, sort, fields, needed)
+        key = cache.getKey(spec, fields, sort, skip, limit)
+        if key is None:
+            return self._query(collection, spec, sort, fields, needed)
+        # get the version before querying, a concurrent write outdates
+        # the result
+        version = collection._version
+        docs = cache.get(key, version)
+        if docs is None:
+            items, produce = self._query(collection, spec, sort, fields,
+                needed)
+            docs = cache.set(key, version, [produce(item) for item in items])
+        return list(docs), None
+
+    def _plan(self, collection, spec, docs):
+        """Return the candidate (key, doc) items and the remaining spec.
+
+        Uses the text and geo indexes. Returns (items, spec, scores, ordered)
+        where ordered marks items ordered by $near distance.
+        """
+        if '$text' in spec:
+            # get the candidates from the text index
+            spec = dict(spec)
+            scores = dict(collection._textSearch(spec.pop('$text'), docs,
+                self.session))
+            items = [(key, docs.get(key)) for key in scores]
+            return items, spec, scores, False
+        for k, v in spec.items():
+            if not isinstance(v, dict) or not GEO_OPERATORS.intersection(v):
+                continue
+            index = collection._getGeoIndex(k, docs, self.session)
+            if '$near' in v or '$nearSphere' in v:
+                if index is None:
+                    raise pymongo.errors.OperationFailure(
+                        "error processing query: planner returned error: "
+                        "unable to find index for $geoNear query", 291)
+                spec = dict(spec)
+                query = spec.pop(k)
+                items = ((key, docs.get(key)) for key, d in index.near(query))
+                return items, spec, {}, True
+            elif index is not None:
+                spec = dict(spec)
+                query = spec.pop(k)
+                if '$geoIntersects' in query:
+                    keys = index.intersects(query['$geoIntersects'])
                 else:
-                    if '.' in k:
-                        # support diving into attributes/documents
-                        docVal = getPart(doc, k)
-                    else:
-                        # Mongo always ignores documents where a key of the
-                        # spec is missing.
-                        if k not in doc:
-                            break
-                        docVal = doc.get(k, NOVALUEMARKER)
-                    # XXX: This is not generic and will not handle operator
-                    # based specs.
-                    if docVal != NOVALUEMARKER and v != docVal:
-                        break
-            else:
-                append(copy.deepcopy(doc))
+                    keys = index.within(query.get('$geoWithin',
+                        query.get('$within')))
+                return [(key, docs.get(key)) for key in keys], spec, {}, False
+        _id = spec.get('_id')
+        if _id is not None and not isinstance(_id, (dict, list)):
+            # look up a plain _id directly
+            key = toUnicode(_id)
+            return [(key, docs.get(key))], spec, {}, False
+        return docs.items(), spec, {}, False
+
+    def _query(self, collection, spec, sort=None, fields=None, needed=0):
+        """Return the matching (key, doc) items in sort order and the
+        produce function returning the projected document copy of an item.
+
+        Stops after the needed number of documents if the candidates are
+        ordered by $near distance and no sort is given. Queries on a sharded
+        collection not using a text or geo index get routed to the shards.
+        """
+        docs = collection._getDocs(self.session)
+        if self._routed(docs, spec):
+            found = docs.scatterGather(self, spec, sort)
+            scores = {}
+        else:
+            items, spec, scores, ordered = self._plan(collection, spec, docs)
+            found = self._find(items, spec, sort, scores,
+                ordered and not sort and needed)
+        # the partial doesn't reference the cursor, server-side cursors
+        # don't keep it alive
+        return found, functools.partial(_produceDoc, fields, scores)
+
+    def _routed(self, docs, spec):
+        """Return True if the query gets routed to the shards"""
+        return getattr(docs, 'sharded', False) and '$text' not in spec and \
+            not [v for v in spec.values()
+                 if isinstance(v, dict) and GEO_OPERATORS.intersection(v)]
+
+    def _matching(self, collection, spec=None):
+        """Return the matching (key, doc) items, unsorted and not copied"""
+        if spec is None:
+            spec = self._spec
+        docs = collection._getDocs(self.session)
+        if self._routed(docs, spec):
+            return docs.scatterGather(self, spec)
+        items, spec, scores, ordered = self._plan(collection, spec, docs)
+        return self._find(items, spec)
+
+    def _count(self, collection, spec):
+        """Return the number of matching documents without copying them"""
+        if not spec:
+            return len(collection._getDocs(self.session))
+        index = collection._getFieldIndex(spec, session=self.session)
+        if index is not None:
+            with collection._client._lock:
+                return index.count(spec)
+        return len(self._matching(collection, spec))
+
+    def _find(self, items, spec, sort=None, scores=None, stop=0):
+        """Return the matching (key, doc) items ordered by sort.
+
+        Stops after stop matching items if given.
+        """
+        match = self._match
+        model = self.collection._client._model
+        if model is not None:
+            items = model.examine(items)
+        found = []
+        append = found.append
+        for key, doc in items:
+            if doc is not None and match(doc, spec):
+                append((key, doc))
+                if stop and len(found) >= stop:
+                    break
 
         if sort:
-            docs = sorted(docs, cmp=cursor_comparator(sort))
+            # stable sort, starting with the last sort key
+            for name, direction in reversed(sort):
+                if isinstance(direction, dict):
+                    # {'$meta': 'textScore'}, highest score first
+                    found.sort(key=lambda item: scores.get(item[0], 0),
+                        reverse=True)
+                else:
+                    reverse = direction < 0
+                    found.sort(key=lambda item: sortKey(
+                        getField(item[1], name), reverse), reverse=reverse)
+        return found
+
+    def _match(self, doc, spec):
+        """Return True if the document matches the spec"""
+        for k, v in spec.items():
+            if isinstance(v, dict) and GEO_OPERATORS.intersection(v):
+                from m01.mongofake import geo
+                value = getField(doc, k)
+                for op, query in v.items():
+                    if op in GEO_OPERATORS and not geo.match(op, value, query):
+                        return False
+            elif k in doc and isinstance(v, dict):
+                for op, value in v.items():
+                    if ((op == '$gt' and not doc[k] > value) or
+                        (op == '$lt' and not doc[k] < value) or
+                        (op == '$gte' and not doc[k] >= value) or
+                        (op == '$lte' and not doc[k] <= value) or
+                        (op == '$ne' and not doc[k] != value) or
+                        (op == '$in' and not doc[k] in value) or
+                        (op == '$exists' and not k in doc) or
+                        (op == '$all' and not all([vv in doc[k]
+                                                   for vv in value])) or
+                        (op == '$nin' and not doc[k] not in value)
+                        # TODO: $mod, $nor $or, $and, $size, $type, $regex
+                        ):
+                        return False
+            else:
+                if '.' in k:
+                    # support diving into attributes/documents
+                    docVal = getPart(doc, k)
+                else:
+                    # Mongo always ignores documents where a key of the
+                    # spec is missing.
+                    if k not in doc:
+                        return False
+                    docVal = doc.get(k, NOVALUEMARKER)
+                # XXX: This is not generic and will not handle operator
+                # based specs.
+                if docVal != NOVALUEMARKER and v != docVal:
+                    return False
+        return True
 
-        return docs
+    def _project(self, doc, fields, score=None):
+        return project(doc, fields, score)
 
     def count(self, with_limit_and_skip=False):
+        if self._docs is None and self.total is None:
+            # count without executing the query
+            collection = self.collection._getReadCollection(
+                self._read_preference, self.session)
+            self.total = self._count(collection, self._spec)
         if with_limit_and_skip:
-            return len(self.docs)
+            count = max(self.total - self._skip, 0)
+            if self._limit:
+                count = min(count, abs(self._limit))
+            return count
         else:
             return self.total
 
+    def distinct(self, key):
+        return self.collection.distinct(key, self._spec, self.session)
+
     def skip(self, skip):
+        self._checkOkay()
         self._skip = skip
-        self.docs = self.docs[skip:]
         return self
 
     def limit(self, limit):
+        self._checkOkay()
         self._limit = limit
-        self.docs = self.docs[:limit]
         return self
 
-    def sort(self, name, order):
-        sorter = sortByAttribute(name, order)
-        docs = list(self.docs)
-        docs.sort(sorter)
-        self.docs = docs
+    def sort(self, key_or_list, direction=None):
+        self._checkOkay()
+        if isinstance(key_or_list, string_types):
+            if direction is None:
+                direction = pymongo.ASCENDING
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def batch_size(self, batch_size):
+        """Set the number of documents per batch, 0 for the default"""
+        if not isinstance(batch_size, int):
+            raise TypeError("batch_size must be an integer")
+        if batch_size < 0:
+            raise ValueError("batch_size must be >= 0")
+        self._checkOkay()
+        self._batchSize = batch_size
+        return self
+
+    @property
+    def cursor_id(self):
+        """The id of the server-side cursor, 0 if exhausted or closed"""
+        return self._id
+
+    @property
+    def alive(self):
+        """False if no more documents are available"""
+        return self._docs is None or bool(self._docs) or bool(self._id)
+
+    def close(self):
+        """Free the server-side cursor, the current batch stays available"""
+        if self._id:
+            self._registry.close(self._id)
+            self._id = 0
+
+    def __enter__(self):
         return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
     def __iter__(self):
         return self
 
     def next(self):
-        if len(self.docs):
-            next = self.docs.pop(0)
+        if self._docs is None:
+            self._execute()
+        if not self._docs and self._id:
+            self._getMore(self._batchSize or GET_MORE_BATCH_SIZE)
+        if self._docs:
+            next = self._docs.pop(0)
         else:
             raise StopIteration
         return next
@@ -354,6 +1479,86 @@ class FakeCursor(object):
     __next__ = next
 
 
+def _includeField(src, dst, parts):
+    # copy a (dotted) field from src to dst
+    key = parts[0]
+    if not isinstance(src, Mapping) or key not in src:
+        return
+    value = src[key]
+    if len(parts) == 1:
+        dst[key] = value
+    elif isinstance(value, Mapping):
+        _includeField(value, dst.setdefault(key, {}), parts[1:])
+    elif isinstance(value, list):
+        items = dst.setdefault(key, [{} for v in value])
+        for v, item in zip(value, items):
+            _includeField(v, item, parts[1:])
+
+
+def _excludeField(doc, parts):
+    # remove a (dotted) field from a projected document, copy on write
+    key = parts[0]
+    if key not in doc:
+        return
+    if len(parts) == 1:
+        del doc[key]
+        return
+    value = doc[key]
+    if isinstance(value, Mapping):
+        value = dict(value)
+        _excludeField(value, parts[1:])
+        doc[key] = value
+    elif isinstance(value, list):
+        items = []
+        for v in value:
+            if isinstance(v, Mapping):
+                v = dict(v)
+                _excludeField(v, parts[1:])
+            items.append(v)
+        doc[key] = items
+
+
+def recorded(func):
+    """Record the calls of a collection method while the client records,
+    apply the performance model of the client and count the operation"""
+    name = func.__name__
+    # find gets counted when the cursor runs the query
+    optype = name != 'find' and OPERATION_TYPES.get(name) or None
+
+    def record(self, *args, **kwargs):
+        recorder = self._client._recorder
+        if recorder is None:
+            return func(self, *args, **kwargs)
+        return recorder.call(self, name, func, args, kwargs)
+
+    def run(self, *args, **kwargs):
+        model = self._client._model
+        if model is None or name == 'find':
+            # the cursor applies the model when the query runs
+            return record(self, *args, **kwargs)
+        return model.call(self, name, record, args, kwargs)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if optype is None or getattr(_counting, 'active', False):
+            return run(self, *args, **kwargs)
+        _counting.active = True
+        start = time.time()
+        try:
+            return run(self, *args, **kwargs)
+        finally:
+            _counting.active = False
+            count = 1
+            if name == 'insert':
+                # like MongoDB count the inserted documents
+                docs = args and args[0] or kwargs.get('doc_or_docs')
+                if isinstance(docs, list):
+                    count = len(docs)
+            self._client._opStats.add(optype[0], optype[1],
+                time.time() - start, count)
+    return wrapper
+
+
 class FakeCollection(object):
     """Fake mongoDB collection"""
 
@@ -361,21 +1566,350 @@ class FakeCollection(object):
         self.database = database
         self.name = toUnicode(name)
         self.full_name = '%s.%s' % (database, name)
-        self.docs = OrderedData()
+        self._client = database.connection
+        if self._client._quota is not None:
+            from m01.mongofake.spill import SpillData
+            self.docs = SpillData(quota=self._client._quota)
+        else:
+            self.docs = OrderedData()
+        # multi version concurrency control, only used during transactions
+        self._writeTs = {}
+        self._history = {}
+        self._pending = {}
+        # write version and optional result cache
+        self._version = 0
+        self.cache = None
+        # index name: index, maintained by the write funnel
+        self._indexes = {}
+        self._read_preference = None
+        # statistics, the sizes get maintained by the write funnel
+        self._dataSize = 0
+        self._idIndexSize = 0
+        # materialized views of this collection and the view of a view
+        # collection, see views.py
+        self._views = []
+        self._view = None
 
     def __getattr__(self, name):
-        """Get a sub-collection of this collection by name (e.g. gridfs)"""
-        return FakeCollection(self.database, u"%s.%s" % (self.name, name))
+        """Get a sub-collection of this collection by name (e.g. gridfs)
+
+        The sub-collection gets stored in the database like any other
+        collection and the same instance gets returned on each access.
+        """
+        if name.startswith('_'):
+            raise AttributeError("%s has no attribute %r. To access the %s.%s "
+                "collection, use %s[%r]." % (self.__class__.__name__, name,
+                    self.name, name, self.__class__.__name__, name))
+        return self[name]
+
+    def __getitem__(self, name):
+        return self.database[u"%s.%s" % (self.name, name)]
 
     def clear(self):
-        for k in self.docs.keys():
+        for k in list(self.docs.keys()):
             del self.docs[k]
+        self._closeStorage(self.docs)
+        for index in self._indexes.values():
+            index.clear()
+        self._dataSize = self._idIndexSize = 0
+        self._version += 1
+        self._replicate('clear')
+        for view in self._views:
+            # clear doesn't use the write funnel
+            view.rebuild()
+
+    @property
+    def read_preference(self):
+        if self._read_preference is None:
+            return self.database.read_preference
+        return self._read_preference
+
+    @read_preference.setter
+    def read_preference(self, read_preference):
+        self._read_preference = read_preference
+
+    def _getReadCollection(self, read_preference=None, session=None):
+        """Return the collection of the replica set member serving a read"""
+        rs = self._client._replicaSet
+        if rs is None or (session is not None and session.in_transaction):
+            return self
+        if read_preference is None:
+            read_preference = self.read_preference
+        client = rs.select(read_preference)
+        if client is self._client:
+            return self
+        return client[self.database.name][self.name]
+
+    def _replicate(self, command, *args, **kwargs):
+        # replay a method call on the replica set secondaries and log it
+        # to the write-ahead log
+        self._client._logCommand(self.database.name, self.name, command,
+            *args, **kwargs)
+
+    def _acknowledge(self, kwargs, session=None):
+        """Wait for the write concern of a write.
+
+        j (or fsync) waits for the write-ahead log, w > 1 or 'majority'
+        waits for the replica set secondaries, w=0 doesn't wait.
+        """
+        w = kwargs.get('w', 1)
+        if w == 0 or (session is not None and session.in_transaction):
+            return
+        client = self._client
+        wal = client._wal
+        if wal is not None and kwargs.get('j', kwargs.get('fsync',
+                                                           wal.journal)):
+            wal.sync()
+        if client._replicaSet is not None and w != 1:
+            client._replicaSet.waitForWrite(w, kwargs.get('wtimeout'))
+
+    def enableCache(self, maxSize=32 * 1024 * 1024):
+        """Cache query results up to maxSize bytes (BSON size).
+
+        Cached results are read only FrozenDocument instances. Returns the
+        ResultCache which provides the hit/miss/eviction stats.
+        """
+        from m01.mongofake.cache import ResultCache
+        self.cache = ResultCache(maxSize)
+        return self.cache
+
+    def disableCache(self):
+        self.cache = None
+
+    def setStorage(self, storage):
+        """Replace the document storage and move the existing documents.
+
+        The storage can be 'dict' (OrderedData), 'raw' (RawBSONData using the
+        client max_bson_size) or a storage instance. The replaced storage
+        gets closed.
+        """
+        if storage == 'dict':
+            storage = OrderedData()
+        elif storage == 'raw':
+            from m01.mongofake.raw import RawBSONData
+            storage = RawBSONData(self._client.max_bson_size)
+        old = self.docs
+        for key, doc in old.items():
+            storage[key] = doc
+        self.docs = storage
+        self._version += 1
+        self._closeStorage(old)
+
+    def _closeStorage(self, storage):
+        # release the resources of a storage, e.g. the spill file or the
+        # thread pool of a sharded storage, which get recreated on use
+        close = getattr(storage, 'close', None)
+        if close is not None:
+            close()
+
+    def enableMemoryQuota(self, maxSize=None, path=None):
+        """Keep at most maxSize bytes (BSON size) of documents in memory.
+
+        The least recently used documents get spilled to a segment file in
+        path (default the temp directory) and get paged in on access. The
+        client memory quota applies too if enabled. Returns the SpillData
+        storage which provides the resident and spilled stats.
+        """
+        from m01.mongofake.spill import SpillData
+        self.setStorage(SpillData(maxSize, self._client._quota, path))
+        return self.docs
+
+    def disableMemoryQuota(self):
+        """Move all documents back into memory"""
+        if hasattr(self.docs, 'quota'):
+            self.setStorage('dict')
+
+    @property
+    def materializedView(self):
+        """The MaterializedView of a view collection or None"""
+        return self._view
+
+    def shardCollection(self, key, shards=2, chunkSize=1000, parallel=True):
+        """Split the collection into chunks on the given number of shards.
 
-    def count(self):
+        The key is a shard key like {'region': 1} or {'userId': 'hashed'}.
+        Returns the ShardedData storage which provides the shard stats.
+        """
+        from m01.mongofake.sharding import ShardedData
+        storage = ShardedData(key, shards, chunkSize, parallel)
+        self.setStorage(storage)
+        return storage
+
+    @recorded
+    def count(self, filter=None, session=None, **kwargs):
+        if filter:
+            return self.count_documents(filter, session=session, **kwargs)
+        return len(self._getDocs(session))
+
+    @recorded
+    def estimated_document_count(self, **kwargs):
+        """Return the number of documents from the storage size, O(1)"""
         return len(self.docs)
 
+    @recorded
+    def count_documents(self, filter, session=None, skip=0, limit=0,
+        **kwargs):
+        """Count the matching documents without copying them.
+
+        A query covered by a field index gets counted from the index
+        entries.
+        """
+        cursor = FakeCursor(self, filter, None, skip, limit, True, True,
+            False, session=session)
+        return cursor.count(with_limit_and_skip=True)
+
+    @recorded
+    def distinct(self, key, filter=None, session=None, **kwargs):
+        """Return the distinct values of a (dotted) field.
+
+        Array values get unwound. A field index covering the key and the
+        filter returns the values from the index entries.
+        """
+        from m01.mongofake.index import hashable
+        if filter is None:
+            filter = {}
+        index = self._getFieldIndex(filter, key, session)
+        if index is not None:
+            with self._client._lock:
+                return index.distinct(key, filter)
+        cursor = FakeCursor(self, filter, None, 0, 0, True, True, False,
+            session=session)
+        values = {}
+        for k, doc in cursor._matching(self):
+            value = getField(doc, key)
+            if value is NOVALUEMARKER:
+                continue
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for v in value:
+                values.setdefault(hashable(v), v)
+        return sorted(values.values(), key=sortKey)
+
+    # storage access
+    def _getDocs(self, session=None):
+        """Return the storage or the snapshot view of a transaction"""
+        if session is not None and session.in_transaction:
+            return SnapshotView(self, session)
+        if self._view is not None and self._view._pending:
+            # apply the deltas of a deferred view
+            self._view.refresh()
+        return self.docs
+
+    def _checkWritable(self):
+        if self._view is not None:
+            raise pymongo.errors.OperationFailure(
+                "Namespace %s.%s is a view, not a collection" % (
+                    self.database.name, self.name), 166)
+
+    def _setDoc(self, key, doc, session=None):
+        """Insert or replace a document (write funnel)"""
+        self._checkWritable()
+        if session is not None and session.in_transaction:
+            session._write(self, key, copy.deepcopy(doc))
+        else:
+            client = self._client
+            with client._lock:
+                self._commit(key, doc, client._tick())
+
+    def _delDoc(self, key, session=None):
+        """Remove a document (write funnel)"""
+        self._checkWritable()
+        if session is not None and session.in_transaction:
+            session._write(self, key, MISSING)
+        else:
+            client = self._client
+            with client._lock:
+                self._commit(key, MISSING, client._tick())
+
+    def _commit(self, key, doc, ts):
+        """Apply a committed write, the client lock must be acquired"""
+        old = self.docs.get(key, MISSING)
+        # the storage and the indexes can reject the document
+        try:
+            self._apply(key, doc)
+        except Exception:
+            self._apply(key, old)
+            raise
+        self._version += 1
+        self._countData(old, -1)
+        self._countData(doc, 1)
+        if self._client._snapshots:
+            # keep the replaced version for active snapshots
+            self._client._versioned.add(self)
+            self._history.setdefault(key, []).append(
+                (self._writeTs.get(key, 0), old))
+            self._writeTs[key] = ts
+        if self._client._replicaSet is not None:
+            self._client._replicaSet.logWrite(self, key, doc, ts)
+        if self._client._wal is not None:
+            self._client._wal.logWrite(self, key, doc, ts)
+        for view in self._views:
+            view.delta(key, old, doc)
+
+    def _apply(self, key, doc):
+        # write the document to the storage and the indexes
+        if doc is MISSING:
+            if key in self.docs:
+                del self.docs[key]
+        else:
+            self.docs[key] = doc
+        for index in self._indexes.values():
+            index.remove(key)
+            if doc is not MISSING:
+                index.add(key, doc)
+
+    def _countData(self, doc, sign):
+        # add or subtract the data size and the _id index size of a document
+        if doc is not MISSING and self._dataSize is not None:
+            self._dataSize += sign * getBSONSize(doc)
+            self._idIndexSize += sign * (getKeySize(doc.get('_id')) +
+                                         INDEX_ENTRY_SIZE)
+
+    def _getSizes(self):
+        """Return the data size and the _id index size.
+
+        The sizes are unknown (None) after the storage got replaced without
+        the write funnel, e.g. with shared fixtures. They get counted once
+        and get maintained by the write funnel again.
+        """
+        with self._client._lock:
+            if self._dataSize is None:
+                self._dataSize = self._idIndexSize = 0
+                for doc in self.docs.values():
+                    self._countData(doc, 1)
+            return self._dataSize, self._idIndexSize
+
+    def _versionAt(self, key, snapshot):
+        """Return the document version visible at the given snapshot"""
+        # read the document before the timestamp, see _commit
+        doc = self.docs.get(key, MISSING)
+        if self._writeTs.get(key, 0) <= snapshot:
+            return doc
+        for ts, doc in reversed(self._history.get(key, ())):
+            if ts <= snapshot:
+                return doc
+        return MISSING
+
+    def _pruneHistory(self, oldest=None):
+        """Remove versions which are not visible to any snapshot"""
+        if oldest is None:
+            self._history = {}
+            self._writeTs = {}
+            return
+        for key, versions in list(self._history.items()):
+            if self._writeTs.get(key, 0) <= oldest:
+                del self._history[key]
+                continue
+            idx = 0
+            for i, (ts, doc) in enumerate(versions):
+                if ts <= oldest:
+                    idx = i
+            if idx:
+                del versions[:idx]
+
+    @recorded
     def update(self, spec, document, upsert=False, manipulate=False, safe=None,
-        multi=False, check_keys=True, **kwargs):
+        multi=False, check_keys=True, session=None, **kwargs):
         if not isinstance(spec, dict):
             raise TypeError("spec must be an instance of dict")
         if not isinstance(document, dict):
@@ -385,16 +1919,22 @@ class FakeCollection(object):
 
         existing = False
         counter = 0
-        for key, doc in list(self.docs.items()):
+        items = list(self._getDocs(session).items())
+        if self._client._model is not None:
+            items = self._client._model.examine(items)
+        for key, doc in items:
             if (counter > 0 and not multi):
                 break
             for k, v in spec.items():
                 if k in doc and v == doc[k]:
                     setData = document.get('$set')
                     if setData is not None:
-                        # do a partial update based on $set data
+                        # do a partial update based on $set data, never
+                        # change the stored version in place
+                        doc = dict(doc)
                         for pk, pv in setData.items():
                             doc[toUnicode(pk)] = pv
+                        self._setDoc(key, doc, session)
                         counter += 1
                         existing = True
                     else:
@@ -402,32 +1942,36 @@ class FakeCollection(object):
                         for k, v in list(document.items()):
                             # use unicode keys as mongodb does
                             d[toUnicode(k)] = v
-                        self.docs[toUnicode(key)] = d
+                        self._setDoc(toUnicode(key), d, session)
                         existing = True
                         counter += 1
                     break
 
+        self._acknowledge(kwargs, session)
         cid = 42
         ok = 1.0
         err = None
         return {u'updatedExisting': existing, u'connectionId': cid, u'ok': ok,
                 u'err': err, u'n': counter}
 
+    @recorded
     def save(self, to_save, manipulate=True, safe=None, check_keys=True,
-        **kwargs):
+        session=None, **kwargs):
         if not isinstance(to_save, dict):
             raise TypeError("cannot save object of type %s" % type(to_save))
 
         if "_id" not in to_save:
-            return self.insert(to_save, manipulate, safe)
+            return self.insert(to_save, manipulate, safe, session=session,
+                **kwargs)
         else:
             self.update({"_id": to_save["_id"]}, to_save, upsert=True,
                 manipulate=manipulate, safe=safe,
-                check_keys=check_keys, **kwargs)
+                check_keys=check_keys, session=session, **kwargs)
             return to_save.get("_id", None)
 
+    @recorded
     def insert(self, doc_or_docs, manipulate=True, safe=None, check_keys=True,
-        continue_on_error=False, **kwargs):
+        continue_on_error=False, session=None, **kwargs):
         docs = doc_or_docs
         if isinstance(docs, dict):
             docs = [docs]
@@ -440,17 +1984,204 @@ class FakeCollection(object):
             for k, v in list(doc.items()):
                 # use unicode keys as mongodb does
                 d[toUnicode(k)] = v
-            self.docs[toUnicode(oid)] = d
+            self._setDoc(toUnicode(oid), d, session)
+        self._acknowledge(kwargs, session)
 
         ids = [doc.get("_id", None) for doc in docs]
         return len(ids) == 1 and ids[0] or ids
 
-    def ensure_index(self, key_or_list, direction=None, unique=False, ttl=300):
-        # we do not need indexes
-        pass
+    def bulkLoad(self, docs):
+        """Store new documents as one batch, e.g. generated fixtures.
+
+        Skips the per document insert overhead. The documents must contain
+        an _id and unicode keys. They get stored without a copy if the
+        storage supports it, don't change them afterwards. Returns the
+        number of loaded documents.
+        """
+        self._checkWritable()
+        client = self._client
+        load = getattr(self.docs, 'load', None)
+        with client._lock:
+            if load is None or self._indexes or client._snapshots or \
+                    client._replicaSet is not None or \
+                    client._wal is not None or self._views:
+                # indexes, snapshots, logs and views need the write funnel
+                for doc in docs:
+                    self._commit(toUnicode(doc['_id']), doc, client._tick())
+            else:
+                load([(toUnicode(doc['_id']), doc) for doc in docs])
+                for doc in docs:
+                    self._countData(doc, 1)
+                self._version += 1
+        return len(docs)
+
+    # map reduce
+    def map_reduce(self, map, reduce, out, full_response=False, session=None,
+        processes=1, **kwargs):
+        """Run map_reduce with Python callables.
+
+        Supports the query, sort, limit and finalize options. out is a
+        collection name or a dict with replace, merge or reduce (and db) or
+        inline. The map and combine phases run in processes worker processes
+        (see mapreduce.py).
+        """
+        from m01.mongofake.mapreduce import runMapReduce
+        response, target = runMapReduce(self, map, reduce, out,
+            kwargs.get('query'), kwargs.get('sort'), kwargs.get('limit', 0),
+            kwargs.get('finalize'), processes, session)
+        if full_response or target is None:
+            return response
+        return target
+
+    def inline_map_reduce(self, map, reduce, full_response=False,
+        session=None, processes=1, **kwargs):
+        """Run map_reduce and return the results"""
+        response = self.map_reduce(map, reduce, {'inline': 1},
+            session=session, processes=processes, **kwargs)
+        if full_response:
+            return response
+        return response['results']
+
+    def group(self, key, condition, initial, reduce, finalize=None,
+        session=None, **kwargs):
+        """Group the documents with a Python reduce(doc, aggregate)"""
+        from m01.mongofake.mapreduce import group
+        return group(self, key, condition, initial, reduce, finalize,
+            session)
+
+    # indexes
+    @recorded
+    def create_index(self, keys, **kwargs):
+        """Create an index and return its name.
+
+        Ascending and descending keys create a field index used for
+        counting and distinct values, text and geo keys create a text or
+        geo index.
+        """
+        if isinstance(keys, string_types):
+            keys = [(keys, pymongo.ASCENDING)]
+        keys = list(keys)
+        name = kwargs.pop('name', None)
+        if name is None:
+            name = u'_'.join([u'%s_%s' % (k, d) for k, d in keys])
+        directions = [d for k, d in keys]
+        if 'text' in directions:
+            self._createTextIndex(name, keys, **kwargs)
+        elif '2dsphere' in directions or '2d' in directions:
+            self._createGeoIndex(name, keys, **kwargs)
+        elif not [d for d in directions if d not in (1, -1)]:
+            self._createFieldIndex(name, keys, **kwargs)
+        else:
+            return name
+        self._replicate('create_index', keys, name=name, **kwargs)
+        return name
 
+    @recorded
+    def ensure_index(self, key_or_list, direction=None, unique=False, ttl=300,
+        **kwargs):
+        if isinstance(key_or_list, string_types):
+            key_or_list = [(key_or_list, direction or pymongo.ASCENDING)]
+        return self.create_index(key_or_list, unique=unique, **kwargs)
+
+    def _createTextIndex(self, name, keys, weights=None,
+        default_language='english', language_override='language',
+        stopWords=None, stemmer=None, **kwargs):
+        from m01.mongofake.text import TextIndex
+        existing = self._getTextIndex()
+        if existing is not None:
+            if existing.name == name:
+                return
+            raise pymongo.errors.OperationFailure(
+                "only one text index per collection allowed, found existing "
+                "text index \"%s\"" % existing.name, 85)
+        index = TextIndex(name, [k for k, d in keys if d == 'text'], weights,
+            default_language, language_override, stopWords, stemmer)
+        self._buildIndex(index)
+
+    def _createFieldIndex(self, name, keys, unique=False, **kwargs):
+        from m01.mongofake.index import FieldIndex
+        if name in self._indexes:
+            return
+        self._buildIndex(FieldIndex(name, keys, unique))
+
+    def _createGeoIndex(self, name, keys, cellSize=None, min=-180.0,
+        max=180.0, **kwargs):
+        from m01.mongofake.geo import GeoIndex
+        if name in self._indexes:
+            return
+        field, kind = [(k, d) for k, d in keys if d in ('2d', '2dsphere')][0]
+        self._buildIndex(GeoIndex(name, field, kind, cellSize, min, max))
+
+    def _buildIndex(self, index):
+        with self._client._lock:
+            for key, doc in self.docs.items():
+                index.add(key, doc)
+            self._indexes[index.name] = index
+
+    def _snapshotIndex(self, index, docs, session):
+        """Return the index or an index of the transaction snapshot"""
+        if session is not None and session.in_transaction:
+            # the index contains the latest versions, index the snapshot
+            index = index.copy()
+            for key, doc in docs.items():
+                index.add(key, doc)
+        return index
+
+    def _getTextIndex(self):
+        for index in self._indexes.values():
+            if index.kind == 'text':
+                return index
+
+    def _getFieldIndex(self, spec, field=None, session=None):
+        """Return a field index covering the spec (and field) or None"""
+        if session is not None and session.in_transaction:
+            # the index contains the latest versions
+            return None
+        for index in self._indexes.values():
+            if index.kind == 'field' and index.covers(spec, field):
+                return index
+
+    def _getGeoIndex(self, field, docs=None, session=None):
+        for index in self._indexes.values():
+            if index.kind in ('2d', '2dsphere') and index.field == field:
+                return self._snapshotIndex(index, docs, session)
+
+    def _textSearch(self, query, docs, session=None):
+        """Return (key, score) for the documents matching a $text query"""
+        index = self._getTextIndex()
+        if index is None:
+            raise pymongo.errors.OperationFailure(
+                "text index required for $text query", 27)
+        index = self._snapshotIndex(index, docs, session)
+        return index.search(query, docs)
+
+    @recorded
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, string_types):
+            name = u'_'.join([u'%s_%s' % (k, d) for k, d in name])
+        with self._client._lock:
+            if self._indexes.pop(name, None) is None:
+                raise pymongo.errors.OperationFailure(
+                    "index not found with name [%s]" % name, 27)
+        self._replicate('drop_index', name)
+
+    @recorded
+    def drop_indexes(self):
+        with self._client._lock:
+            self._indexes = {}
+        self._replicate('drop_indexes')
+
+    def index_information(self):
+        info = {u'_id_': {'key': [(u'_id', 1)]}}
+        for name, index in self._indexes.items():
+            info[name] = index.info()
+        return info
+
+    @recorded
     def find_one(self, spec_or_object_id=None, fields=None, slave_okay=True,
-        _sock=None, _must_use_master=False):
+        _sock=None, _must_use_master=False, session=None,
+        read_preference=None):
         spec = spec_or_object_id
         if spec is None:
             spec = bson.son.SON()
@@ -459,20 +2190,24 @@ class FakeCollection(object):
 
         for result in self.find(spec, limit=-1, fields=fields,
             slave_okay=slave_okay, _sock=_sock,
-            _must_use_master=_must_use_master):
+            _must_use_master=_must_use_master, session=session,
+            read_preference=read_preference):
             return result
         return None
 
+    @recorded
     def find(self, spec=None, fields=None, skip=0, limit=0, slave_okay=True,
         timeout=True, snapshot=False, tailable=False, sort=None, _sock=None,
-        _must_use_master=False):
+        _must_use_master=False, session=None, read_preference=None,
+        batch_size=0, no_cursor_timeout=False):
         if spec is None:
             spec = bson.son.SON()
 
         if not isinstance(spec, dict):
             raise TypeError("spec must be an instance of dict")
-        if not isinstance(fields, (list, tuple, type(None))):
-            raise TypeError("fields must be an instance of list, tuple or None")
+        if not isinstance(fields, (list, tuple, dict, type(None))):
+            raise TypeError("fields must be an instance of list, tuple, dict "
+                            "or None")
         if not isinstance(skip, int):
             raise TypeError("skip must be an instance of int")
         if not isinstance(limit, int):
@@ -486,21 +2221,24 @@ class FakeCollection(object):
         if not isinstance(tailable, bool):
             raise TypeError("tailable must be an instance of bool")
 
-        if fields is not None:
+        if fields is not None and not isinstance(fields, dict):
             if not fields:
                 fields = ["_id"]
             fields = self._fields_list_to_dict(fields)
 
         return FakeCursor(self, spec, fields, skip, limit, slave_okay, timeout,
                       tailable, snapshot, sort=sort, _sock=_sock,
-                      _must_use_master=_must_use_master)
+                      _must_use_master=_must_use_master, session=session,
+                      read_preference=read_preference, batch_size=batch_size,
+                      no_cursor_timeout=no_cursor_timeout)
 
-    def remove(self, spec_or_id=None, safe=False, **kwargs):
+    @recorded
+    def remove(self, spec_or_id=None, safe=False, session=None, **kwargs):
         spec = spec_or_id
         if isinstance(spec, bson.objectid.ObjectId):
             spec = {"_id": spec}
 
-        if not isinstance(spec, types.DictType):
+        if not isinstance(spec, dict):
             raise TypeError("spec must be an instance of dict, not %s" %
                             type(spec))
 
@@ -511,17 +2249,151 @@ class FakeCollection(object):
                     "err": None,
                     "ok": 1.0}
 
-        for doc in self.find(spec, fields=()):
-            del self.docs[toUnicode(doc['_id'])]
+        for doc in self.find(spec, fields=(), session=session):
+            self._delDoc(toUnicode(doc['_id']), session)
             response['n'] += 1
+        self._acknowledge(kwargs, session)
 
         return response
 
+    # find and modify
+    def _findTarget(self, spec, sort=None, session=None):
+        """Return the first matching (key, doc) item in sort order or None.
+
+        A plain _id gets looked up directly and the scan stops at the first
+        match without a sort. The doc is the stored version, don't change
+        it.
+        """
+        docs = self._getDocs(session)
+        cursor = FakeCursor(self, spec, None, 0, 0, True, True, False,
+            session=session)
+        scores = {}
+        _id = spec.get('_id')
+        if _id is not None and not isinstance(_id, dict):
+            key = toUnicode(_id)
+            items = [(key, docs.get(key))]
+        elif cursor._routed(docs, spec):
+            found = docs.scatterGather(cursor, spec, sort)
+            return found and found[0] or None
+        else:
+            items, spec, scores, ordered = cursor._plan(self, spec, docs)
+        found = cursor._find(items, spec, sort, scores, not sort and 1)
+        return found and found[0] or None
+
+    def _findAndModify(self, spec, update=None, replacement=None,
+        remove=False, fields=None, sort=None, upsert=False, new=False,
+        session=None):
+        """Find one document and update, replace or remove it atomically.
+
+        Returns the document before or (new) after the change and the
+        lastErrorObject. The client lock gets held from the lookup to the
+        write, concurrent callers never modify the same document version.
+        """
+        if spec is None:
+            spec = {}
+        if isinstance(sort, dict):
+            sort = list(sort.items())
+        if fields is not None and not isinstance(fields, dict):
+            fields = self._fields_list_to_dict(fields)
+        status = {u'n': 0}
+        with self._client._lock:
+            found = self._findTarget(spec, sort, session)
+            if found is None:
+                if remove or not upsert:
+                    return None, status
+                # build the upserted document from the spec
+                key = None
+                doc = dict([(toUnicode(k), v) for k, v in spec.items()
+                            if not k.startswith('$') and '.' not in k
+                            and not isinstance(v, dict)])
+                old = None
+            else:
+                key, old = found
+                doc = old
+            if remove:
+                self._delDoc(key, session)
+            else:
+                if update is not None:
+                    doc = applyUpdate(doc, update, insert=found is None)
+                else:
+                    # keep the _id of the document or the filter first
+                    ids = '_id' in doc and [(u'_id', doc['_id'])] or []
+                    doc = dict(ids + [(toUnicode(k), v)
+                                      for k, v in replacement.items()])
+                if old is not None:
+                    doc[u'_id'] = old['_id']
+                elif '_id' not in doc:
+                    doc[u'_id'] = bson.objectid.ObjectId()
+                if key is None:
+                    key = toUnicode(doc['_id'])
+                    status[u'upserted'] = doc['_id']
+                self._setDoc(key, doc, session)
+                status[u'updatedExisting'] = old is not None
+            status[u'n'] = 1
+            if remove or not new:
+                doc = old
+            if doc is None:
+                return None, status
+            if fields:
+                return copy.deepcopy(project(doc, fields)), status
+            return copyDocument(doc), status
+
+    @recorded
+    def find_and_modify(self, query={}, update=None, upsert=False, sort=None,
+        full_response=False, manipulate=False, fields=None, remove=False,
+        new=False, session=None, **kwargs):
+        if not update and not remove:
+            raise ValueError("Must either update or remove")
+        if update and remove:
+            raise ValueError("Can't do both update and remove")
+        replacement = None
+        if update and not [k for k in update if k.startswith('$')]:
+            update, replacement = None, update
+        doc, status = self._findAndModify(query, update, replacement, remove,
+            fields, sort, upsert, new, session)
+        self._acknowledge(kwargs, session)
+        if full_response:
+            return {u'value': doc, u'lastErrorObject': status, u'ok': 1.0}
+        return doc
+
+    @recorded
+    def find_one_and_update(self, filter, update, projection=None, sort=None,
+        upsert=False, return_document=False, session=None, **kwargs):
+        """return_document is ReturnDocument.BEFORE (False) or AFTER (True)
+        """
+        if not update or [k for k in update if not k.startswith('$')]:
+            raise ValueError("update only works with $ operators")
+        doc = self._findAndModify(filter, update=update, fields=projection,
+            sort=sort, upsert=upsert, new=return_document,
+            session=session)[0]
+        self._acknowledge(kwargs, session)
+        return doc
+
+    @recorded
+    def find_one_and_replace(self, filter, replacement, projection=None,
+        sort=None, upsert=False, return_document=False, session=None,
+        **kwargs):
+        if [k for k in replacement if k.startswith('$')]:
+            raise ValueError("replacement can not include $ operators")
+        doc = self._findAndModify(filter, replacement=replacement,
+            fields=projection, sort=sort, upsert=upsert, new=return_document,
+            session=session)[0]
+        self._acknowledge(kwargs, session)
+        return doc
+
+    @recorded
+    def find_one_and_delete(self, filter, projection=None, sort=None,
+        session=None, **kwargs):
+        doc = self._findAndModify(filter, remove=True, fields=projection,
+            sort=sort, session=session)[0]
+        self._acknowledge(kwargs, session)
+        return doc
+
     # helper methods
     def _fields_list_to_dict(self, fields):
         as_dict = OrderedData()
         for field in fields:
-            if not isinstance(field, types.StringTypes):
+            if not isinstance(field, string_types):
                 raise TypeError("fields must be a list of key names as "
                                 "(string, unicode)")
             as_dict[field] = 1
@@ -540,6 +2412,7 @@ class FakeDatabase(object):
         self.__name = toUnicode(name)
         self.__connection = connection
         self.cols = {}
+        self._read_preference = None
 
     @property
     def connection(self):
@@ -549,17 +2422,64 @@ class FakeDatabase(object):
     def name(self):
         return self.__name
 
+    @property
+    def read_preference(self):
+        if self._read_preference is None:
+            return self.__connection.read_preference
+        return self._read_preference
+
+    @read_preference.setter
+    def read_preference(self, read_preference):
+        self._read_preference = read_preference
+
     def clear(self):
-        for k, col in self.cols.items():
+        for k, col in list(self.cols.items()):
             col.clear()
             del self.cols[k]
 
-    def create_collection(self, name, **kw):
-        return True
+    def create_collection(self, name, storage=None, viewOn=None,
+        pipeline=None, deferred=False, **kw):
+        """Create a collection or a materialized view.
+
+        A view collection with viewOn (the source collection name) and a
+        pipeline of $match, $project and $group stages gets maintained
+        incrementally by the writes of the source, see views.py. A deferred
+        view applies the writes on the next read or refresh.
+        """
+        if viewOn is None:
+            col = self.__getattr__(name)
+            if storage is not None:
+                col.setStorage(storage)
+            return True
+        from m01.mongofake.views import MaterializedView
+        if name in self.cols:
+            raise pymongo.errors.CollectionInvalid(
+                "collection %s already exists" % name)
+        source = self[viewOn]
+        col = FakeCollection(self, name)
+        if storage is not None:
+            col.setStorage(storage)
+        MaterializedView(source, col, pipeline or [], deferred)
+        self.cols[name] = col
+        return col
 
     def collection_names(self):
         return list(self.cols.keys())
 
+    def command(self, command, value=1, check=True, allowable_errors=None,
+        read_preference=None, session=None, **kwargs):
+        """Run a database command.
+
+        Supports collStats, dbStats, serverStatus and ping, see commands.py.
+        """
+        from m01.mongofake.commands import runCommand
+        start = time.time()
+        try:
+            return runCommand(self, command, value, kwargs)
+        finally:
+            self.__connection._opStats.add('command', 'commands',
+                time.time() - start)
+
     def __getattr__(self, name):
         col = self.cols.get(name)
         if col is None:
@@ -589,11 +2509,171 @@ class FakeDatabase(object):
             self.__name)
 
 
+class _TransactionContext(object):
+    """Commits or aborts the transaction on exit"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.session.in_transaction:
+            if exc_type is None:
+                self.session.commit_transaction()
+            else:
+                self.session.abort_transaction()
+
+
+class FakeClientSession(object):
+    """Fake client session supporting multi document transactions.
+
+    A transaction reads from a snapshot (the client commit timestamp at
+    start_transaction) without blocking any writer. Writes get buffered in the
+    session and applied with a new commit timestamp on commit. Writing a
+    document changed by another transaction or committed after our snapshot
+    raises WriteConflict and aborts the transaction.
+    """
+
+    def __init__(self, client, causal_consistency=True,
+        default_transaction_options=None):
+        self._client = client
+        self.causal_consistency = causal_consistency
+        self.options = default_transaction_options
+        self.session_id = {'id': bson.binary.Binary(uuid.uuid4().bytes, 4)}
+        self._ended = False
+        self._snapshot = None
+        self._writes = {}
+        self._order = []
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def has_ended(self):
+        return self._ended
+
+    @property
+    def in_transaction(self):
+        return self._snapshot is not None
+
+    def _checkEnded(self):
+        if self._ended:
+            raise pymongo.errors.InvalidOperation(
+                "Cannot use ended session")
+
+    def start_transaction(self, read_concern=None, write_concern=None,
+        read_preference=None, max_commit_time_ms=None):
+        self._checkEnded()
+        if self.in_transaction:
+            raise pymongo.errors.InvalidOperation(
+                "Transaction already in progress")
+        self._snapshot = self._client._beginSnapshot()
+        return _TransactionContext(self)
+
+    def _conflict(self):
+        self._finish()
+        return WriteConflict("WriteConflict error: this operation conflicted "
+            "with another operation. Please retry your operation or "
+            "multi-document transaction.")
+
+    def _write(self, collection, key, doc):
+        """Buffer a write, MISSING as doc marks a removed document"""
+        with self._client._lock:
+            owner = collection._pending.get(key)
+            if ((owner is not None and owner is not self) or
+                collection._writeTs.get(key, 0) > self._snapshot):
+                raise self._conflict()
+            collection._pending[key] = self
+            writes = self._writes.setdefault(collection, {})
+            if key not in writes:
+                self._order.append((collection, key))
+            writes[key] = doc
+
+    def commit_transaction(self):
+        self._checkEnded()
+        if not self.in_transaction:
+            raise pymongo.errors.InvalidOperation("No transaction started")
+        client = self._client
+        with client._lock:
+            # non transactional writes don't check pending writes
+            for collection, key in self._order:
+                if collection._writeTs.get(key, 0) > self._snapshot:
+                    raise self._conflict()
+            if self._order:
+                ts = client._tick()
+                wal = client._wal
+                if wal is not None:
+                    # log the writes as one record
+                    wal.beginTransaction()
+                try:
+                    for collection, key in self._order:
+                        collection._commit(key, self._writes[collection][key],
+                            ts)
+                finally:
+                    if wal is not None:
+                        wal.commitTransaction()
+            self._finish()
+
+    def abort_transaction(self):
+        self._checkEnded()
+        if not self.in_transaction:
+            raise pymongo.errors.InvalidOperation("No transaction started")
+        self._finish()
+
+    def _finish(self):
+        with self._client._lock:
+            for collection, key in self._order:
+                if collection._pending.get(key) is self:
+                    del collection._pending[key]
+            self._writes = {}
+            self._order = []
+            snapshot = self._snapshot
+            self._snapshot = None
+            self._client._endSnapshot(snapshot)
+
+    def with_transaction(self, callback, read_concern=None,
+        write_concern=None, read_preference=None, max_commit_time_ms=None,
+        retries=100):
+        """Run callback in a transaction and retry on write conflicts"""
+        while True:
+            self.start_transaction(read_concern, write_concern,
+                read_preference, max_commit_time_ms)
+            try:
+                result = callback(self)
+                self.commit_transaction()
+            except WriteConflict:
+                if retries <= 0:
+                    raise
+                retries -= 1
+                continue
+            except:
+                if self.in_transaction:
+                    self.abort_transaction()
+                raise
+            return result
+
+    def end_session(self):
+        if self.in_transaction:
+            self.abort_transaction()
+        self._ended = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end_session()
+
+
 class FakeMongoClient(object):
     """Fake MongoDB MongoClient."""
 
     HOST = 'localhost'
-    POST = 27017
+    PORT = 27017
+    # BBB: misspelled
+    POST = PORT
 
     __max_bson_size = 4 * 1024 * 1024
 
@@ -605,6 +2685,21 @@ class FakeMongoClient(object):
         self.__document_class = {}
         self.__tz_aware = False
         self.__nodes = []
+        # transactions
+        self._lock = threading.RLock()
+        self._clock = 0
+        self._snapshots = []
+        self._versioned = set()
+        # replica set
+        self._replicaSet = None
+        self._recorder = None
+        self._wal = None
+        self._cursors = None
+        self._quota = None
+        self._model = None
+        self._opStats = OperationStats()
+        self._started = time.time()
+        self.__read_preference = None
 
     @property
     def dbs(self):
@@ -614,7 +2709,7 @@ class FakeMongoClient(object):
         document_class=dict, tz_aware=False, _connect=True, **kwargs):
         if host is None:
             host = self.HOST
-        if isinstance(host, six.string_types):
+        if isinstance(host, string_types):
             host = [host]
         if port is None:
             port = self.PORT
@@ -662,8 +2757,166 @@ class FakeMongoClient(object):
                 # ConnectionFailure makes more sense here than AutoReconnect
                 raise pymongo.errors.ConnectionFailure(str(e))
 
+        self.__read_preference = kwargs.get('read_preference',
+            opts.get('readpreference'))
+        replicaset = kwargs.get('replicaset', opts.get('replicaset'))
+        if replicaset and self._replicaSet is None:
+            self.enableReplicaSet(replicaset)
+
         return self
 
+    def enableReplicaSet(self, name='rs0', secondaries=2, lag=0.0):
+        """Run as primary of a replica set with the given secondaries.
+
+        lag is the replication lag in seconds (or a list with one lag per
+        secondary). Returns the FakeReplicaSet.
+        """
+        from m01.mongofake.replica import FakeReplicaSet
+        if self._replicaSet is not None:
+            self._replicaSet.close()
+        self._replicaSet = FakeReplicaSet(self, name, secondaries, lag)
+        return self._replicaSet
+
+    def disableReplicaSet(self):
+        if self._replicaSet is not None:
+            self._replicaSet.close()
+            self._replicaSet = None
+
+    def _logCommand(self, db, collection, command, *args, **kwargs):
+        # log a command for the replica set and the write-ahead log
+        if self._replicaSet is not None:
+            self._replicaSet.logCommand(db, collection, command, *args,
+                **kwargs)
+        if self._wal is not None:
+            with self._lock:
+                self._wal.logCommand(db, collection, command, *args,
+                    **kwargs)
+
+    def enableDurability(self, path, journal=False, commitInterval=0.1,
+        checkpointEvery=10000):
+        """Recover the data from the directory and log all writes to a
+        write-ahead log in it.
+
+        journal is the default j write concern. Returns the WriteAheadLog.
+        """
+        from m01.mongofake.durable import WriteAheadLog
+        self.disableDurability()
+        wal = WriteAheadLog(self, path, commitInterval, checkpointEvery,
+            journal)
+        wal.recover()
+        wal.start()
+        self._wal = wal
+        return wal
+
+    def disableDurability(self):
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+    def enableRecording(self, target, format=None):
+        """Record the collection calls to a JSON Lines or BSON trace.
+
+        The target is a file name or a stream. Returns the WorkloadRecorder.
+        """
+        from m01.mongofake.workload import WorkloadRecorder
+        self.disableRecording()
+        self._recorder = WorkloadRecorder(target, format)
+        return self._recorder
+
+    def disableRecording(self):
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
+    def enableMemoryQuota(self, maxSize, path=None):
+        """Keep at most maxSize bytes (BSON size) of documents of all
+        collections in memory.
+
+        The least recently used documents of all collections get spilled to
+        segment files in path (default the temp directory). Collections can
+        have their own quota too. Collections using a raw, sharded or shared
+        storage don't spill. Returns the MemoryQuota.
+        """
+        from m01.mongofake.spill import MemoryQuota
+        self.disableMemoryQuota()
+        self._quota = MemoryQuota(maxSize, path)
+        for db in self.dbs.values():
+            for collection in db.cols.values():
+                docs = collection.docs
+                if isinstance(docs, OrderedData):
+                    collection.enableMemoryQuota()
+                elif hasattr(docs, 'quota'):
+                    collection.enableMemoryQuota(docs.maxSize, docs.path)
+        return self._quota
+
+    def disableMemoryQuota(self):
+        quota = self._quota
+        if quota is None:
+            return
+        self._quota = None
+        for db in self.dbs.values():
+            for collection in db.cols.values():
+                docs = collection.docs
+                if getattr(docs, 'quota', None) is not quota:
+                    continue
+                if docs.maxSize is None:
+                    collection.disableMemoryQuota()
+                else:
+                    # keep the quota of the collection
+                    collection.enableMemoryQuota(docs.maxSize, docs.path)
+
+    @property
+    def memoryQuota(self):
+        return self._quota
+
+    def enablePerformanceModel(self, latency=None, perDocument=0.0,
+        throughput=None, tail=None, clock=None, seed=None):
+        """Add modeled latencies to the collection operations.
+
+        See PerformanceModel for the options. A virtual clock simulates the
+        latencies without waiting. Returns the PerformanceModel.
+        """
+        from m01.mongofake.perfmodel import PerformanceModel
+        self._model = PerformanceModel(latency, perDocument, throughput, tail,
+            clock, seed)
+        return self._model
+
+    def disablePerformanceModel(self):
+        self._model = None
+
+    @property
+    def performanceModel(self):
+        return self._model
+
+    @property
+    def cursors(self):
+        """The CursorRegistry with the open server-side cursors"""
+        if self._cursors is None:
+            with self._lock:
+                if self._cursors is None:
+                    from m01.mongofake.cursors import CursorRegistry
+                    self._cursors = CursorRegistry()
+        return self._cursors
+
+    def close_cursor(self, cursor_id, address=None):
+        self.cursors.close(cursor_id)
+
+    def kill_cursors(self, cursor_ids, address=None):
+        for cursor_id in cursor_ids:
+            self.cursors.close(cursor_id)
+
+    @property
+    def replica_set(self):
+        return self._replicaSet
+
+    @property
+    def read_preference(self):
+        return self.__read_preference
+
+    @read_preference.setter
+    def read_preference(self, read_preference):
+        self.__read_preference = read_preference
+
     def __find_node(self, seeds=None):
         # very simple find node implementation
         errors = []
@@ -705,13 +2958,60 @@ class FakeMongoClient(object):
     @property
     def nodes(self):
         """List of all known nodes."""
+        if self._replicaSet is not None:
+            return frozenset(self._replicaSet.nodes)
         return self.__nodes
 
+    @property
+    def is_primary(self):
+        return True
+
+    @property
+    def primary(self):
+        if self._replicaSet is not None:
+            return self._replicaSet.primary
+        return None
+
+    @property
+    def secondaries(self):
+        if self._replicaSet is not None:
+            return set([s.node for s in self._replicaSet.secondaries])
+        return set()
+
+    def start_session(self, causal_consistency=True,
+        default_transaction_options=None):
+        return FakeClientSession(self, causal_consistency,
+            default_transaction_options)
+
+    # multi version concurrency control
+    def _tick(self):
+        """Return the next commit timestamp, the lock must be acquired"""
+        self._clock += 1
+        return self._clock
+
+    def _beginSnapshot(self):
+        with self._lock:
+            self._snapshots.append(self._clock)
+            return self._clock
+
+    def _endSnapshot(self, snapshot):
+        with self._lock:
+            self._snapshots.remove(snapshot)
+            if self._snapshots:
+                oldest = min(self._snapshots)
+            else:
+                oldest = None
+            for collection in self._versioned:
+                collection._pruneHistory(oldest)
+            if oldest is None:
+                self._versioned = set()
+
     def drop_database(self, name):
         db = self.__dbs.get(name)
         if db is not None:
             db.clear()
             del self.__dbs[name]
+            self._logCommand(None, None, 'drop_database', name)
 
     def database_names(self):
         return list(self.__dbs.keys())
@@ -759,23 +3059,195 @@ class FakeMongoConnection(FakeMongoClient):
     """BBB: support old FakeMongoConnection class"""
 
 
-# single shared MongoClient instance
-fakeMongoClient = FakeMongoClient()
 
-# BBB: support
-fakeMongoConnection = FakeMongoConnection()
+try:
+    from pymongo.errors import WaitQueueTimeoutError
+except ImportError:
+    # pymongo < 4.0
+    class WaitQueueTimeoutError(pymongo.errors.ConnectionFailure):
+        """Raised if a pool checkout times out"""
+
+
+class FakePoolHandle(object):
+    """Lightweight session handle checked out from a FakeMongoConnectionPool.
+
+    The handle delegates database access to the shared fake client and can get
+    used as context manager which will check in the handle.
+    """
+
+    def __init__(self, pool, hid):
+        self.pool = pool
+        self.hid = hid
+        self.checkedOut = False
+
+    @property
+    def client(self):
+        return self.pool.connection
+
+    def close(self):
+        """Return the handle to the pool"""
+        self.pool.checkin(self)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def __getitem__(self, name):
+        return self.client[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.checkedOut:
+            self.close()
+
+    def __repr__(self):
+        return "<%s %d>" % (self.__class__.__name__, self.hid)
 
 
 class FakeMongoConnectionPool(object):
-    """Fake mongodb connection pool."""
+    """Fake mongodb connection pool.
+
+    The pool hands out at most max_pool_size handles at the same time (None
+    means unlimited). A checkout waits up to wait_queue_timeout seconds for a
+    free handle and raises WaitQueueTimeoutError after that. The optional
+    latency (seconds or a callable returning seconds) gets applied on each
+    checkout and simulates network round trips.
+    """
 
     def __init__(self, host='localhost', port=27017, max_pool_size=10,
         tz_aware=True, _connect=True, logLevel=20, connectionFactory=None,
-        **kwargs):
-        self.connection = fakeMongoClient
+        wait_queue_timeout=None, latency=None, client=None, **kwargs):
+        if client is None:
+            client = _lazy('fakeMongoClient')
+        self.connection = client
+        self.max_pool_size = max_pool_size
+        self.wait_queue_timeout = wait_queue_timeout
+        self.latency = latency
+        self._cond = threading.Condition()
+        self._idle = []
+        self._created = 0
+        self._inUse = 0
+        self._waiting = 0
+        # metrics
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.waitTimes = Histogram()
+
+    def checkout(self, timeout=None):
+        """Check out a handle, wait for a free one if the pool is exhausted"""
+        if timeout is None:
+            timeout = self.wait_queue_timeout
+        start = time.time()
+        with self._cond:
+            self._waiting += 1
+            try:
+                while (not self._idle and self.max_pool_size is not None and
+                       self._created >= self.max_pool_size):
+                    if timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise WaitQueueTimeoutError(
+                            "Timed out waiting for a handle from the pool, "
+                            "max_pool_size: %s, wait_queue_timeout: %s" % (
+                                self.max_pool_size, timeout))
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+            if self._idle:
+                handle = self._idle.pop()
+            else:
+                self._created += 1
+                handle = FakePoolHandle(self, self._created)
+            handle.checkedOut = True
+            self._inUse += 1
+            self.checkouts += 1
+            self.waitTimes.add(time.time() - start)
+        latency = self.latency
+        if callable(latency):
+            latency = latency()
+        if latency:
+            time.sleep(latency)
+        return handle
+
+    def checkin(self, handle):
+        """Return a checked out handle to the pool"""
+        with self._cond:
+            if handle.pool is not self or not handle.checkedOut:
+                raise ValueError("%r is not checked out from this pool" %
+                    handle)
+            handle.checkedOut = False
+            self._inUse -= 1
+            self.checkins += 1
+            self._idle.append(handle)
+            self._cond.notify()
+
+    def stats(self):
+        """Return the pool metrics"""
+        with self._cond:
+            return {'maxPoolSize': self.max_pool_size,
+                    'created': self._created,
+                    'inUse': self._inUse,
+                    'idle': len(self._idle),
+                    'waiting': self._waiting,
+                    'checkouts': self.checkouts,
+                    'checkins': self.checkins,
+                    'timeouts': self.timeouts,
+                    'waitTime': self.waitTimes.toDict()}
 
     def disconnect(self):
+        with self._cond:
+            self._idle = []
+            self._created = self._inUse
         self.connection.disconnect()
 
-# single shared connection pool instance
-fakeMongoConnectionPool = FakeMongoConnectionPool()
+
+###############################################################################
+#
+# lazy module attributes
+#
+###############################################################################
+
+# name: factory, the attributes get created on first access. The shared
+# instances are: fakeMongoClient (single shared MongoClient),
+# fakeMongoConnection (BBB) and fakeMongoConnectionPool.
+LAZY_ATTRIBUTES = {
+    'BSONPrettyPrinter': _createBSONPrettyPrinter,
+    'DATE_PATTERN': _createDatePattern,
+    'OBJECT_AT_PATTERN': _createObjectAtPattern,
+    'reNormalizer': _createReNormalizer,
+    'fakeMongoClient': FakeMongoClient,
+    'fakeMongoConnection': FakeMongoConnection,
+    'fakeMongoConnectionPool': FakeMongoConnectionPool,
+    }
+
+_lazyLock = threading.RLock()
+
+
+def _lazy(name):
+    """Return a lazy module attribute, create it on first access"""
+    try:
+        return globals()[name]
+    except KeyError:
+        pass
+    with _lazyLock:
+        if name not in globals():
+            globals()[name] = LAZY_ATTRIBUTES[name]()
+        return globals()[name]
+
+
+def __getattr__(name):
+    # python >= 3.7 (PEP 562)
+    if name in LAZY_ATTRIBUTES:
+        return _lazy(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if sys.version_info < (3, 7):
+    # no module __getattr__, create them now
+    for name in LAZY_ATTRIBUTES:
+        _lazy(name)
@@ -0,0 +1,875 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks
+
+Run all benchmarks with ``python -m m01.mongofake.benchmark``. Each benchmark
+method returns a dict containing the size and the timings in seconds. A
+benchmark comparing two implementations also returns whether they gave the
+same result (same) or another value showing that the faster path works.
+"""
+import datetime
+import io
+import os
+import pprint as pp
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import bson.son
+import bson.tz_util
+
+import m01.mongofake
+
+
+def getResultSet(size):
+    """Setup a fake collection and return a cursor over size documents"""
+    client = m01.mongofake.FakeMongoClient()('localhost', 45017)
+    collection = client.benchmark.docs
+    now = datetime.datetime(2015, 3, 17, 12, 0, tzinfo=bson.tz_util.utc)
+    for i in range(size):
+        collection.insert({'_id': m01.mongofake.getObjectId(i),
+                           'name': u'doc-%d' % i,
+                           'created': now,
+                           'modified': now + datetime.timedelta(seconds=i),
+                           'tags': [u'a', u'b', u'c'],
+                           'nested': {'ref': m01.mongofake.getObjectId(i + 1),
+                                      'date': u'2015-03-17 12:00:00'}})
+    return collection
+
+
+def benchRENormalizer(size=10000):
+    """Compare one regex pass per pattern with the combined regex pass"""
+    docs = list(getResultSet(size).find())
+    patterns = m01.mongofake.reNormalizer.patterns
+
+    # one full regex pass per pattern
+    start = time.time()
+    stream = io.StringIO()
+    for doc in docs:
+        text = pp.pformat(m01.mongofake.dictify(doc))
+        for regexp, replacement in patterns:
+            text = regexp.sub(replacement, text)
+        stream.write(text)
+        stream.write(u'\n')
+    sequential = time.time() - start
+
+    # one combined pass, streamed document by document
+    normalizer = m01.mongofake.RENormalizer(patterns)
+    start = time.time()
+    other = io.StringIO()
+    normalizer.pprint((doc for doc in docs), other)
+    combined = time.time() - start
+
+    return {'size': size,
+            'sequential': sequential,
+            'combined': combined,
+            'same': stream.getvalue() == other.getvalue()}
+
+
+def _recursiveDictify(data):
+    # the former recursive implementation which copies everything
+    if isinstance(data, bson.son.SON):
+        data = dict(data)
+    if isinstance(data, dict):
+        return dict([(k, _recursiveDictify(v)) for k, v in data.items()])
+    elif isinstance(data, (tuple, list)):
+        d = [_recursiveDictify(v) for v in data]
+        if isinstance(data, tuple):
+            d = tuple(d)
+        return d
+    return data
+
+
+def benchDictify(size=10000):
+    """Compare the recursive copying dictify with the iterative dictify"""
+    docs = list(getResultSet(size).find())
+
+    start = time.time()
+    copied = [_recursiveDictify(doc) for doc in docs]
+    recursive = time.time() - start
+
+    start = time.time()
+    converted = [m01.mongofake.dictify(doc) for doc in docs]
+    iterative = time.time() - start
+
+    return {'size': size,
+            'recursive': recursive,
+            'iterative': iterative,
+            'same': copied == converted}
+
+
+def benchPrettyPrinter(size=10000):
+    """Compare the regex normalizer with the normalizing pretty printer"""
+    docs = list(getResultSet(size).find())
+    patterns = m01.mongofake.reNormalizer.patterns
+    normalizer = m01.mongofake.RENormalizer(patterns)
+
+    start = time.time()
+    stream = io.StringIO()
+    normalizer.pprint((doc for doc in docs), stream)
+    regex = time.time() - start
+
+    start = time.time()
+    other = io.StringIO()
+    m01.mongofake.reNormalizer.pprint((doc for doc in docs), other)
+    printer = time.time() - start
+
+    # the printer wraps nested documents at other places
+    return {'size': size,
+            'regex': regex,
+            'printer': printer,
+            'same': stream.getvalue().split() == other.getvalue().split()}
+
+
+def _storageMemory(storage, size):
+    # return the memory in bytes used by size documents and the insert time
+    client = m01.mongofake.FakeMongoClient()('localhost', 45017)
+    client.benchmark.create_collection('docs', storage=storage)
+    collection = client.benchmark.docs
+    now = datetime.datetime(2015, 3, 17, 12, 0, tzinfo=bson.tz_util.utc)
+    tracemalloc.start()
+    start = time.time()
+    for i in range(size):
+        collection.insert({'_id': m01.mongofake.getObjectId(i),
+                           'name': u'doc-%d' % i,
+                           'created': now,
+                           'tags': [u'a', u'b', u'c'],
+                           'nested': {'ref': m01.mongofake.getObjectId(i + 1),
+                                      'count': i}})
+    duration = time.time() - start
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used, duration
+
+
+def benchStorageMemory(size=1000000):
+    """Compare the memory used by the dict and the raw BSON storage.
+
+    The default are 1M documents, the fixture size the raw storage is for.
+    With tracemalloc tracing the inserts this takes a few minutes.
+    """
+    dictMemory, dictTime = _storageMemory('dict', size)
+    rawMemory, rawTime = _storageMemory('raw', size)
+    return {'size': size,
+            'dict': dictTime,
+            'raw': rawTime,
+            'dictMB': dictMemory / (1024.0 * 1024),
+            'rawMB': rawMemory / (1024.0 * 1024)}
+
+
+def benchResultCache(size=10000, repeat=100):
+    """Repeat the same queries with and without the result cache"""
+    collection = getResultSet(size)
+    specs = [{'name': u'doc-%d' % i} for i in range(0, size, size // 10 or 1)]
+
+    def run():
+        start = time.time()
+        for i in range(repeat):
+            for spec in specs:
+                list(collection.find(spec))
+        return time.time() - start
+
+    uncached = run()
+    cache = collection.enableCache()
+    cached = run()
+    return {'size': size,
+            'uncached': uncached,
+            'cached': cached,
+            'hits': cache.stats()['hits']}
+
+
+WORDS = [u'apple', u'pear', u'banana', u'cherry', u'plum', u'lemon', u'kiwi',
+         u'mango', u'peach', u'grape', u'melon', u'orange', u'lime', u'fig']
+
+
+def benchTextSearch(size=10000, repeat=10):
+    """Compare $text queries using the text index with a regex scan"""
+    client = m01.mongofake.FakeMongoClient()('localhost', 45017)
+    collection = client.benchmark.texts
+    for i in range(size):
+        words = [WORDS[(i * j) % len(WORDS)] for j in range(1, 8)]
+        if not i % 100:
+            # one percent of the documents contain the searched word
+            words.append(u'durian')
+        collection.insert({'_id': i, 'title': u'doc %s' % i,
+                           'body': u' '.join(words)})
+    collection.create_index([('title', 'text'), ('body', 'text')])
+    regexp = re.compile(r'\bdurian\b', re.I)
+
+    start = time.time()
+    for i in range(repeat):
+        scanned = [doc for doc in collection.docs.values()
+                   if regexp.search(doc['title']) or regexp.search(doc['body'])]
+    scan = time.time() - start
+
+    start = time.time()
+    for i in range(repeat):
+        found = list(collection.find({'$text': {'$search': u'durian'}}))
+    index = time.time() - start
+
+    return {'size': size,
+            'scan': scan,
+            'index': index,
+            'same': sorted([d['_id'] for d in scanned]) ==
+                    sorted([d['_id'] for d in found])}
+
+
+def benchGeoNear(size=100000, repeat=10):
+    """Compare $near and $geoWithin using the 2dsphere index with a scan"""
+    from m01.mongofake import geo
+    client = m01.mongofake.FakeMongoClient()('localhost', 45017)
+    collection = client.benchmark.places
+    collection.create_index([('loc', '2dsphere')])
+    rand = random.Random(42)
+    for i in range(size):
+        collection.insert({'_id': i, 'loc': {'type': 'Point', 'coordinates': [
+            rand.uniform(-180, 180), rand.uniform(-90, 90)]}})
+    point = {'type': 'Point', 'coordinates': [8.54, 47.37]}
+    box = [[5.9, 45.8], [10.5, 47.8]]
+
+    start = time.time()
+    for i in range(repeat):
+        docs = list(collection.docs.values())
+        docs.sort(key=lambda doc: geo.distance(point['coordinates'],
+            doc['loc']['coordinates'], 'meters'))
+        nearest = docs[:10]
+        within = [doc for doc in collection.docs.values()
+                  if geo.match('$geoWithin', doc['loc'], {'$box': box})]
+    scan = time.time() - start
+
+    start = time.time()
+    for i in range(repeat):
+        found = list(collection.find(
+            {'loc': {'$near': {'$geometry': point}}}, limit=10))
+        foundWithin = list(collection.find(
+            {'loc': {'$geoWithin': {'$box': box}}}))
+    index = time.time() - start
+
+    return {'size': size,
+            'scan': scan,
+            'index': index,
+            'same': [d['_id'] for d in nearest] == [d['_id'] for d in found]
+                    and sorted([d['_id'] for d in within]) ==
+                    sorted([d['_id'] for d in foundWithin])}
+
+
+def benchGridFS(size=64 * 1024 * 1024):
+    """Stream size bytes through GridFS and compare the peak memory (in MB)
+    with the file size"""
+    from m01.mongofake.grid import FakeGridFS
+    client = m01.mongofake.FakeMongoClient()('localhost', 45017)
+    fs = FakeGridFS(client.benchmark)
+    block = b'x' * (1024 * 1024)
+
+    tracemalloc.start()
+    start = time.time()
+    gridIn = fs.new_file(filename=u'big.bin')
+    for i in range(size // len(block)):
+        gridIn.write(block)
+    gridIn.write(block[:size % len(block)])
+    gridIn.close()
+    upload = time.time() - start
+    # the stored chunks are the file, only count the streaming overhead
+    stored = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+
+    start = time.time()
+    out = fs.get(gridIn._id)
+    while out.read(len(block)):
+        pass
+    download = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1] - stored
+    tracemalloc.stop()
+
+    return {'size': size,
+            'upload': upload,
+            'download': download,
+            'peakMB': peak / (1024.0 * 1024)}
+
+
+def benchSharding(size=100000, repeat=10, shards=4):
+    """Compare targeted and broadcast queries on a hashed sharded collection
+    and the shard skew of a range and a hashed monotonically increasing key"""
+    client = m01.mongofake.FakeMongoClient()('localhost', 45017)
+    skew = {}
+    for kind in (1, 'hashed'):
+        collection = client.benchmark['sharded_%s' % kind]
+        sharded = collection.shardCollection({'ts': kind}, shards,
+            chunkSize=max(size // (shards * 8), 1))
+        for i in range(size):
+            collection.insert({'_id': i, 'ts': i, 'value': i % 97})
+        skew[kind] = sharded.stats()['skew']
+
+    step = size // 10 or 1
+    start = time.time()
+    for i in range(repeat):
+        for ts in range(0, size, step):
+            list(collection.find({'ts': ts}))
+    targeted = time.time() - start
+
+    start = time.time()
+    for i in range(repeat):
+        for ts in range(0, size, step):
+            list(collection.find({'value': ts % 97}))
+    broadcast = time.time() - start
+    sharded.close()
+
+    return {'size': size,
+            'targeted': targeted,
+            'broadcast': broadcast,
+            'rangeSkew': skew[1],
+            'hashedSkew': skew['hashed'],
+            'targetedShards': len(sharded.target({'ts': 0}))}
+
+
+def benchReplicaReads(size=10000, threads=4, repeat=20):
+    """Compare concurrent reads from the primary with reads spread over
+    the secondaries while a writer updates the primary"""
+    collection = getResultSet(0)
+    rs = collection.database.connection.enableReplicaSet(secondaries=threads)
+    for i in range(size):
+        collection.insert({'_id': i, 'name': u'doc-%d' % i})
+    rs.sync()
+
+    def run(read_preference):
+        stop = []
+
+        def write():
+            i = 0
+            while not stop:
+                collection.update({'_id': i % size}, {'$set': {'n': i}})
+                i += 1
+
+        def read():
+            for i in range(repeat):
+                list(collection.find({'name': u'doc-%d' % i},
+                    read_preference=read_preference))
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        readers = [threading.Thread(target=read) for i in range(threads)]
+        start = time.time()
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        duration = time.time() - start
+        stop.append(True)
+        writer.join()
+        return duration
+
+    primary = run('primary')
+    secondary = run('secondary')
+    members = rs.stats()['members'][1:]
+    lag = max([m['lagSeconds'] for m in members])
+    rs.close()
+    return {'size': size,
+            'primary': primary,
+            'secondary': secondary,
+            'maxLag': lag,
+            'secondaryReads': sum([m['reads'] for m in members])}
+
+
+def benchCountDistinct(size=10000, repeat=100):
+    """Compare count_documents and distinct using a field index with a
+    scan of the documents"""
+    collection = getResultSet(0)
+    for i in range(size):
+        collection.insert({'_id': i, 'state': u'state-%d' % (i % 5),
+                           'region': u'region-%d' % (i % 20)})
+
+    def run():
+        results = []
+        start = time.time()
+        for i in range(repeat):
+            spec = {'state': u'state-%d' % (i % 5)}
+            results.append((collection.count_documents(spec),
+                            sorted(collection.distinct('region', spec))))
+        return time.time() - start, results
+
+    scan, scanned = run()
+    collection.create_index([('state', 1), ('region', 1)])
+    index, found = run()
+    return {'size': size,
+            'scan': scan,
+            'index': index,
+            'same': scanned == found}
+
+
+def benchJobClaim(size=2000, workers=4):
+    """Claim jobs with find_one_and_update from one and from many worker
+    threads, each job must get claimed once"""
+    def run(threads):
+        collection = getResultSet(0)
+        for i in range(size):
+            collection.insert({'_id': i, 'state': u'new', 'priority': i % 10})
+        claimed = []
+
+        def work():
+            while True:
+                job = collection.find_one_and_update({'state': u'new'},
+                    {'$set': {'state': u'running'}}, projection={'_id': 1})
+                if job is None:
+                    return
+                claimed.append(job['_id'])
+
+        pool = [threading.Thread(target=work) for i in range(threads)]
+        start = time.time()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        duration = time.time() - start
+        return duration, len(claimed) - len(set(claimed))
+
+    single, duplicates = run(1)
+    concurrent, duplicates = run(workers)
+    return {'size': size,
+            'single': single,
+            'workers': concurrent,
+            'duplicates': duplicates}
+
+
+def benchReplay(size=10000, concurrency=4):
+    """Record a mixed workload and replay it with one thread, concurrent
+    threads and processes. Returns the throughput in operations per
+    second"""
+    from m01.mongofake import workload
+    collection = getResultSet(0)
+    stream = io.StringIO()
+    collection.database.connection.enableRecording(stream)
+    for i in range(size):
+        collection.insert({'_id': i, 'state': u'new', 'n': i % 100})
+        if i % 4 == 0:
+            collection.find_one({'_id': i // 2})
+        if i % 10 == 0:
+            collection.count_documents({'n': i % 100})
+    collection.database.connection.disableRecording()
+    trace = list(workload.readTrace(io.StringIO(stream.getvalue())))
+
+    reports = []
+
+    def run(workers, mode):
+        client = m01.mongofake.FakeMongoClient()('localhost', 27017)
+        reports.append(workload.replay(trace, client, workers, mode))
+        return reports[-1]['throughput']
+
+    return {'size': size,
+            'single': run(1, 'threads'),
+            'threads': run(concurrency, 'threads'),
+            'processes': run(concurrency, 'processes'),
+            'errors': sum([report['errors'] for report in reports])}
+
+
+def benchWriteConcern(size=2000, threads=4):
+    """Compare the insert throughput (inserts per second) of the write
+    concern settings with the write-ahead log. The journaled inserts run
+    on one and on concurrent threads sharing fsyncs (group commit)"""
+    counts = []
+
+    def run(concern, workers=1, durable=True, secondaries=0):
+        collection = getResultSet(0)
+        client = collection.database.connection
+        path = tempfile.mkdtemp()
+        if durable:
+            client.enableDurability(path)
+        if secondaries:
+            client.enableReplicaSet(secondaries=secondaries)
+
+        def write(n):
+            for i in range(size // workers):
+                collection.insert({'_id': u'%d-%d' % (n, i)}, **concern)
+
+        pool = [threading.Thread(target=write, args=(n,))
+                for n in range(workers)]
+        start = time.time()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        duration = time.time() - start
+        counts.append(collection.count() == size // workers * workers)
+        client.disableDurability()
+        client.disableReplicaSet()
+        shutil.rmtree(path)
+        return size / duration
+
+    res = {'size': size,
+           'memory': run({}, durable=False),
+           'w0': run({'w': 0}),
+           'w1': run({'w': 1}),
+           'j': run({'j': True}),
+           'jThreads': run({'j': True}, threads),
+           'majority': run({'w': 'majority'}, secondaries=2),
+           'majorityJ': run({'w': 'majority', 'j': True}, threads,
+                            secondaries=2)}
+    # all settings stored all documents
+    res['complete'] = all(counts)
+    return res
+
+
+def benchCursorBatching(size=10000, cursors=10):
+    """Open cursors reading only the first documents and keep them open,
+    once with batches and once fetching the whole result up front (like
+    before server-side cursors). Returns the time and the retained memory
+    in bytes"""
+    collection = getResultSet(0)
+    for i in range(size):
+        collection.insert({'_id': i, 'name': u'name-%d' % i,
+                           'tags': [u'a', u'b', u'c'], 'nested': {'i': i}})
+
+    def run(fetchAll):
+        tracemalloc.start()
+        start = time.time()
+        opened = []
+        for i in range(cursors):
+            cursor = collection.find()
+            if fetchAll:
+                cursor.docs
+            next(cursor)
+            opened.append(cursor)
+        duration = time.time() - start
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        for cursor in opened:
+            cursor.close()
+        return duration, used
+
+    upfront, upfrontMemory = run(True)
+    batched, batchedMemory = run(False)
+    return {'size': size,
+            'upfront': upfront,
+            'batched': batched,
+            'upfrontMemory': upfrontMemory,
+            'batchedMemory': batchedMemory}
+
+
+FIXTURE_TEMPLATE = {
+    'user': {'type': 'string', 'format': u'user-%d', 'cardinality': 1000,
+             'distribution': 'zipf'},
+    'age': {'type': 'int', 'min': 18, 'max': 90, 'distribution': 'normal'},
+    'state': {'type': 'choice', 'values': [u'new', u'paid', u'shipped']},
+    'created': {'type': 'date'},
+    'items': {'type': 'array', 'min': 0, 'max': 4,
+              'items': {'sku': {'type': 'string', 'length': 6},
+                        'qty': {'type': 'int', 'min': 1, 'max': 5}}},
+    }
+
+
+def benchFixtureLoad(size=100000, processes=2):
+    """Build a fixture collection with the FixtureGenerator (half and full
+    size, one and many processes) and with one insert per document"""
+    from m01.mongofake.generator import FixtureGenerator
+    generator = FixtureGenerator(FIXTURE_TEMPLATE, seed=1, batchSize=5000)
+
+    def run(count, procs=1):
+        collection = getResultSet(0)
+        start = time.time()
+        generator.load(collection, count, procs)
+        return time.time() - start, collection
+
+    half, loaded = run(size // 2)
+    load, loaded = run(size)
+    parallel, loadedParallel = run(size, processes)
+    collection = getResultSet(0)
+    start = time.time()
+    for doc in generator.generate(size):
+        collection.insert(doc)
+    insert = time.time() - start
+    inserted = list(collection.find())
+    return {'size': size,
+            'loadHalf': half,
+            'load': load,
+            'processes': parallel,
+            'insert': insert,
+            'same': list(loaded.find()) == inserted and
+                    list(loadedParallel.find()) == inserted}
+
+
+def benchMemoryQuota(size=20000, reads=2000):
+    """Insert size documents without and with a memory quota of a tenth of
+    their size and read hot (resident) and cold (spilled) documents by _id.
+    Returns the times and the traced memory in bytes"""
+    def run(quota):
+        collection = getResultSet(0)
+        if quota:
+            collection.enableMemoryQuota(size * 1100 // 10)
+        tracemalloc.start()
+        start = time.time()
+        for i in range(size):
+            collection.insert({'_id': i,
+                               'data': u'%06d%s' % (i, u'x' * 1000)})
+        duration = time.time() - start
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return collection, duration, used
+
+    collection, insert, memory = run(False)
+    collection, quotaInsert, quotaMemory = run(True)
+    start = time.time()
+    for i in range(reads):
+        collection.find_one({'_id': size - 1 - i % 100})
+    hot = time.time() - start
+    start = time.time()
+    for i in range(reads):
+        collection.find_one({'_id': i})
+    cold = time.time() - start
+    stats = collection.docs.stats()
+    collection.disableMemoryQuota()
+    return {'size': size,
+            'insert': insert,
+            'quotaInsert': quotaInsert,
+            'memory': memory,
+            'quotaMemory': quotaMemory,
+            'hotReads': hot,
+            'coldReads': cold,
+            'pageInMax': stats['pageInLatency']['max']}
+
+
+def _mapReport(doc):
+    # a report map function with some work per document
+    for item in doc['items']:
+        yield ((doc['user'], doc['state']),
+               {'count': 1, 'qty': item['qty'], 'skus': len(item['sku'])})
+
+
+def _reduceReport(key, values):
+    return {'count': sum([v['count'] for v in values]),
+            'qty': sum([v['qty'] for v in values]),
+            'skus': sum([v['skus'] for v in values])}
+
+
+def benchMapReduce(size=50000, processes=4):
+    """Run a report map_reduce on generated fixtures in one process and in
+    worker processes"""
+    from m01.mongofake.generator import FixtureGenerator
+    collection = getResultSet(0)
+    FixtureGenerator(FIXTURE_TEMPLATE, seed=1, batchSize=5000).load(
+        collection, size)
+
+    def run(procs):
+        start = time.time()
+        results = collection.inline_map_reduce(_mapReport, _reduceReport,
+            processes=procs)
+        return time.time() - start, results
+
+    single, results = run(1)
+    parallel, parallelResults = run(processes)
+    return {'size': size,
+            'single': single,
+            'processes': parallel,
+            'same': results == parallelResults}
+
+
+# the throughput cap of the performance model benchmark
+PERFORMANCE_THROUGHPUT = 5000
+
+
+def benchPerformanceModel(size=20000, clients=8):
+    """Simulate clients threads reading size documents by _id with a modeled
+    latency and a throughput cap on a virtual clock. Returns the real times
+    without and with the model and the simulated time"""
+    from m01.mongofake.perfmodel import Normal
+    collection = getResultSet(0)
+    for i in range(100):
+        collection.insert({'_id': i, 'data': u'x' * 100})
+    client = collection._client
+
+    def run():
+        def read(offset):
+            for i in range(offset, size, clients):
+                collection.find_one({'_id': i % 100})
+
+        threads = [threading.Thread(target=read, args=(i,))
+                   for i in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    baseline = run()
+    model = client.enablePerformanceModel(Normal(0.001, 0.0002),
+        throughput=PERFORMANCE_THROUGHPUT, tail=(0.01, 0.05),
+        clock='virtual', seed=1)
+    try:
+        modeled = run()
+    finally:
+        client.disablePerformanceModel()
+    stats = model.stats()
+    return {'size': size,
+            'baseline': baseline,
+            'modeled': modeled,
+            'simulated': stats['time'],
+            'throttled': stats['throttled']}
+
+
+def benchCollStats(size=20000, polls=100):
+    """Insert size indexed documents and poll collStats and serverStatus.
+    Compares the poll time with summing the document sizes by scanning"""
+    from m01.mongofake import encodeBSON
+    collection = getResultSet(0)
+    collection.create_index([('tags', 1)])
+    start = time.time()
+    for i in range(size):
+        collection.insert({'_id': i, 'name': u'name %d' % i,
+                           'tags': [u'a', u'b']})
+    insert = time.time() - start
+    database = collection.database
+    start = time.time()
+    for i in range(polls):
+        stats = database.command('collStats', collection.name)
+        database.command('serverStatus')
+    poll = (time.time() - start) / polls
+    start = time.time()
+    dataSize = sum([len(encodeBSON(doc))
+                    for doc in collection.docs.values()])
+    scan = time.time() - start
+    return {'size': size,
+            'insert': insert,
+            'poll': poll,
+            'scan': scan,
+            'same': stats['size'] == dataSize}
+
+
+def benchMaterializedView(size=20000, updates=200):
+    """Update documents of a collection with a grouped materialized view.
+    Compares the updates without a view, with an incrementally maintained
+    view and with recomputing the groups after each update"""
+    client = m01.mongofake.FakeMongoClient()('localhost', 45017)
+    database = client.benchmark
+    collection = database.orders
+    collection.bulkLoad([{'_id': i, 'customer': i % 100, 'total': i}
+                         for i in range(size)])
+    pipeline = [{'$group': {'_id': '$customer',
+                            'total': {'$sum': '$total'},
+                            'max': {'$max': '$total'}}}]
+
+    def update(count):
+        start = time.time()
+        for i in range(count):
+            collection.update({'_id': i * 7 % size}, {'$inc': {'total': 1}})
+        return time.time() - start
+
+    baseline = update(updates)
+    view = database.create_collection('totals', viewOn='orders',
+        pipeline=pipeline)
+    incremental = update(updates)
+    applyTime = view.materializedView.stats()['applyTime']['total']
+    maintained = list(view.find())
+    view.materializedView.rebuild()
+    same = maintained == list(view.find())
+    # recompute the groups after each update, a tenth of the updates
+    count = max(1, updates // 10)
+    start = time.time()
+    for i in range(count):
+        collection.update({'_id': i}, {'$inc': {'total': 1}})
+        view.materializedView.rebuild()
+    recompute = (time.time() - start) * updates / count
+    return {'size': size,
+            'baseline': baseline,
+            'incremental': incremental,
+            'recompute': recompute,
+            'applyTime': applyTime,
+            'same': same}
+
+
+IMPORT_SCRIPT = """
+import m01.mongofake
+print(' '.join(sorted([name for name in m01.mongofake.LAZY_ATTRIBUTES
+                       if name in vars(m01.mongofake)])))
+"""
+
+
+def benchImportTime(repeat=5):
+    """Measure the self and cumulative import time of m01.mongofake in a
+    fresh interpreter, using cached bytecode like an installed package.
+
+    Returns the fastest run and the lazy attributes created by the import.
+    """
+    cache = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    # import from the same paths as this process, e.g. a develop egg
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    cmd = [sys.executable, '-X', 'importtime', '-X', 'pycache_prefix=' + cache,
+           '-c', IMPORT_SCRIPT]
+    try:
+        # the first run writes the bytecode cache
+        subprocess.check_output(cmd, env=env, stderr=subprocess.STDOUT)
+        timings = []
+        for i in range(repeat):
+            proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True)
+            out, err = proc.communicate()
+            for line in err.splitlines():
+                # import time: self [us] | cumulative | imported package
+                parts = [part.strip() for part in line.split('|')]
+                if len(parts) == 3 and parts[2] == 'm01.mongofake':
+                    own = int(parts[0].split(':')[1])
+                    timings.append((own / 1e6, int(parts[1]) / 1e6))
+    finally:
+        shutil.rmtree(cache)
+    own, cumulative = min(timings)
+    return {'size': repeat,
+            'self': own,
+            'cumulative': cumulative,
+            'created': out.split()}
+
+
+BENCHMARKS = [
+    benchRENormalizer,
+    benchDictify,
+    benchPrettyPrinter,
+    benchStorageMemory,
+    benchResultCache,
+    benchTextSearch,
+    benchGeoNear,
+    benchGridFS,
+    benchSharding,
+    benchReplicaReads,
+    benchImportTime,
+    benchJobClaim,
+    benchCountDistinct,
+    benchReplay,
+    benchWriteConcern,
+    benchCursorBatching,
+    benchFixtureLoad,
+    benchMemoryQuota,
+    benchMapReduce,
+    benchPerformanceModel,
+    benchCollStats,
+    benchMaterializedView,
+    ]
+
+
+def main(args=None):
+    for bench in BENCHMARKS:
+        res = bench()
+        timings = ', '.join([
+            '%s: %s' % (k, isinstance(v, float) and '%.4f' % v or v)
+            for k, v in sorted(res.items())
+            if k != 'size' and not isinstance(v, list)])
+        print('%s (size %s): %s' % (bench.__name__, res['size'], timings))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
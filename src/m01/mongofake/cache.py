@@ -0,0 +1,210 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Query result cache
+
+The ResultCache keeps the result of a query keyed by the BSON encoded query
+shape (spec, fields, sort, skip, limit). Each entry remembers the collection
+write version it was computed at. A write increments the collection version
+and outdated entries get dropped on their next lookup. The cache is bounded by
+the BSON size of the cached results and evicts the least recently used
+entries first.
+"""
+import collections
+import datetime
+import threading
+
+import bson.errors
+
+from m01.mongofake import encodeBSON
+
+
+def _readOnly(self, *args, **kwargs):
+    raise TypeError("%s is read only" % self.__class__.__name__)
+
+
+class FrozenDocument(dict):
+    """Read only document returned from the result cache"""
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = _readOnly
+    clear = pop = popitem = setdefault = update = _readOnly
+    __ior__ = _readOnly
+
+    def __copy__(self):
+        # a copy is a plain (writable) dict
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (), None, None, iter(dict.items(self)))
+
+
+class FrozenList(list):
+    """Read only list used for the values of a FrozenDocument"""
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = _readOnly
+    append = extend = insert = pop = remove = reverse = sort = _readOnly
+    clear = _readOnly
+    __iadd__ = __imul__ = _readOnly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(data):
+    """Return a read only copy of the given document"""
+    if isinstance(data, dict):
+        d = FrozenDocument()
+        for k, v in data.items():
+            dict.__setitem__(d, k, freeze(v))
+        return d
+    elif isinstance(data, list):
+        l = FrozenList()
+        list.extend(l, [freeze(v) for v in data])
+        return l
+    return data
+
+
+def thaw(data):
+    """Return a writable copy of a frozen document"""
+    if isinstance(data, dict):
+        return dict([(k, thaw(v)) for k, v in data.items()])
+    elif isinstance(data, list):
+        return [thaw(v) for v in data]
+    return data
+
+
+def _addTypeTags(value, tags):
+    # the BSON encoding doesn't distinguish a tuple from a list and a naive
+    # from an aware datetime but matching does, tag them in walk order
+    if isinstance(value, dict):
+        for v in value.values():
+            _addTypeTags(v, tags)
+    elif isinstance(value, (list, tuple)):
+        tags.append(isinstance(value, tuple) and b't' or b'l')
+        for v in value:
+            _addTypeTags(v, tags)
+    elif isinstance(value, datetime.datetime):
+        tags.append(value.tzinfo is None and b'n' or b'a')
+
+
+class ResultCache(object):
+    """LRU cache for query results bounded by the BSON size in bytes.
+
+    Entries are stored as (version, size, docs) where docs is a tuple of
+    FrozenDocument. Results larger than maxSize don't get cached.
+    """
+
+    def __init__(self, maxSize=32 * 1024 * 1024):
+        self.maxSize = maxSize
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.uncachable = 0
+
+    def getKey(self, spec, fields=None, sort=None, skip=0, limit=0):
+        """Return the BSON encoded query shape with the type tags of its
+        sequences and datetimes or None if not encodable"""
+        tags = []
+        _addTypeTags(spec, tags)
+        if fields is not None:
+            fields = [[k, v] for k, v in fields.items()]
+        if sort is not None:
+            sort = [list(s) for s in sort]
+        try:
+            key = encodeBSON({'spec': spec, 'fields': fields, 'sort': sort,
+                              'skip': skip, 'limit': limit})
+        except (bson.errors.InvalidDocument, TypeError):
+            self.uncachable += 1
+            return None
+        return key + b''.join(tags)
+
+    def get(self, key, version):
+        """Return the cached docs or None if missing or outdated"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != version:
+                # written since, drop it
+                self.size -= entry[1]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            # mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, version, docs):
+        """Freeze and cache the docs and return the frozen docs"""
+        try:
+            size = len(key) + sum([len(encodeBSON(doc)) for doc in docs])
+        except (bson.errors.InvalidDocument, TypeError):
+            self.uncachable += 1
+            return docs
+        docs = tuple([freeze(doc) for doc in docs])
+        if size > self.maxSize:
+            self.uncachable += 1
+            return docs
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            while self._entries and self.size + size > self.maxSize:
+                k, entry = self._entries.popitem(last=False)
+                self.size -= entry[1]
+                self.evictions += 1
+            self._entries[key] = (version, size, docs)
+            self.size += size
+        return docs
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return the cache metrics"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {'maxSize': self.maxSize,
+                    'size': self.size,
+                    'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRatio': total and float(self.hits) / total or 0.0,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'uncachable': self.uncachable}
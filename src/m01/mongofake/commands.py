@@ -0,0 +1,165 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Database commands
+
+FakeDatabase.command supports the statistic commands used by monitoring code:
+
+- collStats, the document count, data size, average object size and the
+  size and key count of each index of a collection
+
+- dbStats, the sums of the collection statistics of a database
+
+- serverStatus, the opcounters and the latency histograms (opLatencies) of
+  the client and the open cursors
+
+- ping
+
+The statistics don't scan the documents. The collection write funnel keeps
+the data size (BSON size) and the indexes keep their key counts and
+estimated sizes. The client counts the collection operations and their
+latency.
+"""
+import datetime
+import os
+import time
+
+import bson.son
+import pymongo.errors
+
+from m01.mongofake import string_types
+from m01.mongofake import toUnicode
+
+
+def _getScale(spec):
+    scale = spec.get('scale', 1)
+    if not isinstance(scale, int) or isinstance(scale, bool) or scale < 1:
+        raise pymongo.errors.OperationFailure("scale has to be >= 1", 2)
+    return scale
+
+
+def _getIndexStats(collection):
+    # return {index name: (key count, size)} including the _id index
+    count = len(collection.docs)
+    dataSize, idIndexSize = collection._getSizes()
+    res = {u'_id_': (count, idIndexSize)}
+    with collection._client._lock:
+        for name, index in collection._indexes.items():
+            res[name] = (index.keyCount, index.size)
+    return res
+
+
+def collStats(database, spec):
+    name = spec['collStats']
+    if not isinstance(name, string_types):
+        raise pymongo.errors.OperationFailure(
+            "collection name has invalid type %s" % type(name).__name__, 73)
+    scale = _getScale(spec)
+    collection = database.cols.get(toUnicode(name))
+    if collection is None:
+        raise pymongo.errors.OperationFailure(
+            "Collection [%s.%s] not found." % (database.name, name), 26)
+    count = len(collection.docs)
+    size = collection._getSizes()[0]
+    indexes = _getIndexStats(collection)
+    return {'ns': u'%s.%s' % (database.name, collection.name),
+            'size': size // scale,
+            'count': count,
+            'avgObjSize': count and size // count or 0,
+            'storageSize': size // scale,
+            'capped': False,
+            'nindexes': len(indexes),
+            'totalIndexSize': sum([s for c, s in indexes.values()]) // scale,
+            'indexSizes': dict([(n, s // scale)
+                                for n, (c, s) in indexes.items()]),
+            'indexKeys': dict([(n, c) for n, (c, s) in indexes.items()]),
+            'scaleFactor': scale,
+            'ok': 1.0}
+
+
+def dbStats(database, spec):
+    scale = _getScale(spec)
+    objects = dataSize = indexes = indexSize = 0
+    collections = list(database.cols.values())
+    views = len([c for c in collections if c._view is not None])
+    for collection in collections:
+        objects += len(collection.docs)
+        dataSize += collection._getSizes()[0]
+        stats = _getIndexStats(collection)
+        indexes += len(stats)
+        indexSize += sum([s for c, s in stats.values()])
+    return {'db': database.name,
+            'collections': len(collections) - views,
+            'views': views,
+            'objects': objects,
+            'avgObjSize': objects and float(dataSize) / objects or 0,
+            'dataSize': dataSize // scale,
+            'storageSize': dataSize // scale,
+            'indexes': indexes,
+            'indexSize': indexSize // scale,
+            'scaleFactor': scale,
+            'ok': 1.0}
+
+
+def serverStatus(database, spec):
+    client = database.connection
+    opStats = client._opStats
+    with opStats._lock:
+        opcounters = dict(opStats.opcounters)
+    uptime = time.time() - client._started
+    res = {'host': '%s:%s' % (client.host, client.port),
+           'process': 'mongod',
+           'pid': os.getpid(),
+           'uptime': int(uptime),
+           'uptimeMillis': int(uptime * 1000),
+           'localTime': datetime.datetime.utcnow(),
+           'opcounters': opcounters,
+           'opLatencies': opStats.getOpLatencies(),
+           'ok': 1.0}
+    if client._cursors is not None:
+        stats = client._cursors.stats()
+        res['metrics'] = {'cursor': {
+            'open': {'total': stats['open'], 'noTimeout': stats['noTimeout']},
+            'timedOut': stats['reaped']}}
+    return res
+
+
+def ping(database, spec):
+    return {'ok': 1.0}
+
+
+# command name: function(database, spec)
+COMMANDS = {
+    'collStats': collStats,
+    'collstats': collStats,
+    'dbStats': dbStats,
+    'dbstats': dbStats,
+    'serverStatus': serverStatus,
+    'ping': ping,
+    }
+
+
+def runCommand(database, command, value=1, kwargs=None):
+    """Run a command given as name (with value and kwargs) or document"""
+    if isinstance(command, string_types):
+        command = bson.son.SON([(command, value)])
+        command.update(kwargs or {})
+    name = next(iter(command))
+    func = COMMANDS.get(name)
+    if func is None:
+        raise pymongo.errors.OperationFailure(
+            "no such command: '%s'" % name, 59)
+    if func is collStats and name != 'collStats':
+        command = dict(command)
+        command['collStats'] = command.pop(name)
+    return func(database, command)
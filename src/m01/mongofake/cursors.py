@@ -0,0 +1,177 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Server-side cursors
+
+A FakeCursor returns the first batch of its result and keeps the remaining
+result in a ServerCursor registered by id in the CursorRegistry of the
+client. Each getMore produces (copies and projects) the documents of the
+next batch only. The remaining result references the stored documents, it
+doesn't contain copies.
+
+The registry frees cursors which were not used for timeout seconds unless
+they got opened with no_cursor_timeout. The reaper thread only runs while
+cursors are open.
+"""
+import itertools
+import sys
+import threading
+import time
+
+import pymongo.errors
+
+from m01.mongofake import encodeBSON
+
+try:
+    CursorNotFound = pymongo.errors.CursorNotFound
+except AttributeError:
+    # pymongo < 3.0
+    CursorNotFound = pymongo.errors.OperationFailure
+
+# like cursorTimeoutMillis in MongoDB
+DEFAULT_TIMEOUT = 600.0
+
+
+class ServerCursor(object):
+    """The remaining result of a query.
+
+    The items are (key, doc) tuples produced with the produce function or
+    already produced documents if produce is None.
+    """
+
+    def __init__(self, id, namespace, items, produce=None, noTimeout=False):
+        self.id = id
+        self.namespace = namespace
+        self.items = items
+        self.produce = produce
+        self.noTimeout = noTimeout
+        self.pos = 0
+        self.lastUsed = time.time()
+
+    @property
+    def remaining(self):
+        return len(self.items) - self.pos
+
+    def next(self, size):
+        """Return the next size items, not produced yet"""
+        items = self.items[self.pos:self.pos + size]
+        self.pos += len(items)
+        self.lastUsed = time.time()
+        return items
+
+    def retainedBytes(self):
+        """Return the estimated memory of the remaining result"""
+        size = sys.getsizeof(self.items)
+        if self.produce is None:
+            # copies from the result cache
+            for doc in self.items[self.pos:]:
+                size += len(encodeBSON(doc))
+        return size
+
+
+class CursorRegistry(object):
+    """Open server-side cursors of a client by cursor id"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, interval=None):
+        # idle seconds before a cursor gets reaped and the reaper interval
+        self.timeout = timeout
+        self.interval = interval
+        self.cursors = {}
+        self.opened = 0
+        self.closed = 0
+        self.reaped = 0
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def open(self, namespace, items, produce=None, noTimeout=False):
+        """Register the remaining result and return the ServerCursor"""
+        with self._cond:
+            cursor = ServerCursor(next(self._ids), namespace, items, produce,
+                noTimeout)
+            self.cursors[cursor.id] = cursor
+            self.opened += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='m01.mongofake cursor reaper')
+                self._thread.daemon = True
+                self._thread.start()
+            return cursor
+
+    def getMore(self, id, size):
+        """Return the next batch and True if the cursor got exhausted"""
+        with self._cond:
+            cursor = self.cursors.get(id)
+            if cursor is None:
+                raise CursorNotFound("cursor id %d not found" % id, 43)
+            # reserve the batch, produce it without holding the lock
+            items = cursor.next(size)
+            exhausted = not cursor.remaining
+            if exhausted:
+                del self.cursors[id]
+                self.closed += 1
+        if cursor.produce is not None:
+            items = [cursor.produce(item) for item in items]
+        return items, exhausted
+
+    def close(self, id):
+        """Free a cursor, returns False if it doesn't exist"""
+        with self._cond:
+            if self.cursors.pop(id, None) is None:
+                return False
+            self.closed += 1
+            return True
+
+    def reap(self, now=None):
+        """Free the cursors idle for more than timeout seconds"""
+        if now is None:
+            now = time.time()
+        with self._cond:
+            idle = [c.id for c in self.cursors.values()
+                    if not c.noTimeout and now - c.lastUsed > self.timeout]
+            for id in idle:
+                del self.cursors[id]
+            self.reaped += len(idle)
+            return len(idle)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self.cursors:
+                    self._thread = None
+                    return
+                interval = self.interval
+                if interval is None:
+                    interval = min(self.timeout / 2.0, 60.0)
+                self._cond.wait(interval)
+            self.reap()
+
+    def wakeup(self):
+        """Let the reaper check the cursors now, e.g. after changing the
+        timeout"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return the open cursor counts and the retained memory"""
+        with self._cond:
+            cursors = list(self.cursors.values())
+            return {'open': len(cursors),
+                    'noTimeout': len([c for c in cursors if c.noTimeout]),
+                    'retainedDocuments': sum([c.remaining for c in cursors]),
+                    'retainedBytes': sum([c.retainedBytes()
+                                          for c in cursors]),
+                    'opened': self.opened,
+                    'closed': self.closed,
+                    'reaped': self.reaped,
+                    'timeout': self.timeout}
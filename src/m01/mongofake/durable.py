@@ -0,0 +1,357 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Write-ahead log
+
+The WriteAheadLog makes a fake client durable. Each committed write and each
+command (e.g. create_index) gets appended as BSON record with an increasing
+log sequence number (lsn) to the log file in the data directory.
+
+The writes of a committed transaction get logged as one record with all its
+operations (like applyOps), the log never contains a partial transaction.
+
+Appending only buffers the record. A write with the j write concern waits
+until its record got fsynced. Concurrent writers share one fsync (group
+commit), the first waiting writer writes and fsyncs all buffered records for
+the others. A background thread fsyncs the buffer every commitInterval
+seconds like the MongoDB journal does and writes a checkpoint after
+checkpointEvery records.
+
+A checkpoint writes all documents and index definitions with the lsn of the
+last included record to a new checkpoint file, atomically replaces the old
+one and truncates the log. Recovery loads the last checkpoint and replays
+the complete log records after its lsn, a torn last record gets dropped.
+"""
+import io
+import os
+import struct
+import threading
+import time
+
+import bson
+import bson.errors
+
+from m01.mongofake import MISSING
+from m01.mongofake import decodeBSON
+from m01.mongofake import encodeBSON
+
+INT32 = struct.Struct('<i')
+
+LOG_NAME = 'wal.log'
+CHECKPOINT_NAME = 'checkpoint.bson'
+
+
+def readRecords(path):
+    """Iterate the complete BSON records of a file"""
+    if not os.path.exists(path):
+        return
+    with io.open(path, 'rb') as f:
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                return
+            size = INT32.unpack(head)[0]
+            body = f.read(size - 4)
+            if len(body) < size - 4:
+                # torn write of the last record
+                return
+            try:
+                yield decodeBSON(head + body)
+            except bson.errors.InvalidBSON:
+                return
+
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _tuples(keys):
+    # index keys get stored as lists
+    return [tuple(key) for key in keys]
+
+
+class WriteAheadLog(object):
+    """Write-ahead log with group commit and checkpoints.
+
+    Use FakeMongoClient.enableDurability to recover and enable the log.
+    """
+
+    def __init__(self, client, path, commitInterval=0.1,
+        checkpointEvery=10000, journal=False):
+        self.client = client
+        self.path = path
+        self.commitInterval = commitInterval
+        self.checkpointEvery = checkpointEvery
+        # default j write concern
+        self.journal = journal
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.logPath = os.path.join(path, LOG_NAME)
+        self.checkpointPath = os.path.join(path, CHECKPOINT_NAME)
+        self.lsn = 0
+        self.durableLsn = 0
+        self.checkpointLsn = 0
+        # (db, collection, name): (keys, kwargs)
+        self.indexes = {}
+        # metrics
+        self.appended = 0
+        self.syncs = 0
+        self.checkpoints = 0
+        self.bytes = 0
+        self.recovered = 0
+        self._buffer = []
+        # the write records of the committing transaction or None
+        self._batch = None
+        self._syncing = False
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._log = None
+        self._stopped = False
+        self._thread = None
+
+    # recovery
+    def recover(self):
+        """Load the checkpoint and replay the log, returns the number of
+        replayed log records"""
+        client = self.client
+        with client._lock:
+            header = None
+            for record in readRecords(self.checkpointPath):
+                if header is None:
+                    header = record
+                    self.lsn = self.checkpointLsn = record['lsn']
+                    for db, name, index, keys, kwargs in record['indexes']:
+                        self.indexes[(db, name, index)] = (_tuples(keys),
+                            kwargs)
+                else:
+                    collection = client[record['db']][record['c']]
+                    collection._commit(record['k'], record['d'],
+                        client._tick())
+            for (db, name, index), (keys, kwargs) in self.indexes.items():
+                client[db][name].create_index(keys, name=index, **kwargs)
+            count = 0
+            for record in readRecords(self.logPath):
+                if record['lsn'] <= self.lsn:
+                    continue
+                self._replay(record)
+                self.lsn = record['lsn']
+                count += 1
+            self.durableLsn = self.lsn
+            self.recovered = count
+        # rewrite the log without a torn record
+        self.checkpoint()
+        return count
+
+    def _replay(self, record):
+        client = self.client
+        if record['op'] == 'a':
+            # the writes of a transaction
+            for op in record['ops']:
+                self._replay(op)
+        elif record['op'] == 'c':
+            target = client
+            if record['db'] is not None:
+                target = client[record['db']]
+            if record['c'] is not None:
+                target = target[record['c']]
+            args = record['args']
+            if record['cmd'] == 'create_index':
+                args = [_tuples(args[0])] + args[1:]
+            getattr(target, record['cmd'])(*args, **record['kwargs'])
+            self._trackIndexes(record)
+        else:
+            collection = client[record['db']][record['c']]
+            collection._commit(record['k'], record.get('d', MISSING),
+                client._tick())
+
+    def _trackIndexes(self, record):
+        # keep the index definitions for the checkpoint
+        cmd = record['cmd']
+        db, name = record['db'], record['c']
+        if cmd == 'create_index':
+            kwargs = dict(record['kwargs'])
+            index = kwargs.pop('name')
+            self.indexes[(db, name, index)] = (_tuples(record['args'][0]),
+                kwargs)
+        elif cmd == 'drop_index':
+            self.indexes.pop((db, name, record['args'][0]), None)
+        elif cmd in ('drop_indexes', 'drop_database'):
+            if cmd == 'drop_database':
+                db = record['args'][0]
+            for key in list(self.indexes):
+                if key[0] == db and (name is None or key[1] == name):
+                    del self.indexes[key]
+
+    def start(self):
+        """Open the log and start the commit thread"""
+        if self._log is None:
+            self._log = io.open(self.logPath, 'ab')
+        self._thread = threading.Thread(target=self._run,
+            name='m01.mongofake wal %s' % self.path)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # logging, the client lock is acquired
+    def _append(self, record):
+        with self._cond:
+            self.lsn += 1
+            record['lsn'] = self.lsn
+            data = encodeBSON(record)
+            self._buffer.append(data)
+            self.appended += 1
+            self.bytes += len(data)
+            self._local.lsn = self.lsn
+            return self.lsn
+
+    def logWrite(self, collection, key, doc, ts):
+        record = {'op': 'w', 'db': collection.database.name,
+                  'c': collection.name, 'k': key}
+        if doc is not MISSING:
+            record['d'] = doc
+        if self._batch is not None:
+            # logged with the transaction
+            self._batch.append(record)
+            return None
+        return self._append(record)
+
+    def beginTransaction(self):
+        """Collect the writes of a committing transaction"""
+        self._batch = []
+
+    def commitTransaction(self):
+        """Log the collected writes as one record"""
+        ops, self._batch = self._batch, None
+        if ops:
+            return self._append({'op': 'a', 'ops': ops})
+
+    def logCommand(self, db, collection, command, *args, **kwargs):
+        record = {'op': 'c', 'db': db, 'c': collection, 'cmd': command,
+                  'args': list(args), 'kwargs': kwargs}
+        self._trackIndexes(record)
+        return self._append(record)
+
+    # group commit
+    def sync(self, lsn=None):
+        """Wait until the record with the given lsn (default the last record
+        of this thread) is durable"""
+        if lsn is None:
+            lsn = getattr(self._local, 'lsn', 0)
+        with self._cond:
+            while self.durableLsn < lsn:
+                if self._syncing:
+                    # another writer flushes, it may include our record
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                target = self.lsn
+                data = self._buffer
+                self._buffer = []
+                break
+            else:
+                return
+        try:
+            if data:
+                self._log.write(b''.join(data))
+            _fsync(self._log)
+        finally:
+            with self._cond:
+                self.durableLsn = max(self.durableLsn, target)
+                self._syncing = False
+                self.syncs += 1
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(self.commitInterval)
+                if self._stopped:
+                    return
+                pending = self.lsn > self.durableLsn
+            if pending:
+                self.sync(self.lsn)
+            if self.lsn - self.checkpointLsn >= self.checkpointEvery:
+                self.checkpoint()
+
+    # checkpoints
+    def checkpoint(self):
+        """Write all documents to a new checkpoint and truncate the log"""
+        with self.client._lock:
+            with self._cond:
+                while self._syncing:
+                    self._cond.wait()
+                # block group commits, the checkpoint replaces the log
+                self._syncing = True
+                lsn = self.lsn
+                self._buffer = []
+            try:
+                self._checkpoint(lsn)
+            finally:
+                with self._cond:
+                    self._syncing = False
+                    self._cond.notify_all()
+
+    def _checkpoint(self, lsn):
+        client = self.client
+        indexes = [[db, name, index, keys, kwargs]
+                   for (db, name, index), (keys, kwargs)
+                   in sorted(self.indexes.items())]
+        tmp = self.checkpointPath + '.tmp'
+        with io.open(tmp, 'wb') as f:
+            f.write(encodeBSON({'lsn': lsn, 'time': time.time(),
+                                'indexes': indexes}))
+            for dbName in client.database_names():
+                db = client[dbName]
+                for name in db.collection_names():
+                    for key, doc in db[name].docs.items():
+                        f.write(encodeBSON({'db': dbName, 'c': name,
+                                            'k': key, 'd': doc}))
+            _fsync(f)
+        os.rename(tmp, self.checkpointPath)
+        # all records are in the checkpoint
+        if self._log is not None:
+            self._log.close()
+        self._log = io.open(self.logPath, 'wb')
+        _fsync(self._log)
+        with self._cond:
+            self.checkpointLsn = self.durableLsn = lsn
+            self.checkpoints += 1
+
+    def close(self):
+        """Stop the commit thread and make all records durable"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._log is not None:
+            self.sync(self.lsn)
+            self._log.close()
+            self._log = None
+
+    def stats(self):
+        with self._cond:
+            return {'path': self.path,
+                    'lsn': self.lsn,
+                    'durableLsn': self.durableLsn,
+                    'checkpointLsn': self.checkpointLsn,
+                    'appended': self.appended,
+                    'syncs': self.syncs,
+                    # records per fsync
+                    'groupSize': self.syncs and
+                        float(self.appended) / self.syncs or 0.0,
+                    'checkpoints': self.checkpoints,
+                    'bytes': self.bytes,
+                    'recovered': self.recovered}
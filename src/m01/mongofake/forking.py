@@ -0,0 +1,52 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Forked worker processes
+
+The parallel replay, fixture generation and map reduce pass state to their
+worker processes which can't get pickled, e.g. a fake client or Python
+functions. The pools fork their workers and pass the state of the call as
+initializer argument, a forked process inherits it without pickling. Each
+worker process keeps the state of its own pool, concurrent calls from
+threads of the parent process don't share it.
+"""
+import concurrent.futures
+import multiprocessing
+
+# the state of the pool of this worker process
+_state = None
+
+
+def _setState(state):
+    global _state
+    _state = state
+
+
+def getState():
+    """Return the state passed to the pool of the worker process"""
+    return _state
+
+
+def forkPool(processes, state):
+    """Return a multiprocessing pool of forked worker processes with the
+    given state"""
+    return multiprocessing.get_context('fork').Pool(processes, _setState,
+        (state,))
+
+
+def forkExecutor(processes, state):
+    """Return a process pool executor of forked worker processes with the
+    given state"""
+    return concurrent.futures.ProcessPoolExecutor(processes,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_setState, initargs=(state,))
@@ -0,0 +1,358 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Synthetic fixture generator
+
+A FixtureGenerator generates documents from a template and bulk loads them
+into a FakeCollection. The template maps field names to field specs:
+
+- a value which is not a dict is a constant
+
+- a dict without a type is a nested document template
+
+- {'type': 'objectId'} allocates the ObjectIds from the document number,
+  secs sets a timestamp (see getObjectIds)
+
+- {'type': 'sequence', 'start': 0, 'step': 1}
+
+- {'type': 'int', 'min': 0, 'max': 100} and {'type': 'float', ...}, the
+  distribution is 'uniform' (default), 'normal' (with mean and stddev,
+  clipped to min and max) or 'zipf' (with s, the values min to max ranked by
+  their distance to min)
+
+- {'type': 'bool', 'p': 0.5}, p is the probability of True
+
+- {'type': 'choice', 'values': [...], 'weights': [...]}
+
+- {'type': 'string', 'length': 8, 'alphabet': u'abc...'} or with a
+  format like u'user-%d' and a cardinality
+
+- {'type': 'date', 'start': datetime, 'end': datetime}
+
+- {'type': 'array', 'items': spec, 'min': 0, 'max': 5}
+
+- {'type': 'document', 'fields': template}
+
+A cardinality limits a scalar field to cardinality values which get drawn
+with the distribution ('uniform' or 'zipf'), e.g. a field with few distinct
+values for index benchmarks.
+
+The documents get generated in batches, column by column. Each batch uses its
+own random generator seeded from the seed and the batch number, the output
+only depends on the seed and the batch size. The batches can get generated in
+any order and in parallel processes.
+"""
+import abc
+import datetime
+import math
+import random
+
+import bson.tz_util
+import six
+
+from m01.mongofake import getObjectIds
+from m01.mongofake import toUnicode
+from m01.mongofake.forking import forkPool
+from m01.mongofake.forking import getState
+
+ALPHABET = u'abcdefghijklmnopqrstuvwxyz'
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=bson.tz_util.utc)
+# default date range, not depending on the current time
+DATE_START = datetime.datetime(2000, 1, 1, tzinfo=bson.tz_util.utc)
+DATE_END = datetime.datetime(2020, 1, 1, tzinfo=bson.tz_util.utc)
+
+
+def _zipfWeights(size, s):
+    # cumulative weights of the ranks 1 to size
+    weights = []
+    total = 0.0
+    for rank in range(1, size + 1):
+        total += 1.0 / rank ** s
+        weights.append(total)
+    return weights
+
+
+def _toMillis(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=bson.tz_util.utc)
+    return int((value - EPOCH).total_seconds() * 1000)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Field(object):
+    """Generates the values of a field for a batch"""
+
+    def __init__(self, path, spec, seed):
+        self.path = path
+        self.spec = spec
+        self.seed = seed
+
+    @abc.abstractmethod
+    def column(self, rng, start, count):
+        """Return the values of count documents starting at start"""
+
+
+class Constant(Field):
+
+    def column(self, rng, start, count):
+        return [self.spec] * count
+
+
+class ObjectIdField(Field):
+
+    def column(self, rng, start, count):
+        return getObjectIds(start, count, self.spec.get('secs'))
+
+
+class SequenceField(Field):
+
+    def column(self, rng, start, count):
+        first = self.spec.get('start', 0)
+        step = self.spec.get('step', 1)
+        return list(range(first + start * step,
+                          first + (start + count) * step, step))
+
+
+class NumberField(Field):
+
+    def __init__(self, path, spec, seed):
+        super(NumberField, self).__init__(path, spec, seed)
+        self.min = spec.get('min', 0)
+        self.max = spec.get('max', 100)
+        self.distribution = spec.get('distribution', 'uniform')
+        if self.distribution == 'zipf':
+            self.weights = _zipfWeights(int(self.max - self.min) + 1,
+                spec.get('s', 1.0))
+        elif self.distribution not in ('uniform', 'normal'):
+            raise ValueError("unknown distribution %r" % self.distribution)
+
+    def column(self, rng, start, count):
+        low, high = self.min, self.max
+        if self.distribution == 'zipf':
+            ranks = rng.choices(range(len(self.weights)),
+                cum_weights=self.weights, k=count)
+            return [low + r for r in ranks]
+        if self.distribution == 'normal':
+            mean = self.spec.get('mean', (low + high) / 2.0)
+            stddev = self.spec.get('stddev', (high - low) / 6.0)
+            gauss = rng.gauss
+            values = [min(max(gauss(mean, stddev), low), high)
+                      for i in range(count)]
+        else:
+            rand = rng.random
+            size = high - low
+            if self.spec['type'] == 'int':
+                size += 1
+            values = [low + rand() * size for i in range(count)]
+        if self.spec['type'] == 'int':
+            # floor, int() would round negative values up to zero
+            return [int(math.floor(v)) for v in values]
+        return values
+
+
+class BoolField(Field):
+
+    def column(self, rng, start, count):
+        p = self.spec.get('p', 0.5)
+        rand = rng.random
+        return [rand() < p for i in range(count)]
+
+
+class ChoiceField(Field):
+
+    def column(self, rng, start, count):
+        return rng.choices(self.spec['values'], self.spec.get('weights'),
+            k=count)
+
+
+class StringField(Field):
+
+    def column(self, rng, start, count):
+        format = self.spec.get('format')
+        if format is not None:
+            # a unique value per document
+            return [format % i for i in range(start, start + count)]
+        length = self.spec.get('length', 8)
+        alphabet = self.spec.get('alphabet', ALPHABET)
+        choices = rng.choices
+        join = u''.join
+        return [join(choices(alphabet, k=length)) for i in range(count)]
+
+
+class DateField(Field):
+
+    def __init__(self, path, spec, seed):
+        super(DateField, self).__init__(path, spec, seed)
+        # BSON dates have millisecond precision
+        self.start = _toMillis(spec.get('start', DATE_START))
+        self.end = _toMillis(spec.get('end', DATE_END))
+
+    def column(self, rng, start, count):
+        rand = rng.random
+        size = self.end - self.start
+        delta = datetime.timedelta
+        return [EPOCH + delta(milliseconds=self.start + int(rand() * size))
+                for i in range(count)]
+
+
+class ArrayField(Field):
+
+    def __init__(self, path, spec, seed):
+        super(ArrayField, self).__init__(path, spec, seed)
+        self.items = getField(path + '.$', spec['items'], seed)
+
+    def column(self, rng, start, count):
+        low = self.spec.get('min', 0)
+        high = self.spec.get('max', 5)
+        randint = rng.randint
+        lengths = [randint(low, high) for i in range(count)]
+        # generate the items of all arrays at once
+        items = self.items.column(rng, start, sum(lengths))
+        res = []
+        append = res.append
+        pos = 0
+        for length in lengths:
+            append(items[pos:pos + length])
+            pos += length
+        return res
+
+
+class DocumentField(Field):
+
+    def __init__(self, path, spec, seed):
+        super(DocumentField, self).__init__(path, spec, seed)
+        fields = spec.get('fields', spec) if spec.get('type') else spec
+        self.names = [toUnicode(name) for name in fields]
+        self.fields = [getField(path and '%s.%s' % (path, name) or name,
+                                fields[name], seed) for name in fields]
+
+    def column(self, rng, start, count):
+        names = self.names
+        columns = [field.column(rng, start, count) for field in self.fields]
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+class CardinalityField(Field):
+    """Draws the values of a field from a fixed pool of values"""
+
+    def __init__(self, path, spec, seed):
+        super(CardinalityField, self).__init__(path, spec, seed)
+        spec = dict(spec)
+        size = spec.pop('cardinality')
+        distribution = spec.pop('distribution', 'uniform')
+        if spec.get('type') == 'string' and spec.get('format'):
+            self.pool = [spec['format'] % i for i in range(size)]
+        else:
+            # the pool only depends on the seed and the field
+            rng = random.Random('%s:%s' % (seed, path))
+            self.pool = getField(path, spec, seed).column(rng, 0, size)
+        self.weights = None
+        if distribution == 'zipf':
+            self.weights = _zipfWeights(size, self.spec.get('s', 1.0))
+        elif distribution != 'uniform':
+            raise ValueError("unknown distribution %r" % distribution)
+
+    def column(self, rng, start, count):
+        if self.weights is None:
+            return rng.choices(self.pool, k=count)
+        return rng.choices(self.pool, cum_weights=self.weights, k=count)
+
+
+FIELD_TYPES = {
+    'objectId': ObjectIdField,
+    'sequence': SequenceField,
+    'int': NumberField,
+    'float': NumberField,
+    'bool': BoolField,
+    'choice': ChoiceField,
+    'string': StringField,
+    'date': DateField,
+    'array': ArrayField,
+    'document': DocumentField,
+    }
+
+
+def getField(path, spec, seed=0):
+    """Return the Field generating the values of a field spec"""
+    if not isinstance(spec, dict):
+        return Constant(path, spec, seed)
+    kind = spec.get('type')
+    if kind is None:
+        return DocumentField(path, spec, seed)
+    if kind not in FIELD_TYPES:
+        raise ValueError("unknown field type %r for %s" % (kind, path))
+    if 'cardinality' in spec:
+        return CardinalityField(path, spec, seed)
+    return FIELD_TYPES[kind](path, spec, seed)
+
+
+class FixtureGenerator(object):
+    """Generate documents from a template in deterministic batches"""
+
+    def __init__(self, template, seed=0, batchSize=1000):
+        if '_id' not in template:
+            # _id first like in MongoDB
+            template = dict([('_id', {'type': 'objectId'})] +
+                            list(template.items()))
+        self.template = template
+        self.seed = seed
+        self.batchSize = batchSize
+        self.root = DocumentField('', template, seed)
+
+    def batch(self, number, count=None):
+        """Return the documents of a batch, the last batch of count
+        documents can be smaller"""
+        start = number * self.batchSize
+        size = self.batchSize
+        if count is not None:
+            size = max(0, min(size, count - start))
+        rng = random.Random('%s:%s' % (self.seed, number))
+        return self.root.column(rng, start, size)
+
+    def batches(self, count):
+        """Return the number of batches for count documents"""
+        return (count + self.batchSize - 1) // self.batchSize
+
+    def generate(self, count):
+        """Iterate the documents in batches"""
+        for number in range(self.batches(count)):
+            for doc in self.batch(number, count):
+                yield doc
+
+    def load(self, collection, count, processes=1):
+        """Generate count documents and bulk load them into the collection.
+
+        With processes > 1 forked worker processes generate the batches and
+        the parent process loads them in batch order. Returns the number of
+        loaded documents.
+        """
+        numbers = range(self.batches(count))
+        loaded = 0
+        if processes > 1:
+            pool = forkPool(processes, (self, count))
+            try:
+                for docs in pool.imap(_runBatch, numbers):
+                    loaded += collection.bulkLoad(docs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for number in numbers:
+                loaded += collection.bulkLoad(self.batch(number, count))
+        return loaded
+
+
+def _runBatch(number):
+    # worker process, the state is the generator and the document count
+    generator, count = getState()
+    return generator.batch(number, count)
@@ -0,0 +1,657 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Geospatial index
+
+The GeoIndex splits the plane (2d) or the longitude/latitude space (2dsphere)
+into a grid of square cells and keeps the document keys per cell. The index
+gets maintained by the collection write funnel.
+
+$near visits the cells ring by ring around the query point and returns the
+documents ordered by distance. A document gets returned as soon as no cell
+outside the visited rings can contain a closer one, so the search stops
+early if the cursor doesn't need more documents. $geoWithin and
+$geoIntersects only test the documents in the cells covering the bounding
+box of the query shape.
+
+Note: polygon edges are straight lines in the longitude/latitude plane, not
+geodesics like in MongoDB.
+"""
+import heapq
+import math
+
+import pymongo.errors
+import six
+
+from m01.mongofake import INDEX_ENTRY_SIZE
+from m01.mongofake import NOVALUEMARKER
+from m01.mongofake import getField
+from m01.mongofake import getKeySize
+
+# the earth radius in meters used by MongoDB
+EARTH_RADIUS = 6378100.0
+
+INF = float('inf')
+
+
+def _badValue(msg):
+    return pymongo.errors.OperationFailure(msg, 2)
+
+
+###############################################################################
+#
+# geometries, a shape is (kind, coordinates) with the kinds point (x, y),
+# line [(x, y), ...] and polygon [[(x, y), ...], ...] (outer ring and holes)
+#
+###############################################################################
+
+def _isNumber(value):
+    return (isinstance(value, six.integer_types + (float,)) and
+            not isinstance(value, bool))
+
+
+def _point(value):
+    # return a legacy coordinate pair as (x, y) or None
+    if isinstance(value, dict):
+        value = list(value.values())
+    if (isinstance(value, (list, tuple)) and len(value) == 2 and
+        _isNumber(value[0]) and _isNumber(value[1])):
+        return (float(value[0]), float(value[1]))
+    return None
+
+
+def _points(coordinates):
+    return [p for p in [_point(c) for c in coordinates] if p is not None]
+
+
+def parseGeometry(value):
+    """Return the shapes of a GeoJSON geometry or legacy coordinates.
+
+    Arrays of locations return all their shapes, invalid values none.
+    """
+    point = _point(value)
+    if point is not None:
+        return [('point', point)]
+    if isinstance(value, dict):
+        kind = value.get('type')
+        coordinates = value.get('coordinates')
+        if kind == 'GeometryCollection':
+            shapes = []
+            for geometry in value.get('geometries', ()):
+                shapes.extend(parseGeometry(geometry))
+            return shapes
+        if not isinstance(coordinates, (list, tuple)):
+            return []
+        if kind == 'Point':
+            point = _point(coordinates)
+            return point is not None and [('point', point)] or []
+        elif kind == 'MultiPoint':
+            return [('point', p) for p in _points(coordinates)]
+        elif kind == 'LineString':
+            return [('line', _points(coordinates))]
+        elif kind == 'MultiLineString':
+            return [('line', _points(c)) for c in coordinates]
+        elif kind == 'Polygon':
+            return [('polygon', [_points(ring) for ring in coordinates])]
+        elif kind == 'MultiPolygon':
+            return [('polygon', [_points(ring) for ring in polygon])
+                    for polygon in coordinates]
+        return []
+    if isinstance(value, (list, tuple)):
+        # array of locations
+        shapes = []
+        for v in value:
+            shapes.extend(parseGeometry(v))
+        return shapes
+    return []
+
+
+def _vertices(shape):
+    kind, coordinates = shape
+    if kind == 'point':
+        return [coordinates]
+    elif kind == 'line':
+        return coordinates
+    return [p for ring in coordinates for p in ring]
+
+
+def _edges(shape):
+    kind, coordinates = shape
+    if kind == 'point':
+        return [(coordinates, coordinates)]
+    elif kind == 'line':
+        return list(zip(coordinates[:-1], coordinates[1:]))
+    edges = []
+    for ring in coordinates:
+        edges.extend(zip(ring[:-1], ring[1:]))
+    return edges
+
+
+def bbox(shape):
+    """Return (minX, minY, maxX, maxY) of a shape"""
+    points = _vertices(shape)
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _inRing(point, ring):
+    # ray casting
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 > y) != (y2 > y):
+            if x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                inside = not inside
+    return inside
+
+
+def inPolygon(point, rings):
+    """Return True if the point is inside the polygon (outer ring, holes)"""
+    if not rings or not _inRing(point, rings[0]):
+        return False
+    for hole in rings[1:]:
+        if _inRing(point, hole):
+            return False
+    return True
+
+
+def _orientation(a, b, c):
+    value = (b[1] - a[1]) * (c[0] - b[0]) - (b[0] - a[0]) * (c[1] - b[1])
+    if value > 0:
+        return 1
+    elif value < 0:
+        return -1
+    return 0
+
+
+def _onSegment(a, b, p):
+    return (min(a[0], b[0]) <= p[0] <= max(a[0], b[0]) and
+            min(a[1], b[1]) <= p[1] <= max(a[1], b[1]))
+
+
+def segmentsIntersect(a, b, c, d):
+    """Return True if the segments a-b and c-d intersect"""
+    o1 = _orientation(a, b, c)
+    o2 = _orientation(a, b, d)
+    o3 = _orientation(c, d, a)
+    o4 = _orientation(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and _onSegment(a, b, c)) or
+            (o2 == 0 and _onSegment(a, b, d)) or
+            (o3 == 0 and _onSegment(c, d, a)) or
+            (o4 == 0 and _onSegment(c, d, b)))
+
+
+def intersects(shape, other):
+    """Return True if two shapes intersect"""
+    for a, b in ((shape, other), (other, shape)):
+        if b[0] == 'polygon':
+            for p in _vertices(a):
+                if inPolygon(p, b[1]):
+                    return True
+    for a, b in _edges(shape):
+        for c, d in _edges(other):
+            if segmentsIntersect(a, b, c, d):
+                return True
+    return False
+
+
+###############################################################################
+#
+# distances
+#
+###############################################################################
+
+def haversine(p1, p2):
+    """Return the angle in radians between two longitude/latitude points"""
+    lng1, lat1 = math.radians(p1[0]), math.radians(p1[1])
+    lng2, lat2 = math.radians(p2[0]), math.radians(p2[1])
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * math.asin(min(1.0, math.sqrt(a)))
+
+
+def distance(p1, p2, unit):
+    """Return the distance in the given unit (planar, radians or meters)"""
+    if unit == 'planar':
+        return math.hypot(p2[0] - p1[0], p2[1] - p1[1])
+    angle = haversine(p1, p2)
+    if unit == 'meters':
+        return angle * EARTH_RADIUS
+    return angle
+
+
+def shapeDistance(point, shape, unit):
+    """Return the distance to the nearest vertex of a shape"""
+    if shape[0] == 'polygon' and inPolygon(point, shape[1]):
+        return 0.0
+    return min([distance(point, p, unit) for p in _vertices(shape)])
+
+
+###############################################################################
+#
+# query shapes
+#
+###############################################################################
+
+class Circle(object):
+    """$center (planar) and $centerSphere (radians) query shape"""
+
+    def __init__(self, center, radius, unit):
+        self.center = center
+        self.radius = radius
+        self.unit = unit
+
+    def bbox(self):
+        x, y = self.center
+        if self.unit == 'planar':
+            return (x - self.radius, y - self.radius,
+                    x + self.radius, y + self.radius)
+        dy = math.degrees(self.radius)
+        cos = math.cos(math.radians(min(abs(y) + dy, 90.0)))
+        dx = cos > 1e-9 and dy / cos or 360.0
+        return (x - dx, y - dy, x + dx, y + dy)
+
+    def contains(self, shape):
+        for p in _vertices(shape):
+            if distance(self.center, p, self.unit) > self.radius:
+                return False
+        return True
+
+
+class Box(object):
+    """$box query shape"""
+
+    def __init__(self, bottomLeft, topRight):
+        self.box = (bottomLeft[0], bottomLeft[1], topRight[0], topRight[1])
+
+    def bbox(self):
+        return self.box
+
+    def contains(self, shape):
+        minX, minY, maxX, maxY = self.box
+        for x, y in _vertices(shape):
+            if not (minX <= x <= maxX and minY <= y <= maxY):
+                return False
+        return True
+
+
+class Polygons(object):
+    """$polygon and GeoJSON (Multi)Polygon query shape"""
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+
+    def bbox(self):
+        boxes = [bbox(shape) for shape in self.shapes]
+        return (min([b[0] for b in boxes]), min([b[1] for b in boxes]),
+                max([b[2] for b in boxes]), max([b[3] for b in boxes]))
+
+    def contains(self, shape):
+        for polygon in self.shapes:
+            for p in _vertices(shape):
+                if not inPolygon(p, polygon[1]):
+                    break
+            else:
+                return True
+        return False
+
+
+def parseWithin(query):
+    """Return the query shape of a $geoWithin query"""
+    if not isinstance(query, dict):
+        raise _badValue("$geoWithin not an object: %r" % (query,))
+    if '$geometry' in query:
+        shapes = parseGeometry(query['$geometry'])
+        if not shapes or [s for s in shapes if s[0] != 'polygon']:
+            raise _badValue("$geoWithin requires a Polygon or MultiPolygon")
+        return Polygons(shapes)
+    elif '$box' in query:
+        box = _points(query['$box'])
+        if len(box) != 2:
+            raise _badValue("$box requires two points")
+        return Box(*box)
+    elif '$polygon' in query:
+        points = _points(query['$polygon'])
+        if len(points) < 3:
+            raise _badValue("$polygon requires at least 3 points")
+        return Polygons([('polygon', [points])])
+    elif '$center' in query or '$centerSphere' in query:
+        unit = '$center' in query and 'planar' or 'radians'
+        try:
+            center, radius = query.get('$center', query.get('$centerSphere'))
+        except (TypeError, ValueError):
+            raise _badValue("$center requires a point and a radius")
+        center = _point(center)
+        if center is None or not _isNumber(radius):
+            raise _badValue("$center requires a point and a radius")
+        return Circle(center, radius, unit)
+    raise _badValue("unknown $geoWithin shape: %r" % (query,))
+
+
+def parseIntersects(query):
+    """Return the shapes of a $geoIntersects query"""
+    if not isinstance(query, dict) or '$geometry' not in query:
+        raise _badValue("$geoIntersects requires a $geometry")
+    shapes = parseGeometry(query['$geometry'])
+    if not shapes:
+        raise _badValue("invalid $geometry: %r" % (query['$geometry'],))
+    return shapes
+
+
+def parseNear(query):
+    """Return (point, unit, minDistance, maxDistance) of a $near query.
+
+    GeoJSON points use meters, legacy points use planar units ($near) or
+    radians ($nearSphere).
+    """
+    op = '$nearSphere' in query and '$nearSphere' or '$near'
+    near = query[op]
+    minDistance = query.get('$minDistance')
+    maxDistance = query.get('$maxDistance')
+    if isinstance(near, dict) and '$geometry' in near:
+        point = parseGeometry(near['$geometry'])
+        if len(point) != 1 or point[0][0] != 'point':
+            raise _badValue("%s requires a GeoJSON Point" % op)
+        minDistance = near.get('$minDistance', minDistance)
+        maxDistance = near.get('$maxDistance', maxDistance)
+        return point[0][1], 'meters', minDistance, maxDistance
+    point = _point(near)
+    if point is None:
+        raise _badValue("%s requires a point" % op)
+    unit = op == '$near' and 'planar' or 'radians'
+    return point, unit, minDistance, maxDistance
+
+
+def match(op, value, query):
+    """Return True if the document value matches the geo query operator"""
+    if op in ('$geoWithin', '$within'):
+        shape = parseWithin(query)
+        shapes = parseGeometry(value)
+        return bool(shapes) and all([shape.contains(s) for s in shapes])
+    elif op == '$geoIntersects':
+        others = parseIntersects(query)
+        for shape in parseGeometry(value):
+            for other in others:
+                if intersects(shape, other):
+                    return True
+        return False
+    # $near gets handled by the query planner using the index
+    return True
+
+
+###############################################################################
+#
+# index
+#
+###############################################################################
+
+class GeoIndex(object):
+    """Grid index for 2d and 2dsphere indexes.
+
+    The cellSize is given in coordinate units (degrees for 2dsphere). The 2d
+    index covers the square between min and max like in MongoDB.
+    """
+
+    def __init__(self, name, field, kind='2dsphere', cellSize=None,
+        min=-180.0, max=180.0):
+        self.name = name
+        self.field = field
+        self.kind = kind
+        if kind == '2dsphere':
+            self.minX, self.minY, self.maxX, self.maxY = -180, -90, 180, 90
+            if cellSize is None:
+                cellSize = 0.5
+        else:
+            self.minX = self.minY = min
+            self.maxX = self.maxY = max
+            if cellSize is None:
+                cellSize = (max - min) / 360.0
+        self.min = min
+        self.max = max
+        self.cellSize = float(cellSize)
+        self.cols = int(math.ceil((self.maxX - self.minX) / self.cellSize))
+        self.rows = int(math.ceil((self.maxY - self.minY) / self.cellSize))
+        self.clear()
+
+    def clear(self):
+        # (col, row): {key: [shape, ...]}
+        self.cells = {}
+        # key: [cell, ...], used for removing a document
+        self._cells = {}
+        # number of entries (document cells) and estimated size in bytes
+        self.keyCount = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self._cells)
+
+    def copy(self):
+        return GeoIndex(self.name, self.field, self.kind, self.cellSize,
+            self.min, self.max)
+
+    def _col(self, x):
+        return max(0, min(self.cols - 1,
+            int(math.floor((x - self.minX) / self.cellSize))))
+
+    def _row(self, y):
+        return max(0, min(self.rows - 1,
+            int(math.floor((y - self.minY) / self.cellSize))))
+
+    def _cover(self, box):
+        # return the cells covering a bounding box
+        minX, minY, maxX, maxY = box
+        if self.kind == '2dsphere' and maxX - minX >= 360:
+            minX, maxX = -180, 180
+        rows = range(self._row(minY), self._row(maxY) + 1)
+        if self.kind == '2dsphere' and (minX < -180 or maxX > 180):
+            # crosses the antimeridian
+            cols = set()
+            for x1, x2 in ((minX, maxX), (minX + 360, maxX + 360),
+                           (minX - 360, maxX - 360)):
+                if x2 >= -180 and x1 <= 180:
+                    cols.update(range(self._col(x1), self._col(x2) + 1))
+        else:
+            cols = range(self._col(minX), self._col(maxX) + 1)
+        return [(col, row) for col in cols for row in rows]
+
+    # maintenance
+    def add(self, key, doc):
+        value = getField(doc, self.field)
+        if value is NOVALUEMARKER:
+            return
+        cells = {}
+        for shape in parseGeometry(value):
+            if shape[0] != 'point' and not _vertices(shape):
+                continue
+            for cell in self._cover(bbox(shape)):
+                cells.setdefault(cell, []).append(shape)
+        if cells:
+            self._cells[key] = list(cells.keys())
+            for cell, shapes in cells.items():
+                self.cells.setdefault(cell, {})[key] = shapes
+                self.size += getKeySize(cell) + INDEX_ENTRY_SIZE
+            self.keyCount += len(cells)
+
+    def remove(self, key):
+        for cell in self._cells.pop(key, ()):
+            self.keyCount -= 1
+            self.size -= getKeySize(cell) + INDEX_ENTRY_SIZE
+            docs = self.cells[cell]
+            del docs[key]
+            if not docs:
+                del self.cells[cell]
+
+    # searching
+    def _candidates(self, box):
+        seen = set()
+        for cell in self._cover(box):
+            for key, shapes in self.cells.get(cell, {}).items():
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def _shapes(self, key):
+        shapes = []
+        for cell in self._cells.get(key, ()):
+            for shape in self.cells[cell][key]:
+                if shape not in shapes:
+                    shapes.append(shape)
+        return shapes
+
+    def within(self, query):
+        """Return the keys of the documents within the $geoWithin shape"""
+        shape = parseWithin(query)
+        return [key for key in self._candidates(shape.bbox())
+                if all([shape.contains(s) for s in self._shapes(key)])]
+
+    def intersects(self, query):
+        """Return the keys of the documents intersecting the $geometry"""
+        others = parseIntersects(query)
+        res = []
+        seen = set()
+        for other in others:
+            for key in self._candidates(bbox(other)):
+                if key in seen:
+                    continue
+                for shape in self._shapes(key):
+                    if intersects(shape, other):
+                        seen.add(key)
+                        res.append(key)
+                        break
+        return res
+
+    def _ring(self, col, row, r):
+        # yield the cells of ring r around the given cell
+        if r == 0:
+            cells = [(col, row)]
+        else:
+            cells = [(col + dx, row + dy)
+                     for dy in (-r, r) for dx in range(-r, r + 1)]
+            cells.extend([(col + dx, row + dy)
+                          for dx in (-r, r) for dy in range(-r + 1, r)])
+        for c, rw in cells:
+            if not 0 <= rw < self.rows:
+                continue
+            if self.kind == '2dsphere':
+                c = c % self.cols
+            elif not 0 <= c < self.cols:
+                continue
+            yield (c, rw)
+
+    def _bound(self, point, col, row, r, unit):
+        # return the minimal distance from the point to any cell outside
+        # of the rings 0 to r
+        x, y = point
+        size = self.cellSize
+        dy = INF
+        if row - r > 0:
+            dy = min(dy, y - (self.minY + (row - r) * size))
+        if row + r < self.rows - 1:
+            dy = min(dy, self.minY + (row + r + 1) * size - y)
+        dx = INF
+        if self.kind == '2dsphere':
+            if 2 * r + 1 < self.cols:
+                dx = min(x - (self.minX + (col - r) * size),
+                         self.minX + (col + r + 1) * size - x)
+        else:
+            if col - r > 0:
+                dx = min(dx, x - (self.minX + (col - r) * size))
+            if col + r < self.cols - 1:
+                dx = min(dx, self.minX + (col + r + 1) * size - x)
+        if unit == 'planar':
+            return min(dx, dy)
+        # the distance to the meridian dx away is the shortest one
+        bound = INF
+        if dy != INF:
+            bound = math.radians(dy)
+        if dx != INF:
+            sin = math.cos(math.radians(y)) * math.sin(
+                math.radians(min(dx, 90.0)))
+            bound = min(bound, math.asin(min(1.0, sin)))
+        if unit == 'meters' and bound != INF:
+            bound *= EARTH_RADIUS
+        return bound
+
+    def _ringOf(self, col, row, cell):
+        # return the ring of a cell around the given cell
+        dx = abs(cell[0] - col)
+        if self.kind == '2dsphere':
+            dx = min(dx, self.cols - dx)
+        return max(dx, abs(cell[1] - row))
+
+    def near(self, query):
+        """Yield (key, distance) ordered by distance for a $near query"""
+        point, unit, minDistance, maxDistance = parseNear(query)
+        col, row = self._col(point[0]), self._row(point[1])
+        best = {}
+        done = set()
+        heap = []
+        maxRing = max(self.cols, self.rows)
+        # ring: occupied cells, used as soon as a ring has more cells than
+        # the index, empty rings get skipped
+        sparse = None
+        r = 0
+        while True:
+            if sparse is None and 8 * r > len(self.cells):
+                sparse = {}
+                for cell in self.cells:
+                    ring = self._ringOf(col, row, cell)
+                    if ring >= r:
+                        sparse.setdefault(ring, []).append(cell)
+            if sparse is None:
+                cells = self._ring(col, row, r)
+            else:
+                cells = sparse.pop(r, ())
+            for cell in cells:
+                for key, shapes in self.cells.get(cell, {}).items():
+                    if key in done:
+                        continue
+                    d = min([shapeDistance(point, s, unit) for s in shapes])
+                    if d < best.get(key, INF):
+                        best[key] = d
+                        heapq.heappush(heap, (d, key))
+            # the next ring which can contain documents
+            nextRing = r + 1
+            if sparse is not None:
+                nextRing = sparse and min(sparse) or INF
+            if nextRing > maxRing:
+                bound = INF
+            else:
+                bound = self._bound(point, col, row, nextRing - 1, unit)
+            while heap and heap[0][0] <= bound:
+                d, key = heapq.heappop(heap)
+                if key in done or best[key] != d:
+                    continue
+                done.add(key)
+                if maxDistance is not None and d > maxDistance:
+                    return
+                if minDistance is not None and d < minDistance:
+                    continue
+                yield key, d
+            if bound == INF or (maxDistance is not None and
+                                bound > maxDistance):
+                return
+            r = nextRing
+
+    def info(self):
+        """Return the index information as provided by index_information"""
+        info = {'key': [(self.field, self.kind)]}
+        if self.kind == '2dsphere':
+            info['2dsphereIndexVersion'] = 3
+        else:
+            info['min'] = self.min
+            info['max'] = self.max
+        return info
@@ -0,0 +1,487 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Fake GridFS
+
+FakeGridFS stores files like GridFS in the <root>.files and <root>.chunks
+collections of a fake database. Uploads get split into chunks from
+memoryview slices of the written data. Downloads read one chunk at a time,
+the chunk data stored in the collection gets sliced without copying it.
+"""
+import datetime
+import hashlib
+import io
+
+import bson.objectid
+import gridfs.errors
+import six
+
+from m01.mongofake import INDEX_ENTRY_SIZE
+from m01.mongofake import getKeySize
+
+DEFAULT_CHUNK_SIZE = 255 * 1024
+
+
+class ChunkIndex(object):
+    """Unique files_id, n index on the chunks collection.
+
+    Maps (files_id, n) to the storage key of the chunk. Gets maintained by
+    the collection write funnel like any other index.
+    """
+
+    kind = 'chunks'
+
+    def __init__(self, name='files_id_1_n_1'):
+        self.name = name
+        self.clear()
+
+    def clear(self):
+        # (files_id, n): key
+        self.keys = {}
+        # key: (files_id, n)
+        self._entries = {}
+        self.keyCount = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def copy(self):
+        return ChunkIndex(self.name)
+
+    def add(self, key, doc):
+        entry = (doc.get('files_id'), doc.get('n'))
+        if entry[0] is not None:
+            self.keys[entry] = key
+            self._entries[key] = entry
+            self.keyCount += 1
+            self.size += getKeySize(entry) + INDEX_ENTRY_SIZE
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            del self.keys[entry]
+            self.keyCount -= 1
+            self.size -= getKeySize(entry) + INDEX_ENTRY_SIZE
+
+    def get(self, files_id, n):
+        """Return the storage key of a chunk or None"""
+        return self.keys.get((files_id, n))
+
+    def info(self):
+        return {'key': [('files_id', 1), ('n', 1)], 'unique': True}
+
+
+def _chunkIndex(chunks):
+    # return the chunk index, create it if missing
+    index = chunks._indexes.get('files_id_1_n_1')
+    if index is None:
+        index = ChunkIndex()
+        chunks._buildIndex(index)
+    return index
+
+
+class FakeGridIn(object):
+    """Write a file to GridFS.
+
+    Written data gets split into chunks using memoryview slices, only the
+    last incomplete chunk gets buffered. The file document gets written on
+    close.
+    """
+
+    def __init__(self, root_collection, disable_md5=False, **kwargs):
+        self._files = root_collection.files
+        self._chunks = root_collection.chunks
+        _chunkIndex(self._chunks)
+        if 'content_type' in kwargs:
+            kwargs['contentType'] = kwargs.pop('content_type')
+        if 'chunk_size' in kwargs:
+            kwargs['chunkSize'] = kwargs.pop('chunk_size')
+        self._encoding = kwargs.pop('encoding', None)
+        kwargs.setdefault('_id', bson.objectid.ObjectId())
+        kwargs.setdefault('chunkSize', DEFAULT_CHUNK_SIZE)
+        self._file = kwargs
+        self._chunkSize = kwargs['chunkSize']
+        self._buffer = bytearray()
+        self._n = 0
+        self._length = 0
+        self._md5 = not disable_md5 and hashlib.md5() or None
+        self._closed = False
+
+    @property
+    def _id(self):
+        return self._file['_id']
+
+    @property
+    def filename(self):
+        return self._file.get('filename')
+
+    name = filename
+
+    @property
+    def content_type(self):
+        return self._file.get('contentType')
+
+    @property
+    def chunk_size(self):
+        return self._chunkSize
+
+    @property
+    def length(self):
+        return self._file.get('length')
+
+    @property
+    def upload_date(self):
+        return self._file.get('uploadDate')
+
+    @property
+    def md5(self):
+        return self._file.get('md5')
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _flushChunk(self, data):
+        # data is a memoryview or the buffer, store one copy as bytes
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        else:
+            data = bytes(data)
+        self._chunks.insert({'files_id': self._id, 'n': self._n,
+                             'data': data})
+        if self._md5 is not None:
+            self._md5.update(data)
+        self._n += 1
+        self._length += len(data)
+
+    def write(self, data):
+        """Write bytes, a file like object or text (if an encoding is set)"""
+        if self._closed:
+            raise ValueError("cannot write to a closed file")
+        if hasattr(data, 'read'):
+            while True:
+                block = data.read(self._chunkSize - len(self._buffer))
+                if not block:
+                    break
+                self.write(block)
+            return
+        if isinstance(data, six.text_type):
+            if self._encoding is None:
+                raise TypeError("must specify an encoding for file in order "
+                                "to write %s" % six.text_type.__name__)
+            data = data.encode(self._encoding)
+        view = memoryview(data)
+        size = self._chunkSize
+        pos = 0
+        if self._buffer:
+            # fill up the buffered chunk first
+            pos = min(size - len(self._buffer), len(view))
+            self._buffer += view[:pos]
+            if len(self._buffer) == size:
+                self._flushChunk(self._buffer)
+                self._buffer = bytearray()
+        while len(view) - pos >= size:
+            self._flushChunk(view[pos:pos + size])
+            pos += size
+        if pos < len(view):
+            self._buffer += view[pos:]
+
+    def writelines(self, sequence):
+        for line in sequence:
+            self.write(line)
+
+    def close(self):
+        """Flush the last chunk and write the file document"""
+        if self._closed:
+            return
+        if self._buffer:
+            self._flushChunk(self._buffer)
+            self._buffer = bytearray()
+        now = datetime.datetime.utcnow()
+        self._file['uploadDate'] = now.replace(
+            microsecond=now.microsecond // 1000 * 1000)
+        self._file['length'] = self._length
+        if self._md5 is not None:
+            self._file['md5'] = self._md5.hexdigest()
+        self._files.insert(self._file)
+        self._closed = True
+
+    def abort(self):
+        """Remove the written chunks"""
+        _deleteChunks(self._chunks, self._id)
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def _deleteChunks(chunks, files_id):
+    index = _chunkIndex(chunks)
+    n = 0
+    while True:
+        key = index.get(files_id, n)
+        if key is None:
+            break
+        chunks._delDoc(key)
+        n += 1
+
+
+class FakeGridOut(io.RawIOBase):
+    """Read a file from GridFS.
+
+    Only the current chunk gets loaded. Reading slices the stored chunk data
+    using memoryview and copies each byte once into the result.
+    """
+
+    def __init__(self, root_collection, file_id=None, file_document=None):
+        io.RawIOBase.__init__(self)
+        self._chunks = root_collection.chunks
+        self._index = _chunkIndex(self._chunks)
+        if file_document is None:
+            file_document = root_collection.files.find_one({'_id': file_id})
+            if file_document is None:
+                raise gridfs.errors.NoFile("no file in gridfs collection %r "
+                    "with _id %r" % (root_collection.files, file_id))
+        self._file = file_document
+        self._position = 0
+        self._chunkN = -1
+        self._chunk = None
+
+    @property
+    def _id(self):
+        return self._file['_id']
+
+    @property
+    def filename(self):
+        return self._file.get('filename')
+
+    name = filename
+
+    @property
+    def content_type(self):
+        return self._file.get('contentType')
+
+    @property
+    def length(self):
+        return self._file['length']
+
+    @property
+    def chunk_size(self):
+        return self._file['chunkSize']
+
+    @property
+    def upload_date(self):
+        return self._file['uploadDate']
+
+    @property
+    def aliases(self):
+        return self._file.get('aliases')
+
+    @property
+    def metadata(self):
+        return self._file.get('metadata')
+
+    @property
+    def md5(self):
+        return self._file.get('md5')
+
+    def __getattr__(self, name):
+        if name in self._file:
+            return self._file[name]
+        raise AttributeError("GridOut object has no attribute '%s'" % name)
+
+    def _getChunk(self, n):
+        # return the data of chunk n
+        key = self._index.get(self._id, n)
+        doc = key is not None and self._chunks.docs.get(key) or None
+        if doc is None:
+            raise gridfs.errors.CorruptGridFile("no chunk #%d" % n)
+        return doc['data']
+
+    def _view(self):
+        # return a memoryview of the current chunk starting at the position
+        n, offset = divmod(self._position, self.chunk_size)
+        if n != self._chunkN:
+            self._chunk = memoryview(self._getChunk(n))
+            self._chunkN = n
+        return self._chunk[offset:]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Read into a writable buffer, returns the number of bytes read"""
+        target = memoryview(buffer)
+        size = min(len(target), max(0, self.length - self._position))
+        pos = 0
+        while pos < size:
+            view = self._view()
+            n = min(len(view), size - pos)
+            target[pos:pos + n] = view[:n]
+            pos += n
+            self._position += n
+        return size
+
+    def read(self, size=-1):
+        # the position can be past the end after seek
+        remaining = max(0, self.length - self._position)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if not size:
+            return b''
+        view = self._view()
+        if len(view) >= size:
+            # within the current chunk
+            self._position += size
+            return view[:size].tobytes()
+        buffer = bytearray(size)
+        self.readinto(buffer)
+        return bytes(buffer)
+
+    def readall(self):
+        return self.read()
+
+    def readchunk(self):
+        """Read the rest of the current chunk"""
+        if self._position >= self.length:
+            return b''
+        return self.read(len(self._view()))
+
+    def readline(self, size=-1):
+        # the position can be past the end after seek
+        remaining = max(0, self.length - self._position)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        parts = []
+        read = 0
+        while read < size:
+            view = self._view()[:size - read]
+            idx = view.tobytes().find(b'\n')
+            if idx != -1:
+                view = view[:idx + 1]
+            parts.append(view.tobytes())
+            read += len(view)
+            self._position += len(view)
+            if idx != -1:
+                break
+        return b''.join(parts)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._position
+        elif whence == io.SEEK_END:
+            pos += self.length
+        if pos < 0:
+            raise IOError(22, "Invalid value for `pos` - must be positive")
+        self._position = pos
+        return pos
+
+    def __iter__(self):
+        """Iterate over the stored chunks, the data doesn't get copied"""
+        for n in range(self._numChunks()):
+            yield self._getChunk(n)
+
+    def _numChunks(self):
+        return (self.length + self.chunk_size - 1) // self.chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class FakeGridFS(object):
+    """Fake GridFS using the <collection>.files and <collection>.chunks
+    collections of a fake database.
+    """
+
+    def __init__(self, database, collection='fs', disable_md5=False):
+        self._collection = database[collection]
+        self._files = self._collection.files
+        self._chunks = self._collection.chunks
+        self._disable_md5 = disable_md5
+        _chunkIndex(self._chunks)
+
+    def new_file(self, **kwargs):
+        return FakeGridIn(self._collection, disable_md5=self._disable_md5,
+            **kwargs)
+
+    def put(self, data, **kwargs):
+        """Store data (bytes or file like object) and return the file _id"""
+        if '_id' in kwargs and self.exists(kwargs['_id']):
+            raise gridfs.errors.FileExists("file with _id %r already exists"
+                % kwargs['_id'])
+        gridIn = self.new_file(**kwargs)
+        try:
+            gridIn.write(data)
+        except Exception:
+            gridIn.abort()
+            raise
+        gridIn.close()
+        return gridIn._id
+
+    def get(self, file_id):
+        return FakeGridOut(self._collection, file_id)
+
+    def get_version(self, filename=None, version=-1, **kwargs):
+        query = kwargs
+        if filename is not None:
+            query['filename'] = filename
+        docs = sorted(self._files.find(query),
+            key=lambda doc: doc['uploadDate'])
+        try:
+            doc = docs[version]
+        except IndexError:
+            raise gridfs.errors.NoFile("no version %d for filename %r" % (
+                version, filename))
+        return FakeGridOut(self._collection, file_document=doc)
+
+    def get_last_version(self, filename=None, **kwargs):
+        return self.get_version(filename=filename, **kwargs)
+
+    def delete(self, file_id):
+        self._files.remove({'_id': file_id})
+        _deleteChunks(self._chunks, file_id)
+
+    def list(self):
+        return sorted(set([doc['filename'] for doc in self._files.find()
+                           if doc.get('filename') is not None]))
+
+    def find(self, *args, **kwargs):
+        for doc in self._files.find(*args, **kwargs):
+            yield FakeGridOut(self._collection, file_document=doc)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for gridOut in self.find(filter, *args, **kwargs):
+            return gridOut
+        return None
+
+    def exists(self, document_or_id=None, **kwargs):
+        if kwargs:
+            return self._files.find_one(kwargs, ['_id']) is not None
+        return self._files.find_one(document_or_id, ['_id']) is not None
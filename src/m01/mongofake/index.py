@@ -0,0 +1,181 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Field index
+
+The FieldIndex maps the values of the indexed fields to the keys of the
+documents containing them. The index gets maintained by the collection write
+funnel. Counts and distinct values of queries covered by the index get
+answered from the index entries without touching the documents.
+
+An array value adds one entry per array item (multikey index), like in
+MongoDB. A multikey index only covers distinct without a query, the query
+matching compares arrays as a whole.
+"""
+import itertools
+
+import pymongo.errors
+
+from m01.mongofake import INDEX_ENTRY_SIZE
+from m01.mongofake import NOVALUEMARKER
+from m01.mongofake import getField
+from m01.mongofake import getKeySize
+from m01.mongofake import sortKey
+
+
+def hashable(value):
+    """Return a hashable value comparing like the given value"""
+    if isinstance(value, dict):
+        return tuple([(k, hashable(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return tuple([hashable(v) for v in value])
+    return value
+
+
+class FieldIndex(object):
+    """Index on one or more fields (ascending or descending)"""
+
+    kind = 'field'
+
+    def __init__(self, name, keys, unique=False):
+        self.name = name
+        self.keys = list(keys)
+        self.fields = [k for k, d in self.keys]
+        self.unique = unique
+        self.multikey = False
+        self.clear()
+
+    def clear(self):
+        # (value, ...): {key: value tuple with the original values}
+        self.entries = {}
+        # key: [(value, ...), ...], used for removing a document
+        self._entries = {}
+        # number of entries and estimated size in bytes
+        self.keyCount = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def copy(self):
+        return FieldIndex(self.name, self.keys, self.unique)
+
+    # maintenance
+    def _values(self, doc):
+        # return the entries of a document, one per array item combination
+        values = []
+        for name in self.fields:
+            value = getField(doc, name)
+            if isinstance(value, (list, tuple)) and value:
+                self.multikey = True
+                values.append(list(value))
+            else:
+                values.append([value])
+        return itertools.product(*values)
+
+    def add(self, key, doc):
+        entries = [(tuple([hashable(v) for v in values]), values)
+                   for values in self._values(doc)]
+        if self.unique:
+            for entry, values in entries:
+                if [k for k in self.entries.get(entry, ()) if k != key]:
+                    raise pymongo.errors.DuplicateKeyError(
+                        "E11000 duplicate key error index: %s dup key: %r"
+                        % (self.name, values), 11000)
+        for entry, values in entries:
+            self.entries.setdefault(entry, {})[key] = values
+            self.size += getKeySize(entry) + INDEX_ENTRY_SIZE
+        self._entries[key] = [entry for entry, values in entries]
+        self.keyCount += len(entries)
+
+    def remove(self, key):
+        for entry in self._entries.pop(key, ()):
+            self.keyCount -= 1
+            self.size -= getKeySize(entry) + INDEX_ENTRY_SIZE
+            keys = self.entries[entry]
+            keys.pop(key, None)
+            if not keys:
+                del self.entries[entry]
+
+    # queries
+    def covers(self, spec, field=None):
+        """Return True if the spec (and field) only use the indexed fields
+        with equality or $in conditions"""
+        if field is not None and field not in self.fields:
+            return False
+        if self.multikey and (spec or field is None):
+            return False
+        for name, value in spec.items():
+            # the query matching only applies operators to top level fields
+            if name not in self.fields or '.' in name:
+                return False
+            if isinstance(value, dict):
+                if list(value.keys()) != ['$in']:
+                    return False
+                value = value['$in']
+                if [v for v in value if isinstance(v, (dict, list))]:
+                    return False
+            elif isinstance(value, list):
+                return False
+        return True
+
+    def _conditions(self, spec):
+        # return the allowed entry values per field position or None
+        conditions = []
+        for name in self.fields:
+            value = spec.get(name, NOVALUEMARKER)
+            if value is NOVALUEMARKER:
+                conditions.append(None)
+            elif isinstance(value, dict):
+                conditions.append(set([hashable(v) for v in value['$in']]))
+            else:
+                conditions.append(set([hashable(value)]))
+        return conditions
+
+    def _matching(self, spec):
+        # return the matching {key: values} entries
+        conditions = self._conditions(spec)
+        if None not in conditions:
+            # lookup the entries directly
+            for entry in itertools.product(*conditions):
+                keys = self.entries.get(entry)
+                if keys:
+                    yield keys
+            return
+        for entry, keys in self.entries.items():
+            for value, allowed in zip(entry, conditions):
+                if allowed is not None and value not in allowed:
+                    break
+            else:
+                yield keys
+
+    def count(self, spec):
+        """Return the number of documents matching a covered spec"""
+        return sum([len(keys) for keys in self._matching(spec)])
+
+    def distinct(self, field, spec):
+        """Return the sorted distinct values of a field for a covered spec"""
+        pos = self.fields.index(field)
+        values = {}
+        for keys in self._matching(spec):
+            value = next(iter(keys.values()))[pos]
+            if value is not NOVALUEMARKER:
+                values[hashable(value)] = value
+        return sorted(values.values(), key=sortKey)
+
+    def info(self):
+        """Return the index information as provided by index_information"""
+        info = {'key': list(self.keys)}
+        if self.unique:
+            info['unique'] = True
+        return info
@@ -0,0 +1,304 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""map_reduce and group
+
+The map, reduce and finalize functions are Python callables:
+
+- map(doc) returns or yields (key, value) pairs or calls emit(key, value)
+  like a JavaScript map function
+
+- reduce(key, values) returns one value. Like in MongoDB it must be
+  associative, reduce gets applied to partial results again
+
+- finalize(key, value) returns the final value
+
+There is no JavaScript engine. Legacy code passing JavaScript source (or a
+bson Code) works if a Python equivalent got registered for the source with
+registerFunction.
+
+The matching documents get split into partitions. The map and combine
+(reduce per partition) phases run in a concurrent.futures process pool of
+forked worker processes, the parent process merges and reduces the partial
+results.
+"""
+import re
+import threading
+import time
+
+import pymongo.errors
+
+from m01.mongofake import NOVALUEMARKER
+from m01.mongofake import FakeCursor
+from m01.mongofake import copyDocument
+from m01.mongofake import getField
+from m01.mongofake import sortKey
+from m01.mongofake import string_types
+from m01.mongofake import toUnicode
+from m01.mongofake.forking import forkExecutor
+from m01.mongofake.forking import getState
+from m01.mongofake.index import hashable
+
+# reduce the values of a key once that many got emitted (bounded memory)
+COMBINE_SIZE = 1000
+
+# partitions per worker process, smaller partitions balance the load
+PARTITIONS_PER_PROCESS = 4
+
+_functions = {}
+_local = threading.local()
+
+
+def _normalize(source):
+    return re.sub(r'\s+', ' ', toUnicode(source)).strip()
+
+
+def registerFunction(source, func):
+    """Register a Python callable used for the JavaScript source"""
+    _functions[_normalize(source)] = func
+
+
+def getFunction(func, name='function'):
+    """Return the callable or the callable registered for the source"""
+    if func is None or callable(func):
+        return func
+    if isinstance(func, string_types):
+        registered = _functions.get(_normalize(func))
+        if registered is not None:
+            return registered
+    raise TypeError("%s must be a Python callable or registered with "
+        "registerFunction, there is no JavaScript support" % name)
+
+
+def emit(key, value):
+    """Emit a key and value from a map function (JavaScript style)"""
+    _local.pairs.append((key, value))
+
+
+def _mapItems(mapper, reducer, items):
+    # map and combine (key, doc) items, returns ({hashable key: (key, value)},
+    # emit count, reduce count)
+    values = {}
+    emits = 0
+    reduces = 0
+    pairs = _local.pairs = []
+    try:
+        for key, doc in items:
+            res = mapper(copyDocument(doc))
+            if res is not None:
+                pairs.extend(res)
+            for k, v in pairs:
+                h = hashable(k)
+                entry = values.get(h)
+                if entry is None:
+                    values[h] = (k, [v])
+                    continue
+                entry[1].append(v)
+                if len(entry[1]) >= COMBINE_SIZE:
+                    entry[1][:] = [reducer(k, entry[1])]
+                    reduces += 1
+            emits += len(pairs)
+            del pairs[:]
+    finally:
+        del _local.pairs
+    res = {}
+    for h, (k, vs) in values.items():
+        if len(vs) > 1:
+            res[h] = (k, reducer(k, vs))
+            reduces += 1
+        else:
+            res[h] = (k, vs[0])
+    return res, emits, reduces
+
+
+def _mapPartition(idx):
+    # worker process, the state is the mapper, reducer and partitions
+    mapper, reducer, parts = getState()
+    return _mapItems(mapper, reducer, parts[idx])
+
+
+def _partition(items, count):
+    size = max(1, (len(items) + count - 1) // count)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def mapReduce(collection, map, reduce, query=None, sort=None, limit=0,
+    finalize=None, processes=1, session=None):
+    """Run map and reduce on the matching documents.
+
+    Returns the results as {'_id': key, 'value': value} dicts ordered by key
+    and the counts.
+    """
+    mapper = getFunction(map, 'map')
+    reducer = getFunction(reduce, 'reduce')
+    finalize = getFunction(finalize, 'finalize')
+    if isinstance(sort, dict):
+        # pymongo passes the sort as dict or SON
+        sort = list(sort.items())
+    cursor = FakeCursor(collection, query or {}, None, 0, limit, True, True,
+        False, sort=sort, session=session)
+    items, produce = cursor._query(collection, query or {}, sort)
+    if limit:
+        items = items[:limit]
+    if processes > 1 and len(items) > 1:
+        parts = _partition(items, processes * PARTITIONS_PER_PROCESS)
+        with forkExecutor(processes, (mapper, reducer, parts)) as pool:
+            partials = list(pool.map(_mapPartition, range(len(parts))))
+    else:
+        partials = [_mapItems(mapper, reducer, items)]
+
+    # merge the partial results
+    merged = {}
+    emits = 0
+    reduces = 0
+    for values, emitted, reduced in partials:
+        emits += emitted
+        reduces += reduced
+        for h, (k, v) in values.items():
+            entry = merged.get(h)
+            if entry is None:
+                merged[h] = (k, [v])
+            else:
+                entry[1].append(v)
+    results = []
+    for k, vs in merged.values():
+        if len(vs) > 1:
+            value = reducer(k, vs)
+            reduces += 1
+        else:
+            value = vs[0]
+        if finalize is not None:
+            value = finalize(k, value)
+        results.append({u'_id': k, u'value': value})
+    results.sort(key=lambda doc: sortKey(doc['_id']))
+    counts = {'input': len(items),
+              'emit': emits,
+              'reduce': reduces,
+              'output': len(results)}
+    return results, counts
+
+
+def _writeOutput(collection, out, results, reducer, finalize):
+    # write the results to the output collection, returns the result info
+    if isinstance(out, string_types):
+        out = {'replace': out}
+    database = collection.database
+    if out.get('db'):
+        database = database.connection[out['db']]
+    for action in ('replace', 'merge', 'reduce'):
+        if action in out:
+            break
+    else:
+        raise pymongo.errors.OperationFailure(
+            "'out' has to be a string or an object", 13606)
+    target = database[out[action]]
+    if action == 'replace':
+        target.clear()
+    elif action == 'reduce':
+        merged = []
+        for doc in results:
+            old = target.find_one({'_id': doc['_id']})
+            if old is not None:
+                value = reducer(doc['_id'], [old['value'], doc['value']])
+                if finalize is not None:
+                    value = finalize(doc['_id'], value)
+                doc = {u'_id': doc['_id'], u'value': value}
+            merged.append(doc)
+        results = merged
+    if action == 'replace':
+        if results:
+            target.insert(results)
+    else:
+        for doc in results:
+            target.find_one_and_replace({'_id': doc['_id']}, doc,
+                upsert=True)
+    if out.get('db'):
+        return {'db': database.name, 'collection': target.name}, target
+    return target.name, target
+
+
+def runMapReduce(collection, map, reduce, out, query=None, sort=None,
+    limit=0, finalize=None, processes=1, session=None):
+    """Run map_reduce and return the MongoDB response and the output
+    collection (None for inline output)"""
+    start = time.time()
+    map = getFunction(map, 'map')
+    reducer = getFunction(reduce, 'reduce')
+    finalize = getFunction(finalize, 'finalize')
+    results, counts = mapReduce(collection, map, reducer, query, sort, limit,
+        finalize, processes, session)
+    response = {'timeMillis': 0, 'counts': counts, 'ok': 1.0}
+    target = None
+    if isinstance(out, dict) and out.get('inline'):
+        response['results'] = results
+    else:
+        response['result'], target = _writeOutput(collection, out, results,
+            reducer, finalize)
+    response['timeMillis'] = int((time.time() - start) * 1000)
+    return response, target
+
+
+def _getGroupKey(key):
+    # return a function returning the group key dict of a document
+    if key is None:
+        return lambda doc: {}
+    if isinstance(key, dict):
+        key = list(key.keys())
+    if isinstance(key, (list, tuple)):
+        names = [toUnicode(k) for k in key]
+
+        def getKey(doc):
+            res = {}
+            for name in names:
+                value = getField(doc, name)
+                if value is NOVALUEMARKER:
+                    # a missing field groups as null
+                    value = None
+                res[name] = value
+            return res
+        return getKey
+    return getFunction(key, 'key')
+
+
+def group(collection, key, condition, initial, reduce, finalize=None,
+    session=None):
+    """Group the matching documents like the legacy group command.
+
+    key is a list or dict of field names or a callable returning the key
+    dict of a document (keyf). reduce(doc, aggregate) updates the aggregate
+    which starts as a copy of initial. Runs in one process, the aggregates
+    can't get merged without a combine function.
+    """
+    getKey = _getGroupKey(key)
+    reducer = getFunction(reduce, 'reduce')
+    finalize = getFunction(finalize, 'finalize')
+    cursor = FakeCursor(collection, condition or {}, None, 0, 0, True, True,
+        False, session=session)
+    groups = {}
+    for k, doc in cursor._matching(collection):
+        doc = copyDocument(doc)
+        groupKey = getKey(doc)
+        h = hashable(groupKey)
+        aggregate = groups.get(h)
+        if aggregate is None:
+            aggregate = groups[h] = dict(groupKey)
+            aggregate.update(copyDocument(initial))
+        reducer(doc, aggregate)
+    res = []
+    for aggregate in groups.values():
+        if finalize is not None:
+            value = finalize(aggregate)
+            if value is not None:
+                aggregate = value
+        res.append(aggregate)
+    return res
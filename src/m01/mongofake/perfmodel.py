@@ -0,0 +1,487 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Performance model
+
+A PerformanceModel adds the latency of a real server to the operations of a
+fake client. The latency of an operation is:
+
+- a sample of the latency distribution of the operation (Fixed, Normal or
+  Empirical from a recorded histogram, samples or a workload trace)
+
+- plus perDocument seconds per examined document
+
+- plus a sample of the tail distribution with the tail probability
+
+- plus the time waiting for a free slot if the node has a throughput cap
+
+The model sleeps on its clock. A RealClock sleeps, a VirtualClock only
+advances the virtual time of the calling thread or asyncio task. Capacity
+planning simulations with a VirtualClock run faster than real time, the
+virtual time tells how long the workload would take.
+
+find returns a lazy cursor, the model applies when the cursor executes the
+query (find) and fetches more batches (getMore). Calls within an operation,
+e.g. the find of a find_one, are part of the outer operation.
+
+AsyncClient wraps a fake client for asyncio code. The operations run
+without blocking and await the modeled latency.
+"""
+import asyncio
+import bisect
+import contextvars
+import math
+import random
+import threading
+import time
+
+from m01.mongofake import Histogram
+
+# the smallest throughput cap window in seconds
+MIN_WINDOW = 0.001
+
+# the examined document count of the running operation
+_operation = contextvars.ContextVar('m01.mongofake.perfmodel.operation',
+    default=None)
+
+# the (clock, seconds) delays of async calls, awaited after the call
+_pending = contextvars.ContextVar('m01.mongofake.perfmodel.pending',
+    default=None)
+
+
+###############################################################################
+#
+# latency distributions
+#
+###############################################################################
+
+class Fixed(object):
+    """Fixed latency in seconds"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def sample(self, rng):
+        return self.value
+
+
+class Normal(object):
+    """Normal distributed latency, at least minimum seconds"""
+
+    def __init__(self, mean, stddev, minimum=0.0):
+        self.mean = mean
+        self.stddev = stddev
+        self.minimum = minimum
+
+    def sample(self, rng):
+        return max(self.minimum, rng.gauss(self.mean, self.stddev))
+
+
+class Empirical(object):
+    """Latency distribution from recorded samples or a histogram.
+
+    histogram is a Histogram or its toDict result. A sample of a bucket is
+    uniform distributed between the lower and the upper bound, the upper
+    bound of the last (infinite) bucket is the histogram max.
+    """
+
+    def __init__(self, samples=None, histogram=None):
+        if (samples is None) == (histogram is None):
+            raise ValueError("samples or histogram required")
+        self.samples = samples and list(samples)
+        if samples is not None and not self.samples:
+            raise ValueError("no samples")
+        self._ranges = []
+        self._cumulated = []
+        if histogram is not None:
+            if isinstance(histogram, Histogram):
+                histogram = histogram.toDict()
+            lower = 0.0
+            total = 0
+            for upper, count in histogram['buckets']:
+                if upper == float('inf'):
+                    upper = max(lower, histogram.get('max', lower))
+                if count:
+                    total += count
+                    self._ranges.append((lower, upper))
+                    self._cumulated.append(total)
+                lower = upper
+            if not total:
+                raise ValueError("empty histogram")
+
+    @classmethod
+    def fromTrace(cls, trace, op, format=None):
+        """Return the distribution of the recorded durations of op in a
+        workload trace (file name, stream or list of entries)"""
+        from m01.mongofake.workload import readTrace
+        if not isinstance(trace, list):
+            trace = readTrace(trace, format)
+        return cls([entry['ms'] / 1000.0 for entry in trace
+                    if entry['op'] == op])
+
+    def sample(self, rng):
+        if self.samples is not None:
+            return rng.choice(self.samples)
+        idx = bisect.bisect_right(self._cumulated,
+            rng.random() * self._cumulated[-1])
+        lower, upper = self._ranges[min(idx, len(self._ranges) - 1)]
+        return rng.uniform(lower, upper)
+
+
+def getDistribution(spec):
+    """Return a latency distribution for seconds, a Histogram, a histogram
+    dict, a list of samples or a distribution"""
+    if spec is None or hasattr(spec, 'sample'):
+        return spec
+    if isinstance(spec, (int, float)):
+        return Fixed(spec)
+    if isinstance(spec, (Histogram, dict)):
+        return Empirical(histogram=spec)
+    if isinstance(spec, (list, tuple)):
+        return Empirical(spec)
+    raise TypeError("unknown latency distribution %r" % (spec,))
+
+
+###############################################################################
+#
+# clocks
+#
+###############################################################################
+
+class RealClock(object):
+    """Wall clock, sleeping blocks the caller"""
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    async def asleep(self, seconds):
+        await asyncio.sleep(max(0, seconds))
+
+
+class VirtualClock(object):
+    """Virtual clock, sleeping advances the virtual time without waiting.
+
+    Each thread and asyncio task has its own virtual time, it starts at
+    start in a new thread and at the virtual time of the creating task in a
+    new task. Concurrent sleeps overlap like on a real clock. now is the
+    latest virtual time of all threads and tasks.
+    """
+
+    def __init__(self, start=0.0):
+        self.start = start
+        self._now = contextvars.ContextVar('m01.mongofake.perfmodel.now')
+        self._lock = threading.Lock()
+        self._latest = start
+
+    def time(self):
+        return self._now.get(self.start)
+
+    def sleep(self, seconds):
+        now = self.time() + max(0, seconds)
+        self._now.set(now)
+        with self._lock:
+            if now > self._latest:
+                self._latest = now
+
+    async def asleep(self, seconds):
+        self.sleep(seconds)
+        # let the other tasks run
+        await asyncio.sleep(0)
+
+    @property
+    def now(self):
+        return self._latest
+
+
+def getClock(clock):
+    if clock is None or clock == 'real':
+        return RealClock()
+    if clock == 'virtual':
+        return VirtualClock()
+    return clock
+
+
+###############################################################################
+#
+# model
+#
+###############################################################################
+
+class _Operation(object):
+    """Context applying the model to an operation"""
+
+    def __init__(self, model, name, client):
+        self.model = model
+        self.name = name
+        self.client = client
+        self.token = None
+
+    def __enter__(self):
+        if _operation.get() is None:
+            # not nested, count the examined documents
+            self.token = _operation.set([0])
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.token is None:
+            return
+        examined = _operation.get()[0]
+        _operation.reset(self.token)
+        self.model.wait(self.name, examined, self.client)
+
+
+def _getCapacity(perWindow, window):
+    # the slots of a throughput cap window, the fraction of a slot carries
+    # over, e.g. 1.5 slots per window give 1, 2, 1, 2, ... slots. The
+    # epsilon absorbs the rounding error of 1.0 / rate
+    return (int(math.floor(perWindow * (window + 1) + 1e-9)) -
+            int(math.floor(perWindow * window + 1e-9)))
+
+
+class PerformanceModel(object):
+    """Latency and throughput model of the server.
+
+    latency is a distribution (see getDistribution) for all operations or a
+    dict of operation name: distribution with an optional '*' default.
+    perDocument is the cost in seconds per examined document. throughput
+    caps the operations per second of a node, a number for all nodes or a
+    dict of 'host:port': rate. tail is a (probability, distribution) tuple
+    of extra latency injected into some operations. clock is 'real'
+    (default), 'virtual' or a clock.
+    """
+
+    def __init__(self, latency=None, perDocument=0.0, throughput=None,
+        tail=None, clock=None, seed=None):
+        if not isinstance(latency, dict):
+            latency = {'*': latency}
+        self.latency = dict([(k, getDistribution(v))
+                             for k, v in latency.items()])
+        self.perDocument = perDocument
+        self.throughput = throughput
+        if tail is not None:
+            tail = (tail[0], getDistribution(tail[1]))
+        self.tail = tail
+        self.clock = getClock(clock)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        # node: {window: used slots}, node: first window which isn't full
+        # or passed, the windows before it get pruned
+        self._windows = {}
+        self._first = {}
+        # metrics
+        self._latencies = {}
+        self.examined = 0
+        self.tails = 0
+        self.throttled = 0
+        self.queued = 0.0
+
+    def operation(self, name, client):
+        """Return a context applying the model to the operation name on the
+        node of client"""
+        return _Operation(self, name, client)
+
+    def call(self, collection, name, func, args, kwargs):
+        """Call a collection method and apply the model"""
+        with _Operation(self, name, collection._client):
+            return func(collection, *args, **kwargs)
+
+    def examine(self, items):
+        """Count the (key, doc) items examined by the running operation"""
+        counter = _operation.get()
+        if counter is None:
+            return items
+
+        def examined():
+            for item in items:
+                counter[0] += 1
+                yield item
+        return examined()
+
+    def _getRate(self, node):
+        if isinstance(self.throughput, dict):
+            return self.throughput.get(node)
+        return self.throughput
+
+    def _queue(self, node, now):
+        # reserve a slot of the node, returns the waiting time
+        rate = self._getRate(node)
+        if not rate:
+            return 0.0
+        width = max(1.0 / rate, MIN_WINDOW)
+        perWindow = rate * width
+        windows = self._windows.setdefault(node, {})
+        window = int(now / width)
+        first = self._first.get(node, window)
+        if isinstance(self.clock, RealClock) and window > first:
+            # all threads share the time, the passed windows can't get used
+            if window - first > len(windows):
+                for key in [key for key in windows if key < window]:
+                    del windows[key]
+            else:
+                for key in range(first, window):
+                    windows.pop(key, None)
+            first = window
+        window = max(window, first)
+        while windows.get(window, 0) >= _getCapacity(perWindow, window):
+            window += 1
+        windows[window] = windows.get(window, 0) + 1
+        # skip and prune the full windows
+        while windows.get(first, 0) >= _getCapacity(perWindow, first):
+            del windows[first]
+            first += 1
+        self._first[node] = first
+        return max(0.0, window * width - now)
+
+    def getLatency(self, name, examined=0, node=None):
+        """Return the modeled latency of an operation in seconds and
+        reserve its throughput slot"""
+        with self._lock:
+            rng = self._rng
+            dist = self.latency.get(name, self.latency.get('*'))
+            latency = dist is not None and dist.sample(rng) or 0.0
+            latency += examined * self.perDocument
+            if self.tail is not None and rng.random() < self.tail[0]:
+                latency += self.tail[1].sample(rng)
+                self.tails += 1
+            queued = self._queue(node, self.clock.time())
+            if queued:
+                self.throttled += 1
+                self.queued += queued
+            latency += queued
+            histogram = self._latencies.get(name)
+            if histogram is None:
+                histogram = self._latencies[name] = Histogram()
+            histogram.add(latency)
+            self.examined += examined
+        return latency
+
+    def wait(self, name, examined=0, client=None):
+        """Wait the modeled latency of an operation on the clock"""
+        node = client is not None and '%s:%s' % (client.host, client.port) \
+            or None
+        latency = self.getLatency(name, examined, node)
+        pending = _pending.get()
+        if pending is not None:
+            # awaited by the async caller
+            pending.append((self.clock, latency))
+        else:
+            self.clock.sleep(latency)
+
+    def stats(self):
+        """Return the modeled latency histograms per operation and the
+        counters"""
+        with self._lock:
+            return {'operations': dict([(name, h.toDict())
+                        for name, h in self._latencies.items()]),
+                    'examined': self.examined,
+                    'tails': self.tails,
+                    'throttled': self.throttled,
+                    'queued': self.queued,
+                    'time': getattr(self.clock, 'now', None)}
+
+
+###############################################################################
+#
+# asyncio support
+#
+###############################################################################
+
+async def _call(func, *args):
+    # call func without blocking and await the modeled latency
+    pending = []
+    token = _pending.set(pending)
+    try:
+        res = func(*args)
+    finally:
+        _pending.reset(token)
+    for clock, seconds in pending:
+        await clock.asleep(seconds)
+    return res
+
+
+class AsyncCursor(object):
+    """Cursor for asyncio code"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    async def to_list(self, length=None):
+        """Return at most length documents (all if None)"""
+        res = []
+        while length is None or len(res) < length:
+            doc = await _call(next, self.cursor, None)
+            if doc is None:
+                break
+            res.append(doc)
+        return res
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        doc = await _call(next, self.cursor, None)
+        if doc is None:
+            raise StopAsyncIteration
+        return doc
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class AsyncCollection(object):
+    """Collection for asyncio code, the methods are coroutines. find returns
+    an AsyncCursor."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            return await _call(lambda: method(*args, **kwargs))
+        return call
+
+
+class AsyncDatabase(object):
+
+    def __init__(self, database):
+        self.database = database
+
+    def __getattr__(self, name):
+        return AsyncCollection(self.database[name])
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+
+class AsyncClient(object):
+    """Fake client for asyncio code"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return AsyncDatabase(self.client[name])
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Raw BSON storage
+
+The RawBSONData storage keeps each document as encoded BSON in one
+contiguous bytearray (arena). Documents get returned as LazyBSONDocument and
+only get decoded if a query, sort or projection touches them. This costs a
+fraction of the memory used by the default OrderedData storage.
+"""
+import struct
+
+import pymongo.errors
+
+from m01.mongofake import LazyBSONDocument
+from m01.mongofake import encodeBSON
+
+INT32 = struct.Struct('<i')
+
+try:
+    DocumentTooLarge = pymongo.errors.DocumentTooLarge
+except AttributeError:
+    # pymongo < 2.7
+    DocumentTooLarge = pymongo.errors.InvalidDocument
+
+
+class RawBSONData(object):
+    """Storage keeping encoded BSON documents in a contiguous arena.
+
+    Provides the same API as OrderedData. Replaced and removed documents
+    leave garbage in the arena which gets compacted if more than half of the
+    arena is garbage. The insert order is kept by the (ordered) offsets dict.
+    """
+
+    # don't compact small arenas
+    minCompactSize = 1024 * 1024
+
+    def __init__(self, max_bson_size=None):
+        self.max_bson_size = max_bson_size
+        self.arena = bytearray()
+        self.garbage = 0
+        self._offsets = {}
+
+    @property
+    def size(self):
+        """Size of all stored documents"""
+        return len(self.arena) - self.garbage
+
+    def _size(self, offset):
+        return INT32.unpack_from(self.arena, offset)[0]
+
+    def _read(self, offset):
+        return bytes(self.arena[offset:offset + self._size(offset)])
+
+    def compact(self):
+        """Rewrite the arena without garbage"""
+        arena = bytearray()
+        offsets = {}
+        for key, offset in self._offsets.items():
+            offsets[key] = len(arena)
+            arena += self.arena[offset:offset + self._size(offset)]
+        self.arena = arena
+        self._offsets = offsets
+        self.garbage = 0
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __getitem__(self, key):
+        return LazyBSONDocument(self._read(self._offsets[key]))
+
+    def __setitem__(self, key, item):
+        if isinstance(item, LazyBSONDocument):
+            data = item.raw
+        else:
+            data = encodeBSON(item)
+        size = len(data)
+        if self.max_bson_size is not None and size > self.max_bson_size:
+            raise DocumentTooLarge("BSON document too large (%d bytes) - the "
+                "connected server supports BSON document sizes up to %d "
+                "bytes." % (size, self.max_bson_size))
+        offset = self._offsets.get(key)
+        if offset is not None:
+            self.garbage += self._size(offset)
+        self._offsets[key] = len(self.arena)
+        self.arena += data
+        self._checkCompact()
+
+    def __delitem__(self, key):
+        offset = self._offsets.pop(key)
+        self.garbage += self._size(offset)
+        self._checkCompact()
+
+    def _checkCompact(self):
+        if (self.garbage > self.minCompactSize and
+            self.garbage * 2 > len(self.arena)):
+            self.compact()
+
+    def get(self, key, default=None):
+        """Get item by key"""
+        if key in self._offsets:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self._offsets.keys())
+
+    def values(self):
+        for key in self.keys():
+            yield self[key]
+
+    def items(self):
+        for key in self.keys():
+            yield (key, self[key])
+
+    def __iter__(self):
+        return self.values()
+
+    def __repr__(self):
+        return repr(list(self.values()))
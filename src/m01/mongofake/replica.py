@@ -0,0 +1,313 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Replica set simulation
+
+A FakeReplicaSet adds secondaries to a fake client which acts as primary.
+Each committed write of the primary gets appended to the oplog and queued
+for every secondary. A secondary applies the entries in its own thread to its
+own copy of the data, each entry not before the configured replication lag
+passed. Reads get routed by the read preference to the primary or to one of
+the secondaries and are served from the secondary copy, so reads don't
+share the primary lock and may be stale.
+"""
+import collections
+import itertools
+import random
+import threading
+import time
+
+import pymongo.errors
+import six
+
+from m01.mongofake import MISSING
+from m01.mongofake import copyDocument
+
+try:
+    ServerSelectionTimeoutError = pymongo.errors.ServerSelectionTimeoutError
+except AttributeError:
+    # pymongo < 3.0
+    ServerSelectionTimeoutError = pymongo.errors.AutoReconnect
+
+# read preference modes like pymongo.read_preferences
+PRIMARY = 0
+PRIMARY_PREFERRED = 1
+SECONDARY = 2
+SECONDARY_PREFERRED = 3
+NEAREST = 4
+
+MODES = {'primary': PRIMARY,
+         'primarypreferred': PRIMARY_PREFERRED,
+         'secondary': SECONDARY,
+         'secondarypreferred': SECONDARY_PREFERRED,
+         'nearest': NEAREST}
+
+
+def getMode(read_preference):
+    """Return the mode of a pymongo read preference, mode number or name"""
+    if read_preference is None:
+        return PRIMARY
+    if isinstance(read_preference, six.string_types):
+        return MODES[read_preference.lower()]
+    # pymongo >= 3.0 uses read preference instances
+    return getattr(read_preference, 'mode', read_preference)
+
+
+# oplog entry, op is 'w' for a document write or 'c' for a command
+OplogEntry = collections.namedtuple('OplogEntry',
+    ['ts', 'wall', 'op', 'db', 'collection', 'key', 'doc', 'args'])
+
+
+class FakeSecondary(object):
+    """Secondary applying the oplog of the primary to its own fake client.
+
+    The data lives in a separate FakeMongoClient which is used for reads.
+    The optional applied condition gets notified after each applied entry.
+    """
+
+    def __init__(self, node, lag=0.0, applied=None):
+        from m01.mongofake import FakeMongoClient
+        self.node = node
+        self.lag = lag
+        self._applied = applied
+        self.client = FakeMongoClient()(node[0], node[1])
+        self.optime = 0
+        self.wall = None
+        self.applied = 0
+        self.reads = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = threading.Event()
+        self._running.set()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+            name='m01.mongofake secondary %s:%d' % node)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def pending(self):
+        """Number of not yet applied oplog entries"""
+        return len(self._queue)
+
+    def enqueue(self, entry):
+        with self._cond:
+            self._queue.append(entry)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                entry = self._queue[0]
+            wait = entry.wall + self.lag - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self._running.wait()
+            if self._stopped:
+                return
+            self._apply(entry)
+            with self._cond:
+                self._queue.popleft()
+                self.optime = entry.ts
+                self.wall = entry.wall
+                self.applied += 1
+                self._cond.notify_all()
+            if self._applied is not None:
+                with self._applied:
+                    self._applied.notify_all()
+
+    def _apply(self, entry):
+        client = self.client
+        if entry.op == 'w':
+            collection = client[entry.db][entry.collection]
+            with client._lock:
+                client._clock = entry.ts
+                collection._commit(entry.key, entry.doc, entry.ts)
+        else:
+            # a client, database or collection command
+            target = client
+            if entry.db is not None:
+                target = client[entry.db]
+            if entry.collection is not None:
+                target = target[entry.collection]
+            command, args, kwargs = entry.args
+            getattr(target, command)(*args, **kwargs)
+
+    def waitFor(self, optime, timeout=None):
+        """Wait until the optime got applied, returns False on timeout"""
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._cond:
+            while self.optime < optime:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def pause(self):
+        """Stop applying the oplog, e.g. to test stale reads"""
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._running.set()
+        self._thread.join()
+
+    def __repr__(self):
+        return '<FakeSecondary %s:%d>' % self.node
+
+
+class FakeReplicaSet(object):
+    """One primary (the fake client) and N secondaries.
+
+    lag is the replication lag in seconds, a number for all secondaries or
+    a list with one lag per secondary.
+    """
+
+    def __init__(self, client, name='rs0', secondaries=2, lag=0.0):
+        self.client = client
+        self.name = name
+        host = client.host or client.HOST
+        port = client.port or client.PORT
+        self.primary = (host, port)
+        if not isinstance(lag, (list, tuple)):
+            lag = [lag] * secondaries
+        # notified by the secondaries after applying an oplog entry
+        self._applied = threading.Condition()
+        self.secondaries = [FakeSecondary((host, port + i + 1), lag[i],
+                                          self._applied)
+                            for i in range(secondaries)]
+        self.optime = 0
+        self.oplog = collections.deque(maxlen=10000)
+        self._next = itertools.cycle(range(max(secondaries, 1)))
+        self._random = random.Random()
+        self.primaryReads = 0
+
+    @property
+    def nodes(self):
+        return [self.primary] + [s.node for s in self.secondaries]
+
+    # oplog
+    def _append(self, entry):
+        self.optime = max(self.optime, entry.ts)
+        self.oplog.append(entry)
+        for secondary in self.secondaries:
+            secondary.enqueue(entry)
+
+    def logWrite(self, collection, key, doc, ts):
+        """Log a committed write, the primary lock is acquired"""
+        if doc is not MISSING:
+            # the secondaries must not share nested values with the primary
+            doc = copyDocument(doc)
+        self._append(OplogEntry(ts, time.time(), 'w',
+            collection.database.name, collection.name, key, doc, None))
+
+    def logCommand(self, db, collection, command, *args, **kwargs):
+        """Log a command replayed on the client (db is None), database
+        (collection is None) or collection of the secondaries"""
+        with self.client._lock:
+            self._append(OplogEntry(self.client._tick(), time.time(), 'c', db,
+                collection, None, None, (command, args, kwargs)))
+
+    # routing
+    def select(self, read_preference):
+        """Return the client serving a read, the primary or a secondary"""
+        mode = getMode(read_preference)
+        if mode in (PRIMARY, PRIMARY_PREFERRED):
+            self.primaryReads += 1
+            return self.client
+        if mode == NEAREST:
+            idx = self._random.randint(0, len(self.secondaries))
+            if idx == len(self.secondaries):
+                self.primaryReads += 1
+                return self.client
+            secondary = self.secondaries[idx]
+        elif not self.secondaries:
+            if mode == SECONDARY_PREFERRED:
+                self.primaryReads += 1
+                return self.client
+            raise ServerSelectionTimeoutError(
+                "No replica set members match selector \"Secondary\"")
+        else:
+            secondary = self.secondaries[next(self._next)]
+        secondary.reads += 1
+        return secondary.client
+
+    def sync(self, timeout=None):
+        """Wait until all secondaries applied the oplog"""
+        optime = self.optime
+        return all([s.waitFor(optime, timeout) for s in self.secondaries])
+
+    def waitForWrite(self, w, wtimeout=None):
+        """Wait until w members (or the majority) applied the last write.
+
+        The primary and any w - 1 secondaries count. wtimeout is given in
+        milliseconds like in MongoDB and applies to the whole wait.
+        """
+        members = len(self.secondaries) + 1
+        if w == 'majority':
+            w = members // 2 + 1
+        if w > members:
+            raise pymongo.errors.OperationFailure(
+                "Not enough data-bearing nodes", 100)
+        optime = self.optime
+        end = wtimeout and time.time() + wtimeout / 1000.0 or None
+        with self._applied:
+            while len([s for s in self.secondaries
+                       if s.optime >= optime]) < w - 1:
+                if end is None:
+                    self._applied.wait()
+                    continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise pymongo.errors.WTimeoutError(
+                        "waiting for replication timed out", 64)
+                self._applied.wait(remaining)
+
+    def close(self):
+        for secondary in self.secondaries:
+            secondary.stop()
+
+    def stats(self):
+        """Return the replication state of each member"""
+        now = time.time()
+        members = [{'name': u'%s:%d' % self.primary,
+                    'stateStr': u'PRIMARY',
+                    'optime': self.optime,
+                    'reads': self.primaryReads}]
+        for secondary in self.secondaries:
+            with secondary._cond:
+                behind = len(secondary._queue)
+                # seconds since the oldest not applied write
+                lag = behind and now - secondary._queue[0].wall or 0.0
+            members.append({'name': u'%s:%d' % secondary.node,
+                            'stateStr': u'SECONDARY',
+                            'optime': secondary.optime,
+                            'applied': secondary.applied,
+                            'pending': behind,
+                            'lagSeconds': lag,
+                            'reads': secondary.reads})
+        return {'set': self.name, 'members': members}
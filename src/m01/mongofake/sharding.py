@@ -0,0 +1,403 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Sharded collection simulator
+
+The ShardedData storage splits the documents of a FakeCollection into chunks
+by a range or hashed shard key. Each chunk lives on one of N shards and each
+shard keeps its documents in an OrderedData storage. A chunk gets split if it
+contains more than chunkSize documents and the balancer moves chunks from the
+shard with the most chunks to the shard with the fewest.
+
+Queries get routed like mongos does. A query with an equality or $in (or a
+range for range sharding) on the shard key only runs on the shards owning
+the matching chunks. Other queries fan out to all shards on a thread pool,
+each shard matches and sorts its own documents and the sorted results get
+merged.
+"""
+import bisect
+import hashlib
+import heapq
+import struct
+import threading
+from multiprocessing.pool import ThreadPool
+
+import bson.int64
+import six
+
+from m01.mongofake import NOVALUEMARKER
+from m01.mongofake import OrderedData
+from m01.mongofake import encodeBSON
+from m01.mongofake import getField
+from m01.mongofake import sortKey
+
+INT64 = struct.Struct('<q')
+
+# the hashed key space
+MIN_HASH = -2 ** 63
+MAX_HASH = 2 ** 63
+
+RANGE_OPERATORS = frozenset(['$gt', '$gte', '$lt', '$lte'])
+
+
+def hashKey(value):
+    """Return the 64 bit hash of a shard key value (md5 like MongoDB)"""
+    if isinstance(value, six.integer_types + (float,)) and \
+            not isinstance(value, bool) and MIN_HASH <= value < MAX_HASH:
+        # numbers hash as int64 like in MongoDB, 1 and 1.0 are the same key
+        value = bson.int64.Int64(value)
+    data = encodeBSON({'': value})
+    return INT64.unpack_from(hashlib.md5(data).digest())[0]
+
+
+class Chunk(object):
+    """Key range [min, max) living on one shard. None is MinKey/MaxKey"""
+
+    def __init__(self, shard, min=None, max=None):
+        self.shard = shard
+        self.min = min
+        self.max = max
+        self.keys = set()
+        # can't get split, all documents share the same shard key
+        self.jumbo = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return '<Chunk shard%04d %r-%r %d>' % (self.shard, self.min, self.max,
+            len(self.keys))
+
+
+class _MergeKey(object):
+    """Sort key for merging the sorted shard results"""
+
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, doc, sort):
+        self.values = []
+        self.directions = []
+        for name, direction in sort:
+            if isinstance(direction, dict):
+                # {'$meta': 'textScore'}, no score without $text
+                continue
+            self.values.append(sortKey(getField(doc, name), direction < 0))
+            self.directions.append(direction)
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return self.values != other.values
+
+    def __lt__(self, other):
+        for a, b, d in zip(self.values, other.values, self.directions):
+            if a != b:
+                return d < 0 and a > b or d > 0 and a < b
+        return False
+
+
+class ShardedData(object):
+    """Storage splitting the documents into chunks living on N shards.
+
+    Provides the same API as OrderedData. The key is a shard key like
+    {'region': 1} or {'userId': 'hashed'}. Hashed keys get pre-split into
+    two chunks per shard, range keys start with one chunk on the first
+    shard.
+
+    With parallel the fanned out queries run on a thread pool. Matching is
+    Python code holding the GIL, the threads don't run the shards on more
+    than one CPU, the pool models the routing and merging of mongos. The
+    collection closes the pool when the storage gets replaced or cleared.
+    """
+
+    sharded = True
+
+    # number of chunks the shards may differ before the balancer moves one
+    migrationThreshold = 2
+
+    def __init__(self, key, shards=2, chunkSize=1000, parallel=True):
+        if isinstance(key, dict):
+            key = list(key.items())
+        self.key = [(k, d) for k, d in key]
+        self.fields = [k for k, d in self.key]
+        self.hashed = 'hashed' in [d for k, d in self.key]
+        if self.hashed and len(self.key) > 1:
+            raise ValueError("hashed shard keys must be a single field")
+        if shards < 1:
+            raise ValueError("shards must be a positive number")
+        self.chunkSize = chunkSize
+        self.parallel = parallel
+        self.shards = [OrderedData() for i in range(shards)]
+        self._pool = None
+        self._lock = threading.Lock()
+        # key: chunk and key: bound (sortable shard key value)
+        self._chunkOf = {}
+        self._boundOf = {}
+        # metrics
+        self.splits = 0
+        self.migrations = 0
+        self.targeted = 0
+        self.broadcast = 0
+        self.queries = [0] * shards
+        self.writes = [0] * shards
+        if self.hashed:
+            count = shards * 2
+            step = (MAX_HASH - MIN_HASH) // count
+            bounds = [MIN_HASH + i * step for i in range(1, count)]
+            mins = [None] + bounds
+            maxs = bounds + [None]
+            self.chunks = [Chunk(i % shards, mins[i], maxs[i])
+                           for i in range(count)]
+        else:
+            self.chunks = [Chunk(0)]
+        self._bounds = [c.min for c in self.chunks[1:]]
+
+    def shardName(self, shard):
+        return u'shard%04d' % shard
+
+    # routing
+    def _bound(self, values):
+        # return the sortable bound of the shard key values
+        if self.hashed:
+            return hashKey(values[0])
+        return tuple([sortKey(v) for v in values])
+
+    def _docBound(self, doc):
+        values = []
+        for name in self.fields:
+            value = getField(doc, name)
+            if value is NOVALUEMARKER:
+                # a missing shard key is null like in MongoDB
+                value = None
+            elif isinstance(value, (list, tuple)):
+                raise ValueError("shard key %s cannot contain array values"
+                    % name)
+            values.append(value)
+        return self._bound(values)
+
+    def _chunkIndex(self, bound):
+        return bisect.bisect_right(self._bounds, bound)
+
+    def _chunkFor(self, bound):
+        return self.chunks[self._chunkIndex(bound)]
+
+    def target(self, spec):
+        """Return the shards the query must run on"""
+        values = []
+        for name in self.fields:
+            if name not in spec:
+                return list(range(len(self.shards)))
+            value = spec[name]
+            if isinstance(value, dict) and [k for k in value
+                                            if k.startswith('$')]:
+                break
+            values.append(value)
+        if len(values) == len(self.fields):
+            return [self._chunkFor(self._bound(values)).shard]
+        if len(self.fields) > 1:
+            return list(range(len(self.shards)))
+        # all conditions must match, each one can narrow the shards
+        query = spec[self.fields[0]]
+        if '$in' in query:
+            shards = set()
+            for value in query['$in']:
+                shards.add(self._chunkFor(self._bound([value])).shard)
+            return sorted(shards)
+        if not self.hashed and RANGE_OPERATORS.intersection(query):
+            first = 0
+            last = len(self.chunks) - 1
+            for op in ('$gt', '$gte'):
+                if op in query:
+                    first = self._chunkIndex(self._bound([query[op]]))
+            for op in ('$lt', '$lte'):
+                if op in query:
+                    last = self._chunkIndex(self._bound([query[op]]))
+            return sorted(set([c.shard for c in self.chunks[first:last + 1]]))
+        return list(range(len(self.shards)))
+
+    def scatterGather(self, cursor, spec, sort=None):
+        """Run the query on the targeted shards and merge the results.
+
+        Returns the matching (key, doc) items ordered by sort.
+        """
+        shards = self.target(spec)
+        with self._lock:
+            if len(shards) < len(self.shards):
+                self.targeted += 1
+            else:
+                self.broadcast += 1
+            for shard in shards:
+                self.queries[shard] += 1
+
+        def run(shard):
+            return cursor._find(self.shards[shard].items(), spec, sort, {})
+
+        if self.parallel and len(shards) > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(len(self.shards))
+            results = self._pool.map(run, shards)
+        else:
+            results = [run(shard) for shard in shards]
+        if len(results) == 1:
+            return results[0]
+        if not sort:
+            return [item for found in results for item in found]
+        # merge the sorted shard results
+        streams = [[(_MergeKey(doc, sort), i, n, (key, doc))
+                    for n, (key, doc) in enumerate(found)]
+                   for i, found in enumerate(results)]
+        return [entry[3] for entry in heapq.merge(*streams)]
+
+    def close(self):
+        """Stop the scatter-gather thread pool, a query starts a new one"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    # chunk management
+    def _split(self, chunk):
+        """Split the chunk at its median shard key"""
+        bounds = sorted([self._boundOf[key] for key in chunk.keys])
+        middle = bounds[len(bounds) // 2]
+        if middle == bounds[0]:
+            idx = bisect.bisect_right(bounds, middle)
+            if idx == len(bounds):
+                chunk.jumbo = True
+                return
+            middle = bounds[idx]
+        new = Chunk(chunk.shard, middle, chunk.max)
+        chunk.max = middle
+        for key in [k for k in chunk.keys if self._boundOf[k] >= middle]:
+            chunk.keys.remove(key)
+            new.keys.add(key)
+            self._chunkOf[key] = new
+        idx = self.chunks.index(chunk) + 1
+        self.chunks.insert(idx, new)
+        self._bounds.insert(idx - 1, middle)
+        self.splits += 1
+        self._balance()
+
+    def _balance(self):
+        """Move chunks until the shards differ less than the threshold"""
+        while True:
+            counts = self.chunkCounts()
+            source = counts.index(max(counts))
+            target = counts.index(min(counts))
+            if counts[source] - counts[target] < self.migrationThreshold:
+                return
+            chunk = [c for c in self.chunks if c.shard == source][-1]
+            self._migrate(chunk, target)
+
+    def _migrate(self, chunk, shard):
+        # move the chunk documents to the given shard
+        source = self.shards[chunk.shard]
+        target = self.shards[shard]
+        # the documents don't get copied and the order list of the source
+        # only gets rebuilt once
+        for key in chunk.keys:
+            target.data[key] = source.data.pop(key)
+            target._order.append(key)
+        source._order = [k for k in source._order if k in source.data]
+        chunk.shard = shard
+        self.migrations += 1
+
+    def chunkCounts(self):
+        """Return the number of chunks per shard"""
+        counts = [0] * len(self.shards)
+        for chunk in self.chunks:
+            counts[chunk.shard] += 1
+        return counts
+
+    # storage API
+    def __len__(self):
+        return len(self._chunkOf)
+
+    def __contains__(self, key):
+        return key in self._chunkOf
+
+    def __getitem__(self, key):
+        return self.shards[self._chunkOf[key].shard][key]
+
+    def get(self, key, default=None):
+        chunk = self._chunkOf.get(key)
+        if chunk is None:
+            return default
+        return self.shards[chunk.shard].get(key, default)
+
+    def __setitem__(self, key, doc):
+        bound = self._docBound(doc)
+        chunk = self._chunkFor(bound)
+        old = self._chunkOf.get(key)
+        if old is not None and old is not chunk:
+            # the shard key changed
+            del self[key]
+        self.shards[chunk.shard][key] = doc
+        self.writes[chunk.shard] += 1
+        chunk.keys.add(key)
+        self._chunkOf[key] = chunk
+        self._boundOf[key] = bound
+        if len(chunk.keys) > self.chunkSize and not chunk.jumbo:
+            self._split(chunk)
+
+    def __delitem__(self, key):
+        chunk = self._chunkOf.pop(key)
+        del self._boundOf[key]
+        chunk.keys.discard(key)
+        del self.shards[chunk.shard][key]
+
+    def keys(self):
+        return [key for shard in self.shards for key in shard.keys()]
+
+    def values(self):
+        for shard in self.shards:
+            for doc in shard.values():
+                yield doc
+
+    def items(self):
+        for shard in self.shards:
+            for item in shard.items():
+                yield item
+
+    def __iter__(self):
+        return self.values()
+
+    def __repr__(self):
+        return '<%s %s %d shards>' % (self.__class__.__name__, self.key,
+            len(self.shards))
+
+    def stats(self):
+        """Return the per shard load and the chunk balance"""
+        with self._lock:
+            counts = self.chunkCounts()
+            shards = []
+            for i, storage in enumerate(self.shards):
+                shards.append({'shard': self.shardName(i),
+                               'count': len(storage),
+                               'chunks': counts[i],
+                               'queries': self.queries[i],
+                               'writes': self.writes[i]})
+            mean = float(len(self)) / len(self.shards)
+            docs = [len(storage) for storage in self.shards]
+            return {'key': self.key,
+                    'shards': shards,
+                    'chunks': len(self.chunks),
+                    'jumbo': len([c for c in self.chunks if c.jumbo]),
+                    # difference in chunks between the shards
+                    'imbalance': max(counts) - min(counts),
+                    # largest shard compared to the mean, 1.0 is even
+                    'skew': mean and max(docs) / mean or 1.0,
+                    'splits': self.splits,
+                    'migrations': self.migrations,
+                    'targeted': self.targeted,
+                    'broadcast': self.broadcast}
@@ -0,0 +1,344 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Shared fixture store
+
+A SharedStore contains read-only fixture documents encoded as BSON in a
+shared memory segment (or a mmap file if multiprocessing.shared_memory is not
+available). The segment gets built once and many worker processes can attach
+to it by name. Each FakeCollection using a SharedData storage decodes the
+documents from the shared buffer and keeps writes in a per process overlay.
+"""
+import copy
+import mmap
+import os
+import struct
+import tempfile
+import uuid
+
+import bson
+
+from m01.mongofake import decodeBSON
+from m01.mongofake import encodeBSON
+from m01.mongofake import toUnicode
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+MAGIC = b'M01FAKE1'
+# magic, index offset, index size
+HEADER = struct.Struct('<8sQQ')
+INT32 = struct.Struct('<i')
+
+
+###############################################################################
+#
+# segment helpers
+#
+###############################################################################
+
+def _getFilePath(name):
+    return os.path.join(tempfile.gettempdir(), 'm01-mongofake-%s' % name)
+
+
+class _Segment(object):
+    """Shared memory segment or mmap file as fallback"""
+
+    def __init__(self, name, size=None):
+        self.name = name
+        self._shm = None
+        self._mmap = None
+        create = size is not None
+        if shared_memory is not None:
+            if create:
+                self._shm = shared_memory.SharedMemory(name=name, create=True,
+                    size=size)
+            else:
+                self._shm = self._attach(name)
+            self.buf = self._shm.buf
+        else:
+            path = _getFilePath(name)
+            if create:
+                with open(path, 'wb') as f:
+                    f.truncate(size)
+                access = mmap.ACCESS_WRITE
+                mode = 'r+b'
+            else:
+                access = mmap.ACCESS_READ
+                mode = 'rb'
+            with open(path, mode) as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=access)
+            self.buf = memoryview(self._mmap)
+
+    def _attach(self, name):
+        try:
+            # python >= 3.13, don't let the resource tracker of a worker
+            # unlink the segment owned by another process
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            pass
+        # python < 3.13, undo the resource tracker registration
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+    def close(self):
+        buf = self.buf
+        self.buf = None
+        if buf is not None:
+            buf.release()
+        if self._shm is not None:
+            self._shm.close()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def unlink(self):
+        if self._shm is not None:
+            if os.name == 'posix':
+                # a worker sharing the resource tracker of this process
+                # removed the registration when attaching, unlink
+                # unregisters the segment again
+                from multiprocessing import resource_tracker
+                resource_tracker.register(self._shm._name, 'shared_memory')
+            self._shm.unlink()
+        else:
+            path = _getFilePath(self.name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+###############################################################################
+#
+# storage
+#
+###############################################################################
+
+class SharedData(object):
+    """Copy-on-write storage over a shared fixture segment.
+
+    Provides the same API as OrderedData. Documents get decoded from the
+    shared buffer on access. Written or removed documents are tracked in a
+    process local overlay and never touch the shared segment.
+    """
+
+    def __init__(self, store, keys, offsets):
+        self._store = store
+        # shared (per store) base order and offsets, never mutated
+        self._keys = keys
+        self._offsets = offsets
+        # process local overlay
+        self._overlay = {}
+        self._added = []
+        self._deleted = set()
+
+    def _load(self, key):
+        return self._store._read(self._offsets[key])
+
+    def reset(self):
+        """Drop all local changes and expose the shared fixtures again"""
+        self._overlay = {}
+        self._added = []
+        self._deleted = set()
+
+    def __len__(self):
+        return len(self._keys) - len(self._deleted) + len(self._added)
+
+    def __contains__(self, key):
+        if key in self._overlay:
+            return True
+        return key in self._offsets and key not in self._deleted
+
+    def __getitem__(self, key):
+        try:
+            return self._overlay[key]
+        except KeyError:
+            pass
+        if key in self._deleted:
+            raise KeyError(key)
+        return self._load(key)
+
+    def __setitem__(self, key, item):
+        if key in self._offsets:
+            # overwrite or re-add a fixture document
+            self._deleted.discard(key)
+        elif key not in self._overlay:
+            self._added.append(key)
+        self._overlay[key] = copy.deepcopy(item)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._overlay.pop(key, None)
+        if key in self._offsets:
+            self._deleted.add(key)
+        else:
+            self._added.remove(key)
+
+    def get(self, key, default=None):
+        """Get item by key"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        deleted = self._deleted
+        if deleted:
+            keys = [k for k in self._keys if k not in deleted]
+        else:
+            keys = list(self._keys)
+        keys.extend(self._added)
+        return keys
+
+    def values(self):
+        for key in self.keys():
+            yield self[key]
+
+    def items(self):
+        for key in self.keys():
+            yield (key, self[key])
+
+    def __iter__(self):
+        return self.values()
+
+    def __repr__(self):
+        return repr(list(self.values()))
+
+
+###############################################################################
+#
+# shared store
+#
+###############################################################################
+
+class SharedStore(object):
+    """Shared memory segment containing BSON encoded fixture documents.
+
+    The segment layout is a header (magic, index offset, index size) followed
+    by the BSON documents and a BSON encoded index containing the storage
+    keys and document offsets for each collection.
+    """
+
+    def __init__(self, segment, owner=False):
+        self._segment = segment
+        self.owner = owner
+        magic, offset, size = HEADER.unpack_from(segment.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a m01.mongofake shared store: %r" %
+                segment.name)
+        index = decodeBSON(segment.buf[offset:offset + size])
+        self._collections = {}
+        for entry in index['collections']:
+            keys = entry['keys']
+            offsets = dict(zip(keys, entry['offsets']))
+            self._collections[(entry['db'], entry['col'])] = (keys, offsets)
+
+    @property
+    def name(self):
+        return self._segment.name
+
+    @classmethod
+    def create(cls, fixtures, name=None):
+        """Build a new shared store based on the given fixtures.
+
+        The fixtures must be a dict of database names containing a dict of
+        collection names and a list of documents. Documents without an _id
+        will get a new ObjectId.
+        """
+        if name is None:
+            name = 'm01fake_%s' % uuid.uuid4().hex[:16]
+        chunks = []
+        entries = []
+        offset = HEADER.size
+        for dbName, cols in sorted(fixtures.items()):
+            for colName, docs in sorted(cols.items()):
+                keys = []
+                offsets = []
+                for doc in docs:
+                    if doc.get('_id') is None:
+                        doc = dict(doc)
+                        doc[u'_id'] = bson.objectid.ObjectId()
+                    d = {}
+                    for k, v in doc.items():
+                        # use unicode keys as mongodb does
+                        d[toUnicode(k)] = v
+                    data = encodeBSON(d)
+                    keys.append(toUnicode(d['_id']))
+                    offsets.append(offset)
+                    chunks.append(data)
+                    offset += len(data)
+                entries.append({'db': toUnicode(dbName),
+                                'col': toUnicode(colName),
+                                'keys': keys,
+                                'offsets': offsets})
+        index = encodeBSON({'collections': entries})
+        size = offset + len(index)
+        segment = _Segment(name, size)
+        buf = segment.buf
+        HEADER.pack_into(buf, 0, MAGIC, offset, len(index))
+        pos = HEADER.size
+        for data in chunks:
+            end = pos + len(data)
+            buf[pos:end] = data
+            pos = end
+        buf[pos:pos + len(index)] = index
+        return cls(segment, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to an existing shared store by name"""
+        return cls(_Segment(name))
+
+    def _read(self, offset):
+        buf = self._segment.buf
+        size = INT32.unpack_from(buf, offset)[0]
+        return decodeBSON(buf[offset:offset + size])
+
+    def collections(self):
+        """Return the (database name, collection name) tuples"""
+        return sorted(self._collections.keys())
+
+    def getData(self, dbName, colName):
+        """Return a new copy-on-write storage for the given collection"""
+        keys, offsets = self._collections[(dbName, colName)]
+        return SharedData(self, keys, offsets)
+
+    def install(self, client):
+        """Use the shared fixtures as storage in the given (fake) client"""
+        for dbName, colName in self.collections():
+            collection = client[dbName][colName]
+            collection.docs = self.getData(dbName, colName)
+            # count the sizes on demand, see collStats
+            collection._dataSize = None
+            # outdate cached results and index the shared documents
+            collection._version += 1
+            for index in list(collection._indexes.values()):
+                index.clear()
+                collection._buildIndex(index)
+
+    def close(self):
+        """Close the segment, storages using this store can't get used anymore
+        """
+        self._segment.close()
+
+    def unlink(self):
+        """Remove the segment, should get called by the owner"""
+        self._segment.unlink()
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.name)
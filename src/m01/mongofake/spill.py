@@ -0,0 +1,326 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Memory quotas with spill to disk
+
+The SpillData storage keeps documents in memory up to a memory quota. The
+memory usage of a document is estimated from its encoded BSON size. If the
+resident documents exceed the quota of the collection or the shared
+MemoryQuota of the client, the least recently used documents get spilled to
+a segment file and get paged in again on access.
+
+A paged in document keeps its record in the segment file and gets evicted
+again without writing it unless it got replaced. Scanning all documents
+(items, values) reads spilled documents without paging them in, a full
+collection scan doesn't evict the hot documents.
+"""
+import collections
+import io
+import os
+import tempfile
+import threading
+import time
+
+from m01.mongofake import Histogram
+from m01.mongofake import copyDocument
+from m01.mongofake import decodeBSON
+from m01.mongofake import encodeBSON
+
+# page in latency histogram bounds in seconds
+PAGE_IN_BOUNDS = (0.00001, 0.0001, 0.001, 0.01, 0.1)
+
+
+class MemoryQuota(object):
+    """Memory budget shared by the SpillData storages of a client.
+
+    Keeps the least recently used order of all resident documents. The lock
+    protects the quota and all its storages.
+    """
+
+    def __init__(self, maxSize=None, path=None):
+        self.maxSize = maxSize
+        # directory of the segment files
+        self.path = path
+        self.size = 0
+        self.lock = threading.RLock()
+        # (storage, key): None, least recently used first
+        self._lru = collections.OrderedDict()
+
+    def _add(self, storage, key, size):
+        self._lru[(storage, key)] = None
+        self.size += size
+
+    def _touch(self, storage, key):
+        self._lru.move_to_end((storage, key))
+
+    def _remove(self, storage, key, size):
+        del self._lru[(storage, key)]
+        self.size -= size
+
+    def _check(self):
+        # spill the coldest documents of all storages
+        if self.maxSize is None:
+            return
+        while self.size > self.maxSize and len(self._lru) > 1:
+            storage, key = next(iter(self._lru))
+            storage._evict(key)
+
+    def stats(self):
+        with self.lock:
+            return {'maxSize': self.maxSize,
+                    'residentBytes': self.size,
+                    'residentDocuments': len(self._lru),
+                    'storages': len(set([s for s, k in self._lru]))}
+
+
+class SpillData(object):
+    """Storage keeping the recently used documents in memory and spilling
+    the others to a segment file.
+
+    Provides the same API as OrderedData. maxSize is the quota of the
+    collection in bytes (BSON size), quota the shared MemoryQuota of the
+    client. The segment file gets created in path (default the quota path
+    or the temp directory) and gets removed when the storage gets closed.
+    """
+
+    # don't compact small segment files
+    minCompactSize = 1024 * 1024
+
+    def __init__(self, maxSize=None, quota=None, path=None):
+        if quota is None:
+            quota = MemoryQuota()
+        self.maxSize = maxSize
+        self.quota = quota
+        self.path = path or quota.path
+        self.lock = quota.lock
+        # insert order
+        self._keys = {}
+        # key: (doc, size), least recently used first
+        self._resident = collections.OrderedDict()
+        self._residentSize = 0
+        # key: (offset, size) of the record in the segment file
+        self._spilled = {}
+        self._file = None
+        self._filePath = None
+        self._end = 0
+        self.garbage = 0
+        # metrics
+        self.evictions = 0
+        self.spills = 0
+        self.pageIns = 0
+        self.reads = 0
+        self.pageInLatency = Histogram(PAGE_IN_BOUNDS)
+
+    # segment file
+    def _open(self):
+        fd, path = tempfile.mkstemp(prefix='m01-mongofake-spill-',
+            suffix='.bson', dir=self.path)
+        self._file = io.open(fd, 'w+b')
+        if os.name == 'posix':
+            # the open file stays usable and gets freed if the storage
+            # doesn't get closed, e.g. after a failing test
+            os.remove(path)
+            path = None
+        self._filePath = path
+
+    def _closeFile(self):
+        self._file.close()
+        if self._filePath is not None:
+            os.remove(self._filePath)
+        self._file = self._filePath = None
+
+    def _write(self, data):
+        if self._file is None:
+            self._open()
+        offset = self._end
+        self._file.seek(offset)
+        self._file.write(data)
+        self._end += len(data)
+        return offset
+
+    def _read(self, key):
+        offset, size = self._spilled[key]
+        self._file.seek(offset)
+        return decodeBSON(self._file.read(size))
+
+    def _drop(self, key):
+        # the segment file record of key becomes garbage
+        record = self._spilled.pop(key, None)
+        if record is not None:
+            self.garbage += record[1]
+
+    def compact(self):
+        """Rewrite the segment file without garbage"""
+        with self.lock:
+            if self._file is None:
+                return
+            old, oldPath = self._file, self._filePath
+            spilled = self._spilled
+            self._file = self._filePath = None
+            self._spilled = {}
+            self._end = 0
+            self.garbage = 0
+            for key, (offset, size) in spilled.items():
+                old.seek(offset)
+                self._spilled[key] = (self._write(old.read(size)), size)
+            old.close()
+            if oldPath is not None:
+                os.remove(oldPath)
+
+    def _checkCompact(self):
+        if self.garbage > self.minCompactSize and self.garbage * 2 > self._end:
+            self.compact()
+
+    def close(self):
+        """Remove the segment file and release the quota"""
+        with self.lock:
+            for key, (doc, size) in self._resident.items():
+                self.quota._remove(self, key, size)
+            self._resident.clear()
+            self._residentSize = 0
+            if self._file is not None:
+                self._closeFile()
+            self._spilled = {}
+            self._keys = {}
+            self._end = self.garbage = 0
+
+    # residency
+    def _evict(self, key):
+        doc, size = self._resident.pop(key)
+        self._residentSize -= size
+        self.quota._remove(self, key, size)
+        if key not in self._spilled:
+            # new or replaced since the last spill
+            data = encodeBSON(doc)
+            self._spilled[key] = (self._write(data), len(data))
+            self.spills += 1
+        self.evictions += 1
+
+    def _makeResident(self, key, doc, size):
+        self._resident[key] = (doc, size)
+        self._residentSize += size
+        self.quota._add(self, key, size)
+        if self.maxSize is not None:
+            while self._residentSize > self.maxSize and \
+                    len(self._resident) > 1:
+                self._evict(next(iter(self._resident)))
+        self.quota._check()
+
+    def _pageIn(self, key):
+        start = time.time()
+        doc = self._read(key)
+        self.pageInLatency.add(time.time() - start)
+        self.pageIns += 1
+        self._makeResident(key, doc, self._spilled[key][1])
+        return doc
+
+    # storage API
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __getitem__(self, key):
+        with self.lock:
+            entry = self._resident.get(key)
+            if entry is not None:
+                self._resident.move_to_end(key)
+                self.quota._touch(self, key)
+                return entry[0]
+            if key not in self._spilled:
+                raise KeyError(key)
+            return self._pageIn(key)
+
+    def __setitem__(self, key, item):
+        doc = copyDocument(item)
+        size = len(encodeBSON(doc))
+        with self.lock:
+            entry = self._resident.pop(key, None)
+            if entry is not None:
+                self._residentSize -= entry[1]
+                self.quota._remove(self, key, entry[1])
+            self._drop(key)
+            self._keys[key] = None
+            self._makeResident(key, doc, size)
+            self._checkCompact()
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self._keys[key]
+            entry = self._resident.pop(key, None)
+            if entry is not None:
+                self._residentSize -= entry[1]
+                self.quota._remove(self, key, entry[1])
+            self._drop(key)
+            self._checkCompact()
+
+    def get(self, key, default=None):
+        """Get item by key, pages in a spilled document"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _scan(self, key):
+        # read a document without changing the residency
+        with self.lock:
+            entry = self._resident.get(key)
+            if entry is not None:
+                return entry[0]
+            if key not in self._spilled:
+                # removed meanwhile
+                return None
+            self.reads += 1
+            return self._read(key)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        for key in self.keys():
+            doc = self._scan(key)
+            if doc is not None:
+                yield doc
+
+    def items(self):
+        for key in self.keys():
+            doc = self._scan(key)
+            if doc is not None:
+                yield (key, doc)
+
+    def __iter__(self):
+        return self.values()
+
+    def __repr__(self):
+        return repr(list(self.values()))
+
+    def stats(self):
+        """Return the resident and spilled counters and the page in
+        latency histogram"""
+        with self.lock:
+            spilled = [size for key, (offset, size) in self._spilled.items()
+                       if key not in self._resident]
+            return {'maxSize': self.maxSize,
+                    'documents': len(self._keys),
+                    'residentDocuments': len(self._resident),
+                    'residentBytes': self._residentSize,
+                    'spilledDocuments': len(spilled),
+                    'spilledBytes': sum(spilled),
+                    'fileSize': self._end,
+                    'garbage': self.garbage,
+                    'evictions': self.evictions,
+                    'spills': self.spills,
+                    'pageIns': self.pageIns,
+                    'reads': self.reads,
+                    'pageInLatency': self.pageInLatency.toDict()}
@@ -37,6 +37,9 @@ PY_COMPAT = RENormalizing([
     # Python 3 adds module.
     (re.compile('datetime.datetime'),
      r"datetime"),
+    # Python 3.7 changed the compiled regex pattern repr
+    (re.compile(r"re\.compile\('[^']*'(, re\.[A-Z|.]+)?\)"),
+     r"<_sre.SRE_Pattern object at ...>"),
    ])
 
 CHECKER = RENormalizing([
@@ -92,6 +95,37 @@ def test_suite():
             optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS),
     )
 
+    # fake only features
+    fakeNames = ['shared.txt',
+                 'pool.txt',
+                 'session.txt',
+                 'raw.txt',
+                 'cache.txt',
+                 'text.txt',
+                 'geo.txt',
+                 'grid.txt',
+                 'sharding.txt',
+                 'replica.txt',
+                 'findandmodify.txt',
+                 'index.txt',
+                 'workload.txt',
+                 'durable.txt',
+                 'cursors.txt',
+                 'generator.txt',
+                 'spill.txt',
+                 'mapreduce.txt',
+                 'perfmodel.txt',
+                 'commands.txt',
+                 'views.txt',
+                 'benchmark.txt',
+                 ]
+    for name in fakeNames:
+        append(
+            doctest.DocFileSuite(name,
+                checker=PY_COMPAT+FAKE_CHECKER,
+                optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS),
+        )
+
     # return test suite
     return unittest.TestSuite(suites)
 
@@ -0,0 +1,339 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Text index
+
+The TextIndex is an inverted index mapping each term to a posting list of
+document keys and their term score. The index gets maintained by the
+collection write funnel. $text queries intersect the posting lists of phrase
+terms, unite the posting lists of the other terms and remove the documents
+containing negated terms.
+"""
+import re
+
+import pymongo.errors
+import six
+
+from m01.mongofake import INDEX_ENTRY_SIZE
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # python 2
+    from collections import Mapping
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+PHRASE_PATTERN = re.compile(r'"([^"]*)"')
+
+STOP_WORDS = frozenset([
+    u'a', u'about', u'above', u'after', u'again', u'against', u'all', u'am',
+    u'an', u'and', u'any', u'are', u'as', u'at', u'be', u'because', u'been',
+    u'before', u'being', u'below', u'between', u'both', u'but', u'by', u'can',
+    u'could', u'did', u'do', u'does', u'doing', u'down', u'during', u'each',
+    u'few', u'for', u'from', u'further', u'had', u'has', u'have', u'having',
+    u'he', u'her', u'here', u'hers', u'herself', u'him', u'himself', u'his',
+    u'how', u'i', u'if', u'in', u'into', u'is', u'it', u'its', u'itself',
+    u'just', u'me', u'more', u'most', u'my', u'myself', u'no', u'nor', u'not',
+    u'now', u'of', u'off', u'on', u'once', u'only', u'or', u'other', u'our',
+    u'ours', u'ourselves', u'out', u'over', u'own', u'same', u'she', u'should',
+    u'so', u'some', u'such', u'than', u'that', u'the', u'their', u'theirs',
+    u'them', u'themselves', u'then', u'there', u'these', u'they', u'this',
+    u'those', u'through', u'to', u'too', u'under', u'until', u'up', u'very',
+    u'was', u'we', u'were', u'what', u'when', u'where', u'which', u'while',
+    u'who', u'whom', u'why', u'will', u'with', u'would', u'you', u'your',
+    u'yours', u'yourself', u'yourselves',
+    ])
+
+VOWELS = frozenset(u'aeiouy')
+
+
+def simpleStemmer(word):
+    """Strip common english suffixes.
+
+    This is only a small subset of the porter stemmer. It doesn't always
+    return real words but reduces the common word forms to the same stem.
+    """
+    if len(word) <= 3:
+        return word
+    # plurals
+    if word.endswith(u'sses'):
+        word = word[:-2]
+    elif word.endswith(u'ies'):
+        word = word[:-3] + u'y'
+    elif word.endswith(u's') and not word.endswith((u'ss', u'us', u'is')):
+        word = word[:-1]
+    # past and progressive forms
+    for suffix in (u'ing', u'ed'):
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if len(stem) >= 3 and VOWELS.intersection(stem):
+                word = stem
+                if (word[-1] == word[-2] and word[-1] not in u'lsz' and
+                    word[-1] not in VOWELS):
+                    word = word[:-1]
+            break
+    if word.endswith(u'e') and len(word) > 3:
+        word = word[:-1]
+    return word
+
+
+# language name: (stop words, stemmer)
+LANGUAGES = {
+    'english': (STOP_WORDS, simpleStemmer),
+    'none': (frozenset(), None),
+    }
+
+
+def registerLanguage(name, stopWords=(), stemmer=None):
+    """Register stop words and a stemmer (callable) for a language"""
+    LANGUAGES[name] = (frozenset(stopWords), stemmer)
+
+
+class TextIndex(object):
+    """Inverted text index.
+
+    The fields are the indexed field names or ``$**`` for all string fields.
+    The stopWords and stemmer arguments override the language defaults.
+    """
+
+    kind = 'text'
+
+    def __init__(self, name, fields, weights=None, default_language='english',
+        language_override='language', stopWords=None, stemmer=None):
+        self.name = name
+        self.fields = list(fields)
+        self.weights = dict([(f, 1) for f in self.fields])
+        if weights:
+            self.weights.update(weights)
+        self.default_language = default_language
+        self.language_override = language_override
+        self.stopWords = stopWords
+        self.stemmer = stemmer
+        self._getAnalyzer(default_language)
+        self.clear()
+
+    def clear(self):
+        # term: {key: score}
+        self.postings = {}
+        # key: {term: score}, used for removing a document
+        self._terms = {}
+        # number of entries (document terms) and estimated size in bytes
+        self.keyCount = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self._terms)
+
+    def copy(self):
+        return TextIndex(self.name, self.fields, self.weights,
+            self.default_language, self.language_override, self.stopWords,
+            self.stemmer)
+
+    # analyzing
+    def _getAnalyzer(self, language):
+        try:
+            stopWords, stemmer = LANGUAGES[language]
+        except KeyError:
+            raise pymongo.errors.OperationFailure(
+                "language override unsupported: %s" % language, 17262)
+        if self.stopWords is not None:
+            stopWords = self.stopWords
+        if self.stemmer is not None:
+            stemmer = self.stemmer
+        return stopWords, stemmer
+
+    def tokenize(self, text, language=None):
+        """Return the terms of a text"""
+        stopWords, stemmer = self._getAnalyzer(
+            language or self.default_language)
+        terms = []
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            if token in stopWords:
+                continue
+            if stemmer is not None:
+                token = stemmer(token)
+            terms.append(token)
+        return terms
+
+    def _strings(self, value):
+        # yield all strings contained in a value
+        if isinstance(value, six.string_types):
+            yield value
+        elif isinstance(value, Mapping):
+            for v in value.values():
+                for s in self._strings(v):
+                    yield s
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                for s in self._strings(v):
+                    yield s
+
+    def _values(self, doc, field):
+        # yield the strings stored in a (dotted) field
+        values = [doc]
+        for part in field.split('.'):
+            found = []
+            for value in values:
+                if isinstance(value, Mapping) and part in value:
+                    found.append(value[part])
+                elif isinstance(value, (list, tuple)):
+                    found.extend([v[part] for v in value
+                                  if isinstance(v, Mapping) and part in v])
+            values = found
+        for value in values:
+            for s in self._strings(value):
+                yield s
+
+    def _texts(self, doc):
+        # yield (weight, text) for all indexed texts of a document
+        if '$**' in self.fields:
+            for field, value in doc.items():
+                if field == '_id':
+                    continue
+                weight = self.weights.get(field, self.weights['$**'])
+                for s in self._strings(value):
+                    yield weight, s
+        else:
+            for field in self.fields:
+                weight = self.weights.get(field, 1)
+                for s in self._values(doc, field):
+                    yield weight, s
+
+    def analyze(self, doc):
+        """Return a dict of term: score for a document.
+
+        The score gets calculated similar to MongoDB. Each additional
+        occurrence of a term counts half of the previous one and the result
+        gets adjusted by the number of terms in the field.
+        """
+        language = doc.get(self.language_override)
+        if not isinstance(language, six.string_types):
+            language = None
+        scores = {}
+        for weight, text in self._texts(doc):
+            terms = self.tokenize(text, language)
+            if not terms:
+                continue
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            numTerms = float(len(terms))
+            for term, count in counts.items():
+                freq = sum([1.0 / 2 ** i for i in range(count)])
+                coeff = 0.5 * count / numTerms + 0.5
+                scores[term] = scores.get(term, 0) + weight * freq * coeff
+        return scores
+
+    # maintenance
+    def add(self, key, doc):
+        scores = self.analyze(doc)
+        if scores:
+            self._terms[key] = scores
+            for term, score in scores.items():
+                self.postings.setdefault(term, {})[key] = score
+                self.size += len(term) + 5 + INDEX_ENTRY_SIZE
+            self.keyCount += len(scores)
+
+    def remove(self, key):
+        scores = self._terms.pop(key, None)
+        if scores:
+            self.keyCount -= len(scores)
+            for term in scores:
+                self.size -= len(term) + 5 + INDEX_ENTRY_SIZE
+                posting = self.postings[term]
+                del posting[key]
+                if not posting:
+                    del self.postings[term]
+
+    # searching
+    def _parse(self, search, language):
+        # return (terms, phrase terms, raw phrases, negated terms)
+        phrases = PHRASE_PATTERN.findall(search)
+        search = PHRASE_PATTERN.sub(u' ', search)
+        terms = []
+        negated = []
+        for word in search.split():
+            if word.startswith(u'-'):
+                negated.extend(self.tokenize(word[1:], language))
+            else:
+                terms.extend(self.tokenize(word, language))
+        phraseTerms = []
+        for phrase in phrases:
+            phraseTerms.extend(self.tokenize(phrase, language))
+        return terms, phraseTerms, phrases, negated
+
+    def _containsPhrases(self, doc, phrases, caseSensitive):
+        texts = [text for weight, text in self._texts(doc)]
+        if not caseSensitive:
+            texts = [text.lower() for text in texts]
+            phrases = [phrase.lower() for phrase in phrases]
+        for phrase in phrases:
+            for text in texts:
+                if phrase in text:
+                    break
+            else:
+                return False
+        return True
+
+    def search(self, query, docs):
+        """Return a list of (key, score) for the given $text query.
+
+        The documents get only loaded from docs for verifying phrases.
+        """
+        search = query.get('$search')
+        if not isinstance(search, six.string_types):
+            raise pymongo.errors.OperationFailure(
+                "$search required and must be a string", 2)
+        language = query.get('$language')
+        caseSensitive = query.get('$caseSensitive', False)
+        terms, phraseTerms, phrases, negated = self._parse(search, language)
+        postings = self.postings
+        if phraseTerms:
+            # all phrase terms are required, intersect starting with the
+            # shortest posting list
+            lists = sorted([postings.get(t, {}) for t in set(phraseTerms)],
+                key=len)
+            keys = [key for key in lists[0]
+                    if all([key in posting for posting in lists[1:]])]
+        else:
+            keys = []
+            seen = set()
+            for term in terms:
+                for key in postings.get(term, ()):
+                    if key not in seen:
+                        seen.add(key)
+                        keys.append(key)
+        excluded = set()
+        for term in negated:
+            excluded.update(postings.get(term, ()))
+        allTerms = set(terms + phraseTerms)
+        res = []
+        for key in keys:
+            if key in excluded:
+                continue
+            if phrases:
+                doc = docs.get(key)
+                if (doc is None or
+                    not self._containsPhrases(doc, phrases, caseSensitive)):
+                    continue
+            scores = self._terms[key]
+            res.append((key, sum([scores.get(t, 0) for t in allTerms])))
+        return res
+
+    def info(self):
+        """Return the index information as provided by index_information"""
+        return {'key': [('_fts', 'text'), ('_ftsx', 1)],
+                'weights': dict([(f, w) for f, w in self.weights.items()]),
+                'default_language': self.default_language,
+                'language_override': self.language_override,
+                'textIndexVersion': 3}
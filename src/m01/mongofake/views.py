@@ -0,0 +1,463 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Materialized views
+
+A MaterializedView keeps the result of a $match, $project and $group
+pipeline over a source collection in a read only view collection. The view
+gets built once, then the write funnel of the source passes each insert,
+update and remove as a delta (old and new document) to the view:
+
+- without $group a row follows its source document
+
+- with $group the old document gets removed from its group and the new one
+  gets added to its group, only the changed groups get written
+
+The $match and $project stages before $group apply per document, the stages
+after $group per group row. $group supports the $sum, $avg, $min, $max and
+$addToSet accumulators, they can remove a value again. Float sums can differ
+from a recomputation in the last digits.
+
+A deferred view queues the deltas and applies them in a batch on the next
+read of the view or on refresh, the deltas of a group get written once. The
+stats contain the refresh lag (commit to apply) and the delta application
+time.
+"""
+import time
+
+import pymongo.errors
+
+from m01.mongofake import MISSING
+from m01.mongofake import NOVALUEMARKER
+from m01.mongofake import FakeCursor
+from m01.mongofake import Histogram
+from m01.mongofake import copyDocument
+from m01.mongofake import getField
+from m01.mongofake import project
+from m01.mongofake import sortKey
+from m01.mongofake import string_types
+from m01.mongofake import toUnicode
+from m01.mongofake.index import hashable
+
+# lag and apply time histogram bounds in seconds
+VIEW_BOUNDS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0)
+
+
+def evaluate(expr, doc):
+    """Evaluate a field path ('$field'), a document of expressions, a
+    $literal or a constant. Missing fields return NOVALUEMARKER."""
+    if isinstance(expr, string_types) and expr.startswith('$'):
+        return getField(doc, expr[1:])
+    if isinstance(expr, dict):
+        if '$literal' in expr:
+            return expr['$literal']
+        res = {}
+        for k, v in expr.items():
+            value = evaluate(v, doc)
+            if value is not NOVALUEMARKER:
+                res[toUnicode(k)] = value
+        return res
+    if isinstance(expr, list):
+        return [evaluate(v, doc) for v in expr]
+    return expr
+
+
+def _projectRow(doc, spec):
+    # apply a $project stage with 0/1 fields and computed fields
+    fields = {}
+    computed = []
+    for k, v in spec.items():
+        if isinstance(v, (bool, int, float)):
+            fields[k] = v
+        else:
+            computed.append((toUnicode(k), v))
+    if fields:
+        res = project(doc, fields)
+    else:
+        res = {}
+        if '_id' in doc:
+            res[u'_id'] = doc['_id']
+    for k, v in computed:
+        value = evaluate(v, doc)
+        if value is not NOVALUEMARKER:
+            res[k] = value
+    return res
+
+
+###############################################################################
+#
+# accumulators
+#
+###############################################################################
+
+def _isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class SumAccumulator(object):
+    """$sum, ignores non numeric values"""
+
+    def create(self):
+        return [0]
+
+    def add(self, state, value):
+        if _isNumber(value):
+            state[0] += value
+
+    def remove(self, state, value):
+        if _isNumber(value):
+            state[0] -= value
+
+    def result(self, state):
+        return state[0]
+
+
+class AvgAccumulator(object):
+    """$avg, ignores non numeric values"""
+
+    def create(self):
+        return [0, 0]
+
+    def add(self, state, value):
+        if _isNumber(value):
+            state[0] += value
+            state[1] += 1
+
+    def remove(self, state, value):
+        if _isNumber(value):
+            state[0] -= value
+            state[1] -= 1
+
+    def result(self, state):
+        if not state[1]:
+            return None
+        return float(state[0]) / state[1]
+
+
+class _CountingAccumulator(object):
+    # keeps {hashable value: [value, count]}, state is [values, best]
+
+    def create(self):
+        return [{}, NOVALUEMARKER]
+
+    def add(self, state, value):
+        if value is NOVALUEMARKER or value is None:
+            return
+        entry = state[0].setdefault(hashable(value), [value, 0])
+        entry[1] += 1
+
+    def remove(self, state, value):
+        if value is NOVALUEMARKER or value is None:
+            return
+        h = hashable(value)
+        entry = state[0][h]
+        entry[1] -= 1
+        if not entry[1]:
+            del state[0][h]
+
+
+class MinAccumulator(_CountingAccumulator):
+    """$min, ignores null and missing values"""
+
+    reverse = False
+
+    def _better(self, value, best):
+        if self.reverse:
+            return sortKey(value) > sortKey(best)
+        return sortKey(value) < sortKey(best)
+
+    def add(self, state, value):
+        super(MinAccumulator, self).add(state, value)
+        if value is NOVALUEMARKER or value is None:
+            return
+        if state[1] is NOVALUEMARKER or self._better(value, state[1]):
+            state[1] = value
+
+    def remove(self, state, value):
+        super(MinAccumulator, self).remove(state, value)
+        if value is NOVALUEMARKER or value is None:
+            return
+        if hashable(value) not in state[0] and \
+                hashable(value) == hashable(state[1]):
+            # the extreme value got removed, find the next one
+            best = NOVALUEMARKER
+            for v, count in state[0].values():
+                if best is NOVALUEMARKER or self._better(v, best):
+                    best = v
+            state[1] = best
+
+    def result(self, state):
+        if state[1] is NOVALUEMARKER:
+            return None
+        return state[1]
+
+
+class MaxAccumulator(MinAccumulator):
+    """$max, ignores null and missing values"""
+
+    reverse = True
+
+
+class AddToSetAccumulator(_CountingAccumulator):
+    """$addToSet, the values in first added order"""
+
+    def result(self, state):
+        return [v for v, count in state[0].values()]
+
+
+ACCUMULATORS = {
+    '$sum': SumAccumulator,
+    '$avg': AvgAccumulator,
+    '$min': MinAccumulator,
+    '$max': MaxAccumulator,
+    '$addToSet': AddToSetAccumulator,
+    }
+
+# accumulators which can't remove a value
+UNSUPPORTED_ACCUMULATORS = ('$first', '$last', '$push', '$stdDevPop',
+    '$stdDevSamp', '$mergeObjects')
+
+
+class _Group(object):
+    """State of one group"""
+
+    def __init__(self, groupId, accumulators):
+        self.id = groupId
+        self.count = 0
+        self.states = [acc.create() for name, expr, acc in accumulators]
+
+
+###############################################################################
+#
+# view
+#
+###############################################################################
+
+class MaterializedView(object):
+    """View collection maintained from the deltas of the source collection.
+
+    The view gets attached to the source and the view collection and gets
+    built from the source documents.
+    """
+
+    def __init__(self, source, collection, pipeline, deferred=False):
+        self.source = source
+        self.collection = collection
+        self.pipeline = list(pipeline)
+        self.deferred = deferred
+        self._parse(self.pipeline)
+        # used for matching documents
+        self._cursor = FakeCursor(source, {}, None, 0, 0, True, True, False)
+        # hashable group id: _Group
+        self._groups = {}
+        # (commit time, key, old contribution, new contribution)
+        self._pending = []
+        # metrics
+        self.deltas = 0
+        self.skipped = 0
+        self.batches = 0
+        self.writes = 0
+        self.rebuilds = 0
+        self.lag = Histogram(VIEW_BOUNDS)
+        self.applyTime = Histogram(VIEW_BOUNDS)
+        with source._client._lock:
+            collection._view = self
+            source._views.append(self)
+            self.rebuild()
+
+    def _parse(self, pipeline):
+        self._before = []
+        self._group = None
+        self._after = []
+        stages = self._before
+        for stage in pipeline:
+            if not isinstance(stage, dict) or len(stage) != 1:
+                raise pymongo.errors.OperationFailure(
+                    "A pipeline stage specification object must contain "
+                    "exactly one field.", 40323)
+            name, spec = list(stage.items())[0]
+            if name in ('$match', '$project'):
+                stages.append((name, spec))
+            elif name == '$group' and self._group is None:
+                self._parseGroup(spec)
+                stages = self._after
+            elif name == '$group':
+                raise pymongo.errors.OperationFailure(
+                    "a view supports one $group stage", 2)
+            else:
+                raise pymongo.errors.OperationFailure(
+                    "Unrecognized pipeline stage name: '%s'" % name, 40324)
+
+    def _parseGroup(self, spec):
+        if '_id' not in spec:
+            raise pymongo.errors.OperationFailure(
+                "a group specification must include an _id", 15955)
+        self._groupId = spec['_id']
+        self._accumulators = []
+        for name, value in spec.items():
+            if name == '_id':
+                continue
+            op = isinstance(value, dict) and len(value) == 1 and \
+                list(value.keys())[0] or None
+            if op in UNSUPPORTED_ACCUMULATORS:
+                raise pymongo.errors.OperationFailure(
+                    "%s is not supported by an incrementally maintained "
+                    "view" % op, 2)
+            if op not in ACCUMULATORS:
+                raise pymongo.errors.OperationFailure(
+                    "unknown group operator '%s'" % op, 15952)
+            self._accumulators.append(
+                (toUnicode(name), value[op], ACCUMULATORS[op]()))
+        self._group = spec
+
+    def _applyStages(self, doc, stages):
+        # return the row of the document or None if it doesn't match
+        for name, spec in stages:
+            if name == '$match':
+                if not self._cursor._match(doc, spec):
+                    return None
+            else:
+                doc = _projectRow(doc, spec)
+        return doc
+
+    def _contribution(self, doc):
+        # the row or the (group id, values) of a source document or None
+        if doc is MISSING:
+            return None
+        row = self._applyStages(doc, self._before)
+        if row is None or self._group is None:
+            return row
+        groupId = evaluate(self._groupId, row)
+        if groupId is NOVALUEMARKER:
+            groupId = None
+        return (groupId, [evaluate(expr, row)
+                          for name, expr, acc in self._accumulators])
+
+    # maintenance
+    def delta(self, key, old, doc):
+        """Apply (or queue) the change of a source document, called by the
+        write funnel of the source with the client lock"""
+        if self.deferred and doc is not MISSING:
+            # the caller can change the document later
+            doc = copyDocument(doc)
+        old = self._contribution(old)
+        new = self._contribution(doc)
+        if old == new:
+            # not in the view or an unchanged row or group value
+            self.skipped += 1
+            return
+        if self.deferred:
+            self._pending.append((time.time(), key, old, new))
+        else:
+            self._apply([(time.time(), key, old, new)])
+
+    def refresh(self):
+        """Apply the queued deltas"""
+        with self.source._client._lock:
+            if self._pending:
+                pending, self._pending = self._pending, []
+                self._apply(pending)
+
+    def _apply(self, deltas, rebuild=False):
+        start = time.time()
+        # target key: row, None for a removed row
+        rows = {}
+        groups = {}
+        for ts, key, old, new in deltas:
+            self.lag.add(start - ts)
+            if self._group is None:
+                rows[key] = new
+                continue
+            if old is not None:
+                h = hashable(old[0])
+                group = self._groups[h]
+                group.count -= 1
+                for (name, expr, acc), state, value in zip(
+                        self._accumulators, group.states, old[1]):
+                    acc.remove(state, value)
+                groups[h] = group
+            if new is not None:
+                h = hashable(new[0])
+                group = self._groups.get(h)
+                if group is None:
+                    group = self._groups[h] = _Group(new[0],
+                        self._accumulators)
+                group.count += 1
+                for (name, expr, acc), state, value in zip(
+                        self._accumulators, group.states, new[1]):
+                    acc.add(state, value)
+                groups[h] = group
+        for h, group in groups.items():
+            if not group.count:
+                del self._groups[h]
+            rows[toUnicode(group.id)] = self._getGroupRow(group)
+        if rebuild:
+            # remove the old rows
+            for key in list(self.collection.docs.keys()):
+                rows.setdefault(key, None)
+        self._write(rows)
+        self.deltas += len(deltas)
+        self.batches += 1
+        self.applyTime.add(time.time() - start)
+
+    def _getGroupRow(self, group):
+        if not group.count:
+            return None
+        row = {u'_id': group.id}
+        for (name, expr, acc), state in zip(self._accumulators,
+                                            group.states):
+            row[name] = acc.result(state)
+        return self._applyStages(row, self._after)
+
+    def _write(self, rows):
+        # write the changed rows with the write funnel of the view
+        collection = self.collection
+        client = collection._client
+        for key, row in rows.items():
+            if row is None:
+                if key not in collection.docs:
+                    continue
+                row = MISSING
+            collection._commit(key, row, client._tick())
+            self.writes += 1
+
+    def rebuild(self):
+        """Rebuild the view from the source documents"""
+        with self.source._client._lock:
+            self._pending = []
+            self._groups = {}
+            now = time.time()
+            deltas = []
+            for key, doc in self.source.docs.items():
+                new = self._contribution(doc)
+                if new is not None:
+                    deltas.append((now, key, None, new))
+            self._apply(deltas, rebuild=True)
+            self.rebuilds += 1
+
+    def stats(self):
+        """Return the row, group and delta counters and the refresh lag and
+        delta application time histograms"""
+        with self.source._client._lock:
+            return {'source': self.source.name,
+                    'rows': len(self.collection.docs),
+                    'groups': len(self._groups),
+                    'deferred': self.deferred,
+                    'pending': len(self._pending),
+                    'deltas': self.deltas,
+                    'skipped': self.skipped,
+                    'batches': self.batches,
+                    'writes': self.writes,
+                    'rebuilds': self.rebuilds,
+                    'lag': self.lag.toDict(),
+                    'applyTime': self.applyTime.toDict()}
@@ -0,0 +1,327 @@
+##############################################################################
+#
+# Copyright (c) 2012 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Workload capture and replay
+
+A WorkloadRecorder writes one trace entry per FakeCollection call to a JSON
+Lines (extended JSON) or BSON trace. FakeMongoClient.enableRecording records
+the calls of a fake client, a CommandRecorder records the commands of a real
+pymongo client as pymongo CommandListener.
+
+A trace entry is a dict with the keys:
+
+- t, the start time in seconds since the recording started
+
+- db, collection and op, the collection method name
+
+- args and kwargs of the method call
+
+- ms, the duration of the call in milliseconds. find returns a lazy cursor,
+  its duration only covers creating the cursor and not running the query
+
+replay runs a trace against a FakeMongoClient with N worker threads or
+processes and reports the throughput and the latency percentiles per
+operation. The replay iterates the returned cursors, the replayed latency of
+find includes running the query and isn't comparable with the recorded ms.
+"""
+import collections
+import io
+import math
+import threading
+import time
+
+import bson
+import bson.json_util
+import pymongo.monitoring
+import six
+
+from m01.mongofake import FakeCursor
+from m01.mongofake.forking import forkPool
+from m01.mongofake.forking import getState
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _getFormat(path, format):
+    if format is None:
+        format = path.endswith('.bson') and 'bson' or 'json'
+    if format not in ('json', 'bson'):
+        raise ValueError("format must be 'json' or 'bson'")
+    return format
+
+
+class WorkloadRecorder(object):
+    """Write trace entries to a JSON Lines or BSON file or stream.
+
+    The format gets derived from the file extension (.bson) if not given.
+    """
+
+    def __init__(self, target, format=None):
+        if isinstance(target, six.string_types):
+            format = _getFormat(target, format)
+            target = io.open(target, format == 'bson' and 'wb' or 'w')
+            self._close = True
+        else:
+            format = format or 'json'
+            self._close = False
+        self.stream = target
+        self.format = format
+        self.count = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _encode(self, value):
+        # tuples and SON become lists and dicts, sessions get dropped
+        if isinstance(value, dict):
+            return dict([(k, self._encode(v)) for k, v in value.items()])
+        if isinstance(value, (list, tuple)):
+            return [self._encode(v) for v in value]
+        return value
+
+    def write(self, entry):
+        """Append a trace entry"""
+        entry = self._encode(entry)
+        if self.format == 'bson':
+            data = bson.BSON.encode(entry)
+        else:
+            data = six.text_type(bson.json_util.dumps(entry,
+                separators=(',', ':'))) + u'\n'
+        with self._lock:
+            self.stream.write(data)
+            self.count += 1
+
+    def record(self, db, collection, op, args=(), kwargs=None, start=None,
+        duration=0.0):
+        if start is None:
+            start = time.time()
+        kwargs = dict([(k, v) for k, v in (kwargs or {}).items()
+                       if k != 'session'])
+        if 'read_preference' in kwargs:
+            from m01.mongofake.replica import getMode
+            kwargs['read_preference'] = getMode(kwargs['read_preference'])
+        self.write({'t': round(start - self.start, 6),
+                    'db': db,
+                    'collection': collection,
+                    'op': op,
+                    'args': list(args),
+                    'kwargs': kwargs,
+                    'ms': round(duration * 1000, 3)})
+
+    def call(self, collection, name, func, args, kwargs):
+        """Run and record a collection method, nested calls don't get
+        recorded. The duration of find doesn't include the query, the cursor
+        runs it when iterated"""
+        local = self._local
+        if getattr(local, 'active', False):
+            return func(collection, *args, **kwargs)
+        local.active = True
+        start = time.time()
+        try:
+            return func(collection, *args, **kwargs)
+        finally:
+            local.active = False
+            # after the call, inserts added the _id
+            self.record(collection.database.name, collection.name, name,
+                args, kwargs, start, time.time() - start)
+
+    def close(self):
+        with self._lock:
+            if self._close:
+                self.stream.close()
+            else:
+                self.stream.flush()
+
+
+class CommandRecorder(pymongo.monitoring.CommandListener):
+    """Record the commands of a real client as collection calls.
+
+    Register it with pymongo.monitoring.register or the event_listeners
+    option of a MongoClient.
+    """
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def _convert(self, name, cmd):
+        # return a list of (op, args, kwargs) for a command
+        if name == 'find':
+            kwargs = {'skip': cmd.get('skip', 0),
+                      'limit': cmd.get('limit', 0)}
+            if cmd.get('projection'):
+                kwargs['fields'] = cmd['projection']
+            if cmd.get('sort'):
+                kwargs['sort'] = list(cmd['sort'].items())
+            return [('find', [cmd.get('filter', {})], kwargs)]
+        if name == 'insert':
+            return [('insert', [cmd.get('documents', [])], {})]
+        if name == 'update':
+            return [('update', [u['q'], u['u']],
+                     {'upsert': u.get('upsert', False),
+                      'multi': u.get('multi', False)})
+                    for u in cmd.get('updates', ())]
+        if name == 'delete':
+            return [('remove', [d['q']], {}) for d in cmd.get('deletes', ())]
+        if name == 'count':
+            return [('count_documents', [cmd.get('query') or {}], {})]
+        if name == 'distinct':
+            return [('distinct', [cmd['key'], cmd.get('query') or {}], {})]
+        if name == 'findAndModify':
+            kwargs = {'remove': cmd.get('remove', False),
+                      'new': cmd.get('new', False),
+                      'upsert': cmd.get('upsert', False)}
+            if cmd.get('update'):
+                kwargs['update'] = cmd['update']
+            if cmd.get('fields'):
+                kwargs['fields'] = cmd['fields']
+            if cmd.get('sort'):
+                kwargs['sort'] = list(cmd['sort'].items())
+            return [('find_and_modify', [cmd.get('query', {})], kwargs)]
+        return []
+
+    def started(self, event):
+        ops = self._convert(event.command_name, event.command)
+        if ops:
+            with self._lock:
+                self._started[event.request_id] = (time.time(),
+                    event.database_name, event.command[event.command_name],
+                    ops)
+
+    def _finish(self, event):
+        with self._lock:
+            started = self._started.pop(event.request_id, None)
+        if started is not None:
+            start, db, collection, ops = started
+            for op, args, kwargs in ops:
+                self.recorder.record(db, collection, op, args, kwargs, start,
+                    event.duration_micros / 1e6)
+
+    succeeded = _finish
+    failed = _finish
+
+
+def readTrace(source, format=None):
+    """Iterate the entries of a JSON Lines or BSON trace file or stream"""
+    if isinstance(source, six.string_types):
+        format = _getFormat(source, format)
+        with io.open(source, format == 'bson' and 'rb' or 'r') as f:
+            for entry in readTrace(f, format):
+                yield entry
+        return
+    if (format or 'json') == 'bson':
+        for entry in bson.decode_file_iter(source):
+            yield entry
+    else:
+        for line in source:
+            if line.strip():
+                yield bson.json_util.loads(line)
+
+
+def percentile(values, pct):
+    """Return the percentile of sorted values (nearest rank)"""
+    if not values:
+        return 0.0
+    idx = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(idx, len(values) - 1))]
+
+
+def _runEntries(client, entries, timeScale, start=None):
+    # replay entries, return {op: [latency, ...]} and the error count
+    if start is None:
+        start = time.time()
+    latencies = collections.defaultdict(list)
+    errors = 0
+    for entry in entries:
+        if timeScale:
+            wait = start + entry['t'] * timeScale - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        collection = client[entry['db']][entry['collection']]
+        method = getattr(collection, entry['op'])
+        begin = time.time()
+        try:
+            res = method(*entry['args'], **entry['kwargs'])
+            if isinstance(res, FakeCursor):
+                list(res)
+        except Exception:
+            errors += 1
+        latencies[entry['op']].append(time.time() - begin)
+    return dict(latencies), errors
+
+
+def _runProcess(idx):
+    # worker process, the client is the forked copy of the parent client
+    client, parts, timeScale = getState()
+    return _runEntries(client, parts[idx], timeScale)
+
+
+def replay(trace, client, concurrency=1, mode='threads', timeScale=0.0,
+    format=None):
+    """Replay a trace against a fake client and return a report.
+
+    The trace is a file name, a stream or a list of entries. The entries get
+    spread over concurrency workers (mode 'threads' or 'processes'). Each
+    process replays against its own forked copy of the client. timeScale
+    scales the recorded start times, 1.0 replays in real time, 0.5 twice as
+    fast and 0 without waiting.
+    """
+    if not isinstance(trace, list):
+        trace = list(readTrace(trace, format))
+    concurrency = max(1, concurrency)
+    parts = [trace[i::concurrency] for i in range(concurrency)]
+    start = time.time()
+    if mode == 'processes':
+        pool = forkPool(concurrency, (client, parts, timeScale))
+        try:
+            results = pool.map(_runProcess, range(concurrency))
+        finally:
+            pool.close()
+            pool.join()
+    elif mode == 'threads':
+        results = [None] * concurrency
+
+        def run(idx):
+            results[idx] = _runEntries(client, parts[idx], timeScale, start)
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        raise ValueError("mode must be 'threads' or 'processes'")
+    duration = time.time() - start
+
+    latencies = collections.defaultdict(list)
+    errors = 0
+    for result, failed in results:
+        errors += failed
+        for op, values in result.items():
+            latencies[op].extend(values)
+    ops = {}
+    for op, values in latencies.items():
+        values.sort()
+        stats = {'count': len(values),
+                 'mean': sum(values) / len(values),
+                 'max': values[-1]}
+        for pct in PERCENTILES:
+            stats['p%d' % pct] = percentile(values, pct)
+        ops[op] = stats
+    return {'operations': len(trace),
+            'errors': errors,
+            'duration': duration,
+            'throughput': duration and len(trace) / duration or 0.0,
+            'latency': ops}